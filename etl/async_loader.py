@@ -0,0 +1,302 @@
+import argparse
+import asyncio
+import logging
+from contextlib import suppress
+from logging import config
+from time import perf_counter
+from typing import AsyncGenerator, AsyncIterable, Optional
+
+from elasticsearch import AIOHttpConnection, AsyncElasticsearch
+from elasticsearch.helpers import async_streaming_bulk
+from psycopg.conninfo import make_conninfo
+from psycopg.types.string import TextLoader
+from psycopg_pool import AsyncConnectionPool
+
+from data_workers import ElasticsearchLoader, Filmwork, Genre, Person
+from digests import DigestStore
+from etc.config import (AWAIT_TIME, BATCH_SIZE, BULK, CHECKPOINT_CHUNKS, DIGEST_DB_PATH, DSL, ES_CONFIG,
+                        LOGGER_CONF_PATH, METRICS, PG_POOL, PIPELINE_QUEUE_SIZE, SHARD, STATE_FILE_PATH,
+                        TABLE_INDEXES)
+from etc.queries import QUERIES
+from metrics import BULK_SECONDS, CYCLE_SECONDS, PG_FETCH_SECONDS, TRANSFORM_SECONDS, start_metrics_server
+from pipeline import StageError
+from planner import ChangePlanner
+from progress import Progress
+from serializers import FastJSONSerializer
+from shard import Shard
+from state import JsonFileStorage, State
+from table_run import TableRun, rejected_ids, report_lag, resume_point
+from utils import async_backoff
+
+tables = {
+    'filmwork': Filmwork,
+    'person': Person,
+    'genre': Genre
+}
+
+shard = Shard()
+
+
+class InstrumentedAIOHttpConnection(AIOHttpConnection):
+    """
+    Асинхронное соединение elasticsearch, замеряющее время bulk запросов
+    """
+
+    async def perform_request(self, method, url, *args, **kwargs):
+        if not url.endswith('/_bulk'):
+            return await super().perform_request(method, url, *args, **kwargs)
+        with BULK_SECONDS.time():
+            return await super().perform_request(method, url, *args, **kwargs)
+
+
+class AsyncPostgresLoader:
+    """
+    Класс асинхронного выполнения запросов к postgresql (psycopg 3) на соединении из пула
+    """
+
+    def __init__(self, *, pool: AsyncConnectionPool, fetch_size: int = 300):
+        self.pool = pool
+        self.fetch_size = fetch_size
+
+    async def __aenter__(self):
+        self.context = self.pool.connection()
+        self.connection = await self.context.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.context.__aexit__(exc_type, exc_val, exc_tb)
+
+    async def batch_execute(self, *, query: str, params: Optional[dict] = None,
+                            name: Optional[str] = None) -> AsyncGenerator:
+        """
+        Метод извлечения группы полей
+
+        :param query: sql запрос
+        :param params: параметры sql запроса
+        :param name: имя серверного курсора, если не указано - используется клиентский курсор
+        :yield: rows: группа полей, результат выполнения запроса
+        """
+        async with self.connection.cursor(name=name) if name else self.connection.cursor() as cursor:
+            started = perf_counter()
+            await cursor.execute(query, params)
+            while rows := await cursor.fetchmany(self.fetch_size):
+                PG_FETCH_SECONDS.observe(perf_counter() - started)
+                logging.debug(f'Postgres executed: {len(rows)}')
+                yield rows
+                started = perf_counter()
+
+
+async def configure_connection(connection) -> None:
+    """
+    Функция настройки соединения пула: uuid возвращаются строками, как в psycopg2
+    """
+    connection.adapters.register_loader('uuid', TextLoader)
+
+
+@async_backoff()
+async def check_indexes(*, es: AsyncElasticsearch) -> None:
+    """
+    Функция создания отсутствующих индексов elasticsearch и добавления новых полей в существующие
+    """
+    for key, index in ES_CONFIG['index_names'].items():
+        mapping = ElasticsearchLoader.load_settings(ES_CONFIG['movies_settings'][key])
+        if not await es.indices.exists(index=index):
+            await es.indices.create(index=index, body=mapping)
+            logging.debug(f'Elasticsearch index {index} created')
+        else:
+            await es.indices.put_mapping(index=index, body=mapping['mappings'])
+
+
+async def extract_data(*, pool: AsyncConnectionPool, table: str, table_state: dict,
+                       cursor: Optional[dict] = None, rejected: Optional[list] = None) -> AsyncGenerator:
+    """
+    Функция извлечения измененных данных из postgresql
+
+    :param pool: пул соединений postgresql
+    :param table: название таблицы
+    :param table_state: состояние загрузки последней таблицы
+    :param cursor: позиция, с которой нужно продолжить прерванную загрузку таблицы
+    :param rejected: идентификаторы отклоненных ранее документов, извлекаются повторно после изменений
+    :yield: item, cursor: единичный результат выполнения sql запроса и позиция извлечения,
+        если строка завершает группу извлечения
+    """
+    async with AsyncPostgresLoader(pool=pool, fetch_size=BATCH_SIZE) as pg:
+        planner = ChangePlanner(pg=pg, batch_size=BATCH_SIZE, shard=shard)
+        async for batch, position in planner.changed_ids_async(table=table, table_state=table_state, cursor=cursor):
+            async for item in fetch_rows(pg=pg, table=table, ids=batch, position=position):
+                yield item
+        for i in range(0, len(rejected or ()), BATCH_SIZE):
+            async for item in fetch_rows(pg=pg, table=table, ids=rejected[i:i + BATCH_SIZE]):
+                yield item
+
+
+async def fetch_rows(*, pg: AsyncPostgresLoader, table: str, ids: list,
+                     position: Optional[dict] = None) -> AsyncGenerator:
+    """
+    Функция извлечения строк пачки идентификаторов запросом обогащения
+
+    :param pg: соединение postgresql
+    :param table: название таблицы
+    :param ids: пачка идентификаторов
+    :param position: позиция извлечения после пачки
+    :yield: item, cursor: строка и позиция извлечения, если строка последняя в пачке
+    """
+    last = None
+    async for data in pg.batch_execute(query=QUERIES[table], params={'ids': ids}):
+        for item in data:
+            if last is not None:
+                yield last, None
+            last = item
+    if last is not None:
+        yield last, position
+
+
+async def transform_data(*, data: AsyncIterable, table: str, progress: Progress) -> AsyncGenerator:
+    """
+    Функция форматирования сырого sql поля в требуемый elasticsearch
+
+    :param data: строка tuple - результат выполнения sql запроса и позиция извлечения
+    :param table: название таблицы
+    :param progress: учет подтвержденных документов запуска
+    :yield: list: пачка словарей для bulk запроса Elasticsearch
+    """
+    batch, elapsed = [], 0.0
+    async for item, cursor in data:
+        started = perf_counter()
+        doc = tables[table](*item)
+        progress.register(doc_id=doc.id, times=doc.get_db_state(), cursor=cursor)
+        batch.append(doc.get_bulk_format())
+        elapsed += perf_counter() - started
+        if len(batch) >= BATCH_SIZE:
+            TRANSFORM_SECONDS.observe(elapsed, table=table)
+            yield batch
+            batch, elapsed = [], 0.0
+    if batch:
+        TRANSFORM_SECONDS.observe(elapsed, table=table)
+        yield batch
+
+
+async def produce(*, data: AsyncIterable, queue: asyncio.Queue) -> None:
+    """
+    Функция заполнения ограниченной очереди пачками, пока загрузка предыдущих пачек еще идет.
+    None в очереди означает конец данных
+    """
+    try:
+        async for batch in data:
+            await queue.put(batch)
+        await queue.put(None)
+    except Exception as e:
+        await queue.put(StageError(e))
+
+
+async def consume(*, queue: asyncio.Queue) -> AsyncGenerator:
+    while (batch := await queue.get()) is not None:
+        if isinstance(batch, StageError):
+            raise batch.error
+        for action in batch:
+            yield action
+
+
+async def load_data(*, es: AsyncElasticsearch, data: AsyncIterable, table: str, progress: Progress) -> None:
+    """
+    Функция загрузки данных в elasticsearch
+
+    :param es: асинхронный клиент elasticsearch
+    :param data: документы в формате bulk запроса
+    :param table: название таблицы
+    :param progress: учет подтвержденных документов запуска
+    """
+    run = TableRun(state=state, digest_store=digest_store, table=table, index=TABLE_INDEXES[table],
+                   progress=progress, checkpoint_every=CHECKPOINT_CHUNKS * BATCH_SIZE)
+    try:
+        async for ok, item in async_streaming_bulk(es, run.digests.filter_async(data), chunk_size=BATCH_SIZE,
+                                                   max_chunk_bytes=BULK['max_chunk_bytes'],
+                                                   max_retries=BULK['max_retries'],
+                                                   initial_backoff=BULK['initial_backoff'],
+                                                   raise_on_error=False):
+            run.result(ok=ok, item=item)
+    except BaseException:
+        run.interrupted()
+        raise
+    finally:
+        run.close()
+    run.complete()
+
+
+@async_backoff()
+async def run_table(*, pool: AsyncConnectionPool, es: AsyncElasticsearch, table: str) -> None:
+    """
+    Функция запуска ETL процесса для одной таблицы.
+    При ошибке запуск повторяется целиком и продолжается с сохраненной позиции
+
+    :param pool: пул соединений postgresql
+    :param es: асинхронный клиент elasticsearch
+    :param table: название таблицы
+    """
+    logging.info(f'Query {table} started')
+    table_state, cursor, watermark = resume_point(state=state, table=table, state_keys=tables[table].state_keys)
+    progress = Progress(watermark=watermark or table_state)
+
+    queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    data = extract_data(pool=pool, table=table, table_state=table_state, cursor=cursor,
+                        rejected=rejected_ids(state=state, table=table))
+    producer = asyncio.create_task(produce(data=transform_data(data=data, table=table, progress=progress),
+                                           queue=queue))
+    try:
+        with CYCLE_SECONDS.time(table=table):
+            await load_data(es=es, data=consume(queue=queue), table=table, progress=progress)
+    finally:
+        producer.cancel()
+        with suppress(asyncio.CancelledError):
+            await producer
+    report_lag(state=state, table=table)
+
+
+async def schedule_table(*, pool: AsyncConnectionPool, es: AsyncElasticsearch, table: str) -> None:
+    """
+    Функция бесконечного запуска таблицы не чаще, чем раз в AWAIT_TIME секунд после завершения.
+    Как и в TableScheduler, ошибка таблицы только записывается в журнал и не останавливает остальные таблицы
+    """
+    while True:
+        try:
+            await run_table(pool=pool, es=es, table=table)
+        except Exception as e:
+            logging.error(f'Table {table} failed: {e!r}')
+        logging.info(f'Table {table} wait time {AWAIT_TIME}')
+        await asyncio.sleep(AWAIT_TIME)
+
+
+async def run() -> None:
+    """
+    Функция запуска конвейеров всех таблиц в одном цикле событий
+    """
+    pool = AsyncConnectionPool(make_conninfo(**DSL), min_size=PG_POOL['minconn'], max_size=PG_POOL['maxconn'],
+                               configure=configure_connection, open=False)
+    es = AsyncElasticsearch(ES_CONFIG['hosts'], maxsize=ES_CONFIG['maxsize'], retry_on_timeout=True,
+                            serializer=FastJSONSerializer(), connection_class=InstrumentedAIOHttpConnection)
+    try:
+        async with pool:
+            await check_indexes(es=es)
+            await asyncio.gather(*(schedule_table(pool=pool, es=es, table=table) for table in tables))
+    finally:
+        await es.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Асинхронный ETL процесс переноса данных из postgresql в '
+                                                 'elasticsearch')
+    parser.add_argument('--shard', default=SHARD['spec'], metavar='INDEX/COUNT',
+                        help='загружать только записи шарда, у каждого шарда свои файлы состояния')
+    args = parser.parse_args()
+
+    config.fileConfig(LOGGER_CONF_PATH)
+    shard = Shard.parse(spec=args.shard, lock_namespace=SHARD['lock_namespace'])
+    state = State(storage=JsonFileStorage(file_path=shard.file_path(path=STATE_FILE_PATH)))
+    digest_store = DigestStore(file_path=shard.file_path(path=DIGEST_DB_PATH))
+    try:
+        with shard:
+            if METRICS['port']:
+                start_metrics_server(host=METRICS['host'], port=METRICS['port'] + shard.index)
+            asyncio.run(run())
+    finally:
+        digest_store.close()
@@ -0,0 +1,478 @@
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import resource
+import tempfile
+import threading
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Callable, Iterable
+
+from psycopg2.extras import DictCursor
+
+import loader
+from connections import close_connections, get_es_client, get_pg_pool
+from data_workers import PostgresLoader
+from digests import DigestStore
+from etc.config import BENCHMARK, DSL, ES_CONFIG
+from progress import Progress
+from state import JsonFileStorage, State
+
+logger = logging.getLogger('benchmark')
+
+ROLES = ('actor', 'actor', 'actor', 'director', 'writer')
+COPY_CHUNK = 100000
+
+# метрика: 1, если больше - лучше, -1, если меньше - лучше
+METRICS = {
+    'pipeline_rows_s': 1,
+    'extract_rows_s': 1,
+    'transform_rows_s': 1,
+    'load_rows_s': 1,
+    'pg_round_trips': -1,
+    'bulk_requests': -1
+}
+
+
+class Counters:
+    """
+    Класс потокобезопасных счетчиков обращений к postgresql и elasticsearch
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values: dict[str, int] = {}
+
+    def incr(self, *, key: str, value: int = 1) -> None:
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def get(self, *, key: str) -> int:
+        with self.lock:
+            return self.values.get(key, 0)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.values.clear()
+
+
+counters = Counters()
+
+
+class CountingCursor(DictCursor):
+    """
+    Курсор, считающий обращения к серверу postgresql: выполнение запроса, COPY и каждую выборку серверного курсора
+    """
+
+    def execute(self, query, vars=None):
+        counters.incr(key='pg_round_trips')
+        return super().execute(query, vars)
+
+    def fetchmany(self, size=None):
+        if self.name:
+            counters.incr(key='pg_round_trips')
+        return super().fetchmany(size)
+
+    def copy_expert(self, sql, file, size=8192):
+        counters.incr(key='pg_round_trips')
+        return super().copy_expert(sql, file, size)
+
+
+class FakeElasticsearchHandler(BaseHTTPRequestHandler):
+    """
+    Обработчик http запросов, отвечающий как elasticsearch на запросы ETL: проверка и создание индексов и bulk.
+    Документы не сохраняются, поэтому измеряется только стоимость ETL и передачи данных
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self._reply(body=None)
+
+    def do_GET(self):
+        self._reply(body={})
+
+    def do_PUT(self):
+        self._read()
+        self._reply(body={'acknowledged': True})
+
+    def do_POST(self):
+        body = self._read()
+        if not self.path.split('?')[0].endswith('/_bulk'):
+            return self._reply(body={})
+        items, source = [], False
+        for line in body.splitlines():
+            if source or not line:
+                source = False
+                continue
+            op, meta = next(iter(json.loads(line).items()))
+            source = op != 'delete'
+            items.append({op: {'_index': meta.get('_index'), '_id': meta.get('_id'), 'status': 200}})
+        self._reply(body={'took': 1, 'errors': False, 'items': items})
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _reply(self, *, body) -> None:
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+
+def start_fake_elasticsearch() -> ThreadingHTTPServer:
+    """
+    Функция запуска фиктивного elasticsearch в потоке текущего процесса
+
+    :return: http сервер на свободном порту
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeElasticsearchHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-es', daemon=True).start()
+    logger.info(f'Fake elasticsearch listening on 127.0.0.1:{server.server_port}')
+    return server
+
+
+def count_bulk_requests() -> None:
+    """
+    Функция подсчета bulk запросов и документов в них на уровне транспорта общего клиента elasticsearch
+    """
+    transport = get_es_client().transport
+    perform_request = transport.perform_request
+
+    def counted(method, url, *args, **kwargs):
+        if url.endswith('/_bulk'):
+            body = kwargs.get('body') or b''
+            counters.incr(key='bulk_requests')
+            counters.incr(key='bulk_docs', value=body.count(b'\n' if isinstance(body, bytes) else '\n') // 2)
+        return perform_request(method, url, *args, **kwargs)
+
+    transport.perform_request = counted
+
+
+def generate(*, films: int, persons: int, genres: int, persons_per_film: int, seed: int) -> None:
+    """
+    Функция генерации синтетического набора фильмов в базе бенчмарка.
+    Данные зависят только от параметров и seed, поэтому результаты запусков сравнимы между собой
+
+    :param films: количество фильмов
+    :param persons: количество персон
+    :param genres: количество жанров
+    :param persons_per_film: количество персон у фильма
+    :param seed: начальное значение генератора случайных чисел
+    """
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+    def new_id() -> str:
+        return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+    def modified() -> str:
+        return (start + timedelta(seconds=rng.randrange(365 * 24 * 3600))).isoformat()
+
+    genre_ids = [new_id() for _ in range(genres)]
+    person_ids = [new_id() for _ in range(persons)]
+    film_ids = [new_id() for _ in range(films)]
+    data = (
+        ('genre', ('id', 'name', 'description', 'modified'),
+         ((g, f'Genre {n}', f'Genre {n} description', modified()) for n, g in enumerate(genre_ids))),
+        ('person', ('id', 'full_name', 'modified'),
+         ((p, f'Person {n}', modified()) for n, p in enumerate(person_ids))),
+        ('film_work', ('id', 'title', 'description', 'rating', 'creation_date', 'modified'),
+         ((f, f'Film {n}', f'Film {n} description', round(rng.uniform(0, 10), 1),
+           date(1950, 1, 1) + timedelta(days=rng.randrange(70 * 365)), modified())
+          for n, f in enumerate(film_ids))),
+        ('person_film_work', ('id', 'film_work_id', 'person_id', 'role'),
+         ((new_id(), f, p, rng.choice(ROLES))
+          for f in film_ids for p in rng.sample(person_ids, min(persons_per_film, persons)))),
+        ('genre_film_work', ('id', 'film_work_id', 'genre_id'),
+         ((new_id(), f, g) for f in film_ids for g in rng.sample(genre_ids, min(rng.randint(1, 3), genres))))
+    )
+    with open('etc/bench_schema.sql') as schema, open('etc/indexes.sql') as indexes:
+        schema_sql, indexes_sql = schema.read(), indexes.read()
+
+    with PostgresLoader() as pg:
+        pg.cursor.execute(schema_sql)
+        pg.cursor.execute('TRUNCATE film_work, person, genre, person_film_work, genre_film_work;')
+        for table, columns, rows in data:
+            copied = copy_rows(cursor=pg.cursor, table=table, columns=columns, rows=rows)
+            logger.info(f'Generated {table}: {copied}')
+        pg.cursor.execute(indexes_sql)
+        pg.cursor.execute('ANALYZE;')
+
+
+def copy_rows(*, cursor, table: str, columns: tuple, rows: Iterable[tuple]) -> int:
+    """
+    Функция загрузки строк в таблицу через COPY частями по COPY_CHUNK строк
+
+    :param cursor: курсор postgresql
+    :param table: название таблицы
+    :param columns: колонки таблицы в порядке значений строки
+    :param rows: строки без табуляций и переводов строк в значениях
+    :return: количество загруженных строк
+    """
+    copied, buffer = 0, io.StringIO()
+    for n, row in enumerate(rows, start=1):
+        buffer.write('\t'.join('\\N' if value is None else str(value) for value in row) + '\n')
+        if n % COPY_CHUNK == 0:
+            buffer.seek(0)
+            cursor.copy_from(buffer, table, columns=columns)
+            buffer = io.StringIO()
+        copied = n
+    buffer.seek(0)
+    cursor.copy_from(buffer, table, columns=columns)
+    return copied
+
+
+def measure_pipeline(*, table: str) -> dict:
+    """
+    Функция замера полной загрузки таблицы через loader.main
+
+    :param table: название таблицы
+    :return: скорость, количество обращений к postgresql и bulk запросов
+    """
+    counters.reset()
+    started = perf_counter()
+    loader.main(table=table, table_state=dict.fromkeys(loader.tables[table].state_keys))
+    elapsed = perf_counter() - started
+    rows = counters.get(key='bulk_docs')
+    return {
+        'rows': rows,
+        'pipeline_rows_s': rate(rows=rows, elapsed=elapsed),
+        'pg_round_trips': counters.get(key='pg_round_trips'),
+        'bulk_requests': counters.get(key='bulk_requests')
+    }
+
+
+def measure_stages(*, table: str) -> dict:
+    """
+    Функция замера этапов загрузки таблицы по отдельности, каждый этап получает результат предыдущего целиком
+
+    :param table: название таблицы
+    :return: скорость каждого этапа
+    """
+    started = perf_counter()
+    rows = list(loader.extract_data(table=table, table_state=dict.fromkeys(loader.tables[table].state_keys)))
+    extracted = perf_counter()
+    progress = Progress()
+    actions = list(loader.transform_data(data=iter(rows), table=table, progress=progress))
+    transformed = perf_counter()
+    loader.load_data(data=iter(actions), table=table, progress=progress, skip_unchanged=False, save_state=False,
+                     checkpoint=False)
+    loaded = perf_counter()
+    return {
+        'extract_rows_s': rate(rows=len(rows), elapsed=extracted - started),
+        'transform_rows_s': rate(rows=len(rows), elapsed=transformed - extracted),
+        'load_rows_s': rate(rows=len(rows), elapsed=loaded - transformed)
+    }
+
+
+def rate(*, rows: int, elapsed: float) -> float:
+    return round(rows / elapsed, 1) if elapsed > 0 else 0.0
+
+
+def peak_rss_mb() -> float:
+    """
+    Функция получения пикового потребления памяти процессом (ru_maxrss в linux указывается в килобайтах)
+    """
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def current_rss_mb() -> float:
+    """
+    Функция получения текущего потребления памяти процессом из /proc/self/statm
+    """
+    with open('/proc/self/statm') as file:
+        pages = int(file.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+def sample_rss(*, job: Callable[[], dict], interval: float) -> tuple[dict, list[float]]:
+    """
+    Функция замера текущей памяти процесса с заданным интервалом во время выполнения job
+
+    :param job: замеряемая функция
+    :param interval: интервал замеров в секундах
+    :return: результат job и замеры памяти в мегабайтах
+    """
+    samples, done = [], threading.Event()
+
+    def sample() -> None:
+        while not done.wait(interval):
+            samples.append(current_rss_mb())
+
+    sampler = threading.Thread(target=sample, name='rss-sampler', daemon=True)
+    sampler.start()
+    try:
+        result = job()
+    finally:
+        done.set()
+        sampler.join()
+    return result, samples
+
+
+def rss_growth(*, samples: list[float]) -> dict:
+    """
+    Функция оценки роста памяти за загрузку: пик последней половины замеров сравнивается с пиком
+    первой половины без первой пятой части, в которой заполняются очереди, пул соединений и буферы
+
+    :param samples: замеры памяти в мегабайтах
+    :return: пики и относительный рост памяти
+    """
+    warm_up, half = len(samples) // 5, len(samples) // 2
+    if half - warm_up < 1:
+        return {'samples': len(samples), 'growth': None}
+    early, late = max(samples[warm_up:half]), max(samples[half:])
+    return {'samples': len(samples), 'early_mb': round(early, 1), 'late_mb': round(late, 1),
+            'growth': round((late - early) / early, 3)}
+
+
+def check_rss(*, tables: list[str], interval: float, max_growth: float) -> tuple[dict, list[str]]:
+    """
+    Функция проверки, что память не растет с количеством загруженных строк при полной загрузке таблиц.
+    Имеет смысл на больших наборах (миллионы фильмов), когда загрузка длится много интервалов замера
+
+    :param tables: названия таблиц
+    :param interval: интервал замеров в секундах
+    :param max_growth: допустимый относительный рост памяти
+    :return: результаты по таблицам и список таблиц с ростом памяти сверх допустимого
+    """
+    results, failures = {}, []
+    for table in tables:
+        result, samples = sample_rss(job=lambda: measure_pipeline(table=table), interval=interval)
+        results[table] = {**result, 'rss': rss_growth(samples=samples)}
+        growth = results[table]['rss']['growth']
+        if growth is None:
+            logger.warning(f'{table}: too few RSS samples, increase the data set or decrease --rss-interval')
+        elif growth > max_growth:
+            failures.append(f'{table}: RSS grew by {growth:+.1%}')
+    return {'tables': results, 'peak_rss_mb': peak_rss_mb()}, failures
+
+
+def run(*, tables: list[str]) -> dict:
+    """
+    Функция запуска бенчмарка.
+    Пиковая память фиксируется после полных загрузок, до замеров этапов, которые держат таблицу в памяти целиком
+
+    :param tables: названия таблиц
+    :return: результаты по таблицам и пиковая память
+    """
+    results = {table: measure_pipeline(table=table) for table in tables}
+    peak_rss = peak_rss_mb()
+    for table in tables:
+        results[table].update(measure_stages(table=table))
+    return {'tables': results, 'peak_rss_mb': peak_rss}
+
+
+def compare(*, result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Функция сравнения результатов с базовыми
+
+    :param result: результаты текущего запуска
+    :param baseline: сохраненные базовые результаты
+    :param tolerance: допустимое относительное ухудшение метрики
+    :return: список ухудшений сверх допустимого
+    """
+    if result['params'] != baseline.get('params'):
+        logger.warning(f'Baseline params {baseline.get("params")} differ from {result["params"]}')
+    old_tables = baseline.get('tables', {})
+    pairs = [(f'{table}.{metric}', direction, metrics.get(metric), old_tables.get(table, {}).get(metric))
+             for table, metrics in result['tables'].items() for metric, direction in METRICS.items()]
+    pairs.append(('peak_rss_mb', -1, result['peak_rss_mb'], baseline.get('peak_rss_mb')))
+
+    regressions = []
+    for name, direction, new, old in pairs:
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        logger.info(f'{name}: {old} -> {new} ({change:+.1%})')
+        if change * direction < -tolerance:
+            regressions.append(f'{name}: {old} -> {new} ({change:+.1%})')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Бенчмарк ETL на синтетических данных')
+    parser.add_argument('--generate', action='store_true',
+                        help='пересоздать синтетические данные в базе бенчмарка и завершиться без замера')
+    parser.add_argument('--films', type=int, default=10000)
+    parser.add_argument('--persons', type=int, default=20000)
+    parser.add_argument('--genres', type=int, default=30)
+    parser.add_argument('--persons-per-film', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--db-name', default=BENCHMARK['db_name'], help='база postgresql только для бенчмарка')
+    parser.add_argument('--es-host', help='настоящий elasticsearch вместо фиктивного в процессе')
+    parser.add_argument('--tables', nargs='+', choices=loader.tables.keys(), default=list(loader.tables))
+    parser.add_argument('--baseline', default=BENCHMARK['baseline_path'])
+    parser.add_argument('--save-baseline', action='store_true', help='сохранить результаты как базовые')
+    parser.add_argument('--tolerance', type=float, default=BENCHMARK['tolerance'])
+    parser.add_argument('--rss-check', action='store_true',
+                        help='только проверить, что память не растет за время полной загрузки, без базовых результатов')
+    parser.add_argument('--rss-interval', type=float, default=BENCHMARK['rss_interval'])
+    parser.add_argument('--rss-growth', type=float, default=BENCHMARK['rss_growth'],
+                        help='допустимый относительный рост памяти для --rss-check')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    logger.setLevel(logging.INFO)
+
+    DSL['dbname'] = args.db_name
+    fake_es = None
+    if args.es_host:
+        ES_CONFIG['hosts'] = [args.es_host]
+    else:
+        fake_es = start_fake_elasticsearch()
+        ES_CONFIG['hosts'] = [f'127.0.0.1:{fake_es.server_port}']
+    get_pg_pool(cursor_factory=CountingCursor)
+    count_bulk_requests()
+
+    params = {'films': args.films, 'persons': args.persons, 'genres': args.genres,
+              'persons_per_film': args.persons_per_film, 'seed': args.seed, 'fake_es': fake_es is not None}
+    with tempfile.TemporaryDirectory() as work_dir:
+        loader.state = State(storage=JsonFileStorage(file_path=f'{work_dir}/state.json'))
+        loader.digest_store = DigestStore(file_path=f'{work_dir}/digests.db')
+        try:
+            if args.generate:
+                generate(films=args.films, persons=args.persons, genres=args.genres,
+                         persons_per_film=args.persons_per_film, seed=args.seed)
+                raise SystemExit(0)
+            if args.rss_check:
+                result, failures = check_rss(tables=args.tables, interval=args.rss_interval,
+                                             max_growth=args.rss_growth)
+                logger.info(json.dumps({'params': params, **result}, indent=4))
+                if failures:
+                    logger.error('Memory growth: ' + '; '.join(failures))
+                raise SystemExit(1 if failures else 0)
+            result = {'params': params, **run(tables=args.tables)}
+        finally:
+            loader.digest_store.close()
+            close_connections()
+            if fake_es:
+                fake_es.shutdown()
+
+    logger.info(json.dumps(result, indent=4))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(result, file, indent=4)
+        logger.info(f'Baseline saved to {args.baseline}')
+    else:
+        try:
+            with open(args.baseline) as file:
+                regressions = compare(result=result, baseline=json.load(file), tolerance=args.tolerance)
+        except FileNotFoundError:
+            logger.warning(f'Baseline {args.baseline} not found, run with --save-baseline')
+            regressions = []
+        if regressions:
+            logger.error('Regressions: ' + '; '.join(regressions))
+            raise SystemExit(1)
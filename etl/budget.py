@@ -0,0 +1,100 @@
+import logging
+import threading
+from collections import defaultdict, deque
+
+
+class MemoryBudget:
+    """
+    Класс бюджета памяти конвейера: ограничивает количество и суммарный размер документов,
+    которые извлечены, но еще не подтверждены elasticsearch.
+    Резервирование блокирует поток извлечения и преобразования, пока загрузка не освободит место,
+    поэтому давление передается до выборки серверного курсора postgresql.
+    Документ резервируется всегда, если в бюджете нет ни одного документа, иначе большой документ
+    никогда бы не поместился, и если загрузка ждет документы (starving), иначе загрузка и извлечение ждали бы
+    друг друга, пока неполная пачка bulk запроса держит весь бюджет.
+    """
+
+    def __init__(self, *, max_rows: int, max_bytes: int):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+        self.sizes: dict[str, deque] = defaultdict(deque)
+        self.rows = 0
+        self.bytes = 0
+        self.waits = 0
+        self.starved = False
+        self.closed = False
+
+    def exhausted(self, *, size: int = 0) -> bool:
+        """
+        Метод проверки, заблокирует ли резервирование документа
+
+        :param size: размер документа в байтах
+        :return: True, если бюджет исчерпан
+        """
+        with self.condition:
+            return self._exhausted(size=size)
+
+    def reserve(self, *, doc_id: str, size: int) -> None:
+        """
+        Метод резервирования места под документ, ждет освобождения места при исчерпанном бюджете
+
+        :param doc_id: идентификатор документа
+        :param size: размер документа в байтах
+        """
+        with self.condition:
+            if self._exhausted(size=size):
+                self.waits += 1
+                self.condition.wait_for(lambda: not self._exhausted(size=size))
+            self.sizes[doc_id].append(size)
+            self.rows += 1
+            self.bytes += size
+
+    def release(self, *, doc_id: str) -> None:
+        """
+        Метод освобождения места документа после подтверждения, отказа или пропуска
+
+        :param doc_id: идентификатор документа
+        """
+        with self.condition:
+            if not (sizes := self.sizes.get(doc_id)):
+                return
+            size = sizes.popleft()
+            if not sizes:
+                del self.sizes[doc_id]
+            self.rows -= 1
+            self.bytes -= size
+            self.condition.notify_all()
+
+    def starving(self) -> None:
+        """
+        Метод сигнала о том, что загрузке нечего обрабатывать: документы резервируются сверх бюджета,
+        пока загрузка не получит следующую пачку
+        """
+        with self.condition:
+            if self.rows and not self.starved:
+                self.starved = True
+                self.condition.notify_all()
+
+    def fed(self) -> None:
+        """
+        Метод сигнала о том, что загрузка получила документы
+        """
+        with self.condition:
+            self.starved = False
+
+    def close(self) -> None:
+        """
+        Метод снятия ограничений, чтобы ожидающие потоки завершились при остановке загрузки
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.waits:
+            logging.info(f'Memory budget of {self.max_rows} rows and {self.max_bytes} bytes '
+                         f'paused extraction {self.waits} time(s)')
+
+    def _exhausted(self, *, size: int) -> bool:
+        if self.closed or self.starved or not self.rows:
+            return False
+        return self.rows + 1 > self.max_rows or self.bytes + size > self.max_bytes
@@ -0,0 +1,159 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from operator import methodcaller
+from time import monotonic, sleep
+from typing import Generator, Iterable, Optional
+
+from elasticsearch import Elasticsearch, TransportError, helpers
+
+from serializers import BulkPair, bulk_pair
+from utils import RETRIABLE_STATUSES, jitter
+
+
+class AdaptiveChunkSize:
+    """
+    Класс подбора количества документов в bulk запросе по задержке ответа и отказам 429
+    """
+
+    def __init__(self, *, initial: int, minimum: int, maximum: int, target_latency: float):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.lock = threading.Lock()
+
+    def observe(self, *, latency: float, rejected: bool) -> None:
+        """
+        Метод корректировки размера пачки по результату bulk запроса
+
+        :param latency: время выполнения запроса
+        :param rejected: были ли документы отклонены из-за переполнения очереди elasticsearch
+        """
+        with self.lock:
+            previous = size = self.size
+            if rejected:
+                size = size // 2
+            elif latency > self.target_latency:
+                size = int(size * 0.75)
+            elif latency < self.target_latency / 2:
+                size = int(size * 1.25) + 1
+            self.size = min(max(size, self.minimum), self.maximum)
+            changed = self.size != previous
+        if changed:
+            logging.debug(f'Bulk chunk size changed to {self.size}, latency {latency:.2f}s, rejected {rejected}')
+
+
+def adaptive_parallel_bulk(es: Elasticsearch, actions: Iterable, *, chunk_size: AdaptiveChunkSize,
+                           thread_count: int, max_chunk_bytes: int, max_retries: int = 3,
+                           initial_backoff: float = 1, raise_on_error: bool = True,
+                           index: Optional[str] = None, max_in_flight: Optional[int] = None) -> Generator:
+    """
+    Функция параллельной отправки bulk запросов пачками, ограниченными по количеству документов и размеру в байтах
+
+    :param es: клиент elasticsearch
+    :param actions: документы в формате bulk запроса или уже сериализованные пары строк NDJSON
+    :param chunk_size: адаптивный размер пачки
+    :param thread_count: количество потоков отправки
+    :param max_chunk_bytes: максимальный размер пачки в байтах
+    :param max_retries: количество повторов для документов, отклоненных с кодами 429, 502, 503 и 504
+    :param initial_backoff: начальное время ожидания перед повтором
+    :param raise_on_error: выбрасывать BulkIndexError при ошибках индексации
+    :param index: индекс для документов, в строках действий которых индекс не указан
+    :param max_in_flight: количество одновременно отправляемых и ожидающих отправки пачек,
+        по умолчанию вдвое больше потоков
+    :yield: ok, item: результат индексации документа, как в helpers.streaming_bulk
+    """
+    in_flight = deque()
+    max_in_flight = max_in_flight or thread_count * 2
+    with ThreadPoolExecutor(max_workers=thread_count, thread_name_prefix='bulk') as executor:
+        for chunk in _chunk_actions(actions=actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes):
+            if len(in_flight) >= max_in_flight:
+                yield from _chunk_results(results=in_flight.popleft().result(), raise_on_error=raise_on_error)
+            # завершенные пачки отдаются сразу, чтобы подтверждения не ждали заполнения окна отправки
+            while in_flight and in_flight[0].done():
+                yield from _chunk_results(results=in_flight.popleft().result(), raise_on_error=raise_on_error)
+            in_flight.append(executor.submit(_send_chunk, es=es, chunk=chunk, chunk_size=chunk_size,
+                                             max_retries=max_retries, initial_backoff=initial_backoff, index=index))
+        while in_flight:
+            yield from _chunk_results(results=in_flight.popleft().result(), raise_on_error=raise_on_error)
+
+
+def dead_letter(*, result: dict) -> bool:
+    """
+    Функция разбора документа, который elasticsearch не проиндексировал.
+    Документ, отклоненный с неповторяемой ошибкой (например, из-за несоответствия mapping), откладывается
+    в список отклоненных документов, который следующий запуск извлекает повторно, чтобы один документ
+    не останавливал загрузку таблицы.
+    Документ, отклоненный с кодом 429, 502, 503 или 504 после всех повторов, не откладывается и задерживает
+    состояние до следующего запуска
+
+    :param result: результат индексации документа
+    :return: True, если документ нужно отложить в список отклоненных
+    """
+    if result.get('status') in RETRIABLE_STATUSES:
+        logging.warning(f'Document {result.get("_id")} rejected by {result.get("_index")} with status '
+                        f'{result.get("status")}, it will be loaded on the next run')
+        return False
+    logging.error(f'Document {result.get("_id")} rejected by {result.get("_index")}, '
+                  f'deferred to the next run: {result.get("error")}')
+    return True
+
+
+def _chunk_actions(*, actions: Iterable, chunk_size: AdaptiveChunkSize,
+                   max_chunk_bytes: int) -> Generator[list[BulkPair], None, None]:
+    chunk, chunk_bytes = [], 0
+    for data in actions:
+        pair = data if isinstance(data, tuple) else bulk_pair(data)
+        pair_bytes = len(pair[0]) + len(pair[1] or b'')
+        if chunk and (len(chunk) >= chunk_size.size or chunk_bytes + pair_bytes > max_chunk_bytes):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(pair)
+        chunk_bytes += pair_bytes
+    if chunk:
+        yield chunk
+
+
+def _send_chunk(*, es: Elasticsearch, chunk: list[BulkPair], chunk_size: AdaptiveChunkSize, max_retries: int,
+                initial_backoff: float, index: Optional[str] = None) -> list[tuple[bool, dict]]:
+    results, pending = [], chunk
+    for attempt in range(max_retries + 1):
+        started = monotonic()
+        try:
+            body = b''.join(line for pair in pending for line in pair if line is not None)
+            response = es.bulk(body=body, index=index)
+        except TransportError as e:
+            if e.status_code not in RETRIABLE_STATUSES or attempt == max_retries:
+                raise
+            chunk_size.observe(latency=monotonic() - started, rejected=True)
+            sleep(jitter(initial_backoff * 2 ** attempt))
+            continue
+
+        rejected = []
+        for pair, (op_type, item) in zip(pending, map(methodcaller('popitem'), response['items'])):
+            status = item.get('status', 500)
+            if status in RETRIABLE_STATUSES and attempt < max_retries:
+                rejected.append(pair)
+            else:
+                results.append((200 <= status < 300, {op_type: item}))
+        chunk_size.observe(latency=monotonic() - started, rejected=bool(rejected))
+        if not rejected:
+            break
+        logging.warning(f'Bulk rejected {len(rejected)} document(s), retry {attempt + 1}')
+        pending = rejected
+        sleep(jitter(initial_backoff * 2 ** attempt))
+    return results
+
+
+def _chunk_results(*, results: list[tuple[bool, dict]], raise_on_error: bool) -> Generator:
+    # успешные документы пачки отдаются до исключения, чтобы их подтверждения не терялись
+    errors = []
+    for ok, item in results:
+        if ok or not raise_on_error:
+            yield ok, item
+        else:
+            errors.append(item)
+    if errors:
+        raise helpers.BulkIndexError(f'{len(errors)} document(s) failed to index.', errors)
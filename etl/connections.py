@@ -0,0 +1,99 @@
+import logging
+import threading
+from typing import Optional
+
+from elasticsearch import Elasticsearch, Urllib3HttpConnection
+from psycopg2.extras import DictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from etc.config import DSL, ES_CONFIG, PG_POOL
+from metrics import BULK_SECONDS
+from serializers import FastJSONSerializer
+
+_lock = threading.Lock()
+_pg_pool: Optional['BlockingConnectionPool'] = None
+_es_client: Optional[Elasticsearch] = None
+
+
+class InstrumentedConnection(Urllib3HttpConnection):
+    """
+    Соединение elasticsearch, замеряющее время bulk запросов
+    """
+
+    def perform_request(self, method, url, *args, **kwargs):
+        if not url.endswith('/_bulk'):
+            return super().perform_request(method, url, *args, **kwargs)
+        with BULK_SECONDS.time():
+            return super().perform_request(method, url, *args, **kwargs)
+
+
+class BlockingConnectionPool(ThreadedConnectionPool):
+    """
+    Пул соединений postgresql, который при исчерпании ждет возврата соединения, а не выбрасывает PoolError:
+    потоков загрузки, этапов конвейера и разовых запросов может быть больше, чем соединений в пуле
+    """
+
+    def __init__(self, minconn: int, maxconn: int, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None):
+        if not self.slots.acquire(blocking=False):
+            logging.debug('Postgres connection pool is exhausted, waiting for a returned connection')
+            self.slots.acquire()
+        try:
+            return super().getconn(key)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self.slots.release()
+
+
+def get_pg_pool(*, cursor_factory: type = DictCursor) -> BlockingConnectionPool:
+    """
+    Функция получения общего для процесса пула соединений postgresql
+
+    :param cursor_factory: класс курсоров соединений, учитывается только при создании пула
+    :return: пул соединений, создается при первом обращении
+    """
+    global _pg_pool
+    with _lock:
+        if _pg_pool is None or _pg_pool.closed:
+            logging.debug('Creating postgres connection pool')
+            _pg_pool = BlockingConnectionPool(PG_POOL['minconn'], PG_POOL['maxconn'], **DSL,
+                                              cursor_factory=cursor_factory)
+    return _pg_pool
+
+
+def get_es_client() -> Elasticsearch:
+    """
+    Функция получения общего для процесса клиента elasticsearch с keep-alive соединениями
+
+    :return: клиент elasticsearch, создается при первом обращении
+    """
+    global _es_client
+    with _lock:
+        if _es_client is None:
+            logging.debug('Creating elasticsearch client')
+            _es_client = Elasticsearch(ES_CONFIG['hosts'], maxsize=ES_CONFIG['maxsize'], retry_on_timeout=True,
+                                       serializer=FastJSONSerializer(), connection_class=InstrumentedConnection)
+    return _es_client
+
+
+def close_connections() -> None:
+    """
+    Функция закрытия пула postgresql и клиента elasticsearch при завершении процесса
+    """
+    global _pg_pool, _es_client
+    with _lock:
+        if _pg_pool is not None and not _pg_pool.closed:
+            _pg_pool.closeall()
+        if _es_client is not None:
+            _es_client.close()
+        _pg_pool, _es_client = None, None
+    logging.debug('Connections closed')
@@ -0,0 +1,192 @@
+import logging
+import re
+import threading
+from datetime import date, datetime
+from itertools import groupby
+from operator import itemgetter
+from queue import Empty, Full, Queue
+from typing import Generator, Optional
+
+from data_workers import PostgresLoader
+from etc.queries import QUERIES
+from shard import Shard
+
+# экранирование текстового формата COPY
+_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v', '\\': '\\'}
+_ESCAPE = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)')
+_DONE = object()
+
+
+def unescape(value: str) -> Optional[str]:
+    """
+    Функция декодирования поля текстового формата COPY
+
+    :param value: поле в текстовом формате
+    :return: значение поля, None для NULL
+    """
+    if value == '\\N':
+        return None
+    if '\\' not in value:
+        return value
+    return _ESCAPE.sub(_unescape_match, value)
+
+
+def _unescape_match(match: re.Match) -> str:
+    code = match.group(1)
+    if code[0] == 'x' and len(code) > 1:
+        return chr(int(code[1:], 16))
+    if code[0].isdigit():
+        return chr(int(code, 8))
+    return _ESCAPES.get(code, code)
+
+
+class _QueueWriter:
+    """
+    Файл для copy_expert, передающий строки COPY в ограниченную очередь пачками
+    """
+
+    def __init__(self, *, queue: Queue, stop: threading.Event, batch_size: int):
+        self.queue = queue
+        self.stop = stop
+        self.batch_size = batch_size
+        self.buffer = []
+
+    def write(self, data) -> None:
+        if self.stop.is_set():
+            return
+        self.buffer.append(data.decode() if isinstance(data, bytes) else data)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buffer:
+            put(queue=self.queue, item=''.join(self.buffer), stop=self.stop)
+            self.buffer = []
+
+
+def put(*, queue: Queue, item, stop: threading.Event) -> None:
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return
+        except Full:
+            continue
+
+
+class CopyExtractor:
+    """
+    Класс полного извлечения таблицы через COPY ... TO STDOUT вместо поиска изменений и запросов по спискам id.
+    Один запрос COPY на одном соединении отдает строки фильма (персоны) и его связей, упорядоченные по
+    идентификатору документа, они группируются потоково и собираются в строки того же вида, что результаты
+    QUERIES[table], поэтому дальше используются те же классы документов.
+    COPY читается в отдельном потоке через ограниченную очередь, поэтому память не зависит от размера таблицы.
+    Из-за сортировки прерванная полная загрузка продолжается новым COPY с идентификатора после последнего
+    подтвержденного документа
+    """
+
+    def __init__(self, *, pg: PostgresLoader, shard: Optional[Shard] = None, batch_size: int = 1000,
+                 queue_size: int = 8):
+        self.pg = pg
+        self.shard = shard or Shard()
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+
+    def rows(self, *, table: str, after: Optional[str] = None) -> Generator[tuple, None, None]:
+        """
+        Метод извлечения всех строк таблицы
+
+        :param table: название таблицы
+        :param after: идентификатор документа, после которого нужно продолжить извлечение
+        :yield: строка в виде результата QUERIES[table]
+        """
+        records = (tuple(unescape(value) for value in line.split('\t'))
+                   for line in self.lines(table=table, after=after))
+        if table == 'genre':
+            for genre_id, name, description, modified in records:
+                yield genre_id, name, description, datetime.fromisoformat(modified)
+            return
+
+        build = self._filmwork if table == 'filmwork' else self._person
+        for doc_id, group in groupby(records, key=itemgetter(0)):
+            group = list(group)
+            if group[0][1] != '0':
+                logging.warning(f'COPY of {table} returned links of missing {doc_id}, skipped')
+                continue
+            yield build(head=group[0], links=group[1:])
+
+    def lines(self, *, table: str, after: Optional[str] = None) -> Generator[str, None, None]:
+        """
+        Метод чтения строк COPY таблицы
+
+        :param table: название таблицы
+        :param after: идентификатор документа, после которого нужно продолжить чтение
+        :yield: строка текстового формата COPY без перевода строки
+        """
+        queue, stop = Queue(maxsize=self.queue_size), threading.Event()
+        query = self.pg.cursor.mogrify(QUERIES[f'{table}_copy'], {**self.shard.params, 'after': after})
+        worker = threading.Thread(target=self._copy, kwargs={'query': query, 'queue': queue, 'stop': stop},
+                                  name=f'copy-{table}', daemon=True)
+        worker.start()
+        tail = ''
+        try:
+            while True:
+                try:
+                    chunk = queue.get(timeout=0.1)
+                except Empty:
+                    if not worker.is_alive() and queue.empty():
+                        return
+                    continue
+                if chunk is _DONE:
+                    return
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                # разделитель строк только \n: остальные управляющие символы в данных COPY не экранирует
+                *lines, tail = (tail + chunk).split('\n')
+                yield from lines
+        finally:
+            if worker.is_alive():
+                stop.set()
+                self.pg.connection.cancel()
+            worker.join()
+
+    def _copy(self, *, query: bytes, queue: Queue, stop: threading.Event) -> None:
+        writer = _QueueWriter(queue=queue, stop=stop, batch_size=self.batch_size)
+        try:
+            self.pg.cursor.copy_expert(query, writer)
+            writer.flush()
+            put(queue=queue, item=_DONE, stop=stop)
+        except BaseException as e:
+            put(queue=queue, item=e, stop=stop)
+
+    @staticmethod
+    def _filmwork(*, head: tuple, links: list[tuple]) -> tuple:
+        film_id, _, title, description, rating, creation_date, modified = head
+        fields = {'actor': [], 'director': [], 'writer': [], 'genre': []}
+        person_time, genre_time = set(), set()
+        for _, kind, role, entry_id, name, _, entry_modified in links:
+            if kind == '1':
+                if role in fields:
+                    fields[role].append((name, entry_id))
+                person_time.add(datetime.fromisoformat(entry_modified))
+            else:
+                fields['genre'].append((name, entry_id))
+                genre_time.add(datetime.fromisoformat(entry_modified))
+        aggs = {field: dict(sorted(set(pairs))) or None for field, pairs in fields.items()}
+        return (film_id, title, description, float(rating) if rating is not None else None,
+                date.fromisoformat(creation_date) if creation_date is not None else None,
+                aggs['genre'], aggs['actor'], aggs['director'], aggs['writer'],
+                sorted(person_time) or [None], sorted(genre_time) or [None], datetime.fromisoformat(modified))
+
+    @staticmethod
+    def _person(*, head: tuple, links: list[tuple]) -> tuple:
+        person_id, _, full_name, _, modified = head
+        films = {'actor': set(), 'director': set(), 'writer': set()}
+        roles, filmwork_time = set(), set()
+        for _, _, role, film_id, film_modified in links:
+            roles.add(role)
+            if role in films:
+                films[role].add(film_id)
+            filmwork_time.add(datetime.fromisoformat(film_modified))
+        return (person_id, full_name, sorted(roles) or [None],
+                sorted(films['actor']) or None, sorted(films['director']) or None, sorted(films['writer']) or None,
+                datetime.fromisoformat(modified), sorted(filmwork_time) or [None])
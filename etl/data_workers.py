@@ -2,14 +2,16 @@ import json
 import logging
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Generator, Optional, Union
+from time import perf_counter
+from typing import ClassVar, Generator, Optional, Union
 
 import psycopg2
 from elasticsearch import Elasticsearch
-from psycopg2.extras import DictCursor
 
-from etc.config import DSL, ES_CONFIG
-from utils import latest_datetime_from_list, latest_datetime
+from connections import get_es_client, get_pg_pool
+from etc.config import ES_CONFIG
+from metrics import PG_FETCH_SECONDS
+from utils import doc_version, latest_datetime_from_list
 
 
 class PostgresLoader:
@@ -21,28 +23,47 @@ class PostgresLoader:
         self.fetch_size = fetch_size
 
     def __enter__(self):
-        logging.debug('Connecting to postgres')
-        self.connection = psycopg2.connect(**DSL, cursor_factory=DictCursor)
+        logging.debug('Borrowing postgres connection')
+        self.pool = get_pg_pool()
+        self.connection = self.pool.getconn()
         self.cursor = self.connection.cursor()
         logging.debug('Postgres connection complete')
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.connection.commit()
-        self.connection.close()
-        logging.debug('Postgres connection closed')
-
-    def batch_execute(self, *, query: str) -> Generator:
+        broken = self.connection.closed or isinstance(exc_val, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        if not broken:
+            try:
+                if exc_type is None:
+                    self.connection.commit()
+                else:
+                    self.connection.rollback()
+            except psycopg2.Error:
+                broken = True
+        self.pool.putconn(self.connection, close=broken)
+        logging.debug(f'Postgres connection {"closed" if broken else "returned to pool"}')
+
+    def batch_execute(self, *, query: str, params: Optional[dict] = None, name: Optional[str] = None) -> Generator:
         """
         Метод извлечения группы полей
 
         :param query: sql запрос
+        :param params: параметры sql запроса
+        :param name: имя серверного курсора, если не указано - используется клиентский курсор
         :yield: rows: группа полей, результат выполнения запроса
         """
-        self.cursor.execute(query)
-        while rows := self.cursor.fetchmany(size=self.fetch_size):
-            logging.info(f'Postgres executed: {len(rows)}')
-            yield rows
+        cursor = self.connection.cursor(name=name) if name else self.cursor
+        try:
+            started = perf_counter()
+            cursor.execute(query, params)
+            while rows := cursor.fetchmany(size=self.fetch_size):
+                PG_FETCH_SECONDS.observe(perf_counter() - started)
+                logging.debug(f'Postgres executed: {len(rows)}')
+                yield rows
+                started = perf_counter()
+        finally:
+            if name:
+                cursor.close()
 
 
 class ElasticsearchLoader:
@@ -50,24 +71,31 @@ class ElasticsearchLoader:
     Класс для конфигурирования и подключения к elasticsearch
     """
 
+    checked_indexes: set = set()
+
     def __init__(self):
         self.index_name = ES_CONFIG['index_names']
 
     def __enter__(self) -> Elasticsearch:
         logging.debug('Connecting to elasticsearch')
-        self.es = Elasticsearch(ES_CONFIG['hosts'])
-        for index in self.index_name.values():
+        self.es = get_es_client()
+        for key, index in self.index_name.items():
+            if index in self.checked_indexes:
+                continue
+            mapping = self.load_settings(ES_CONFIG['movies_settings'][key])
             if not self.es.indices.exists(index):
                 logging.debug(f'Elasticsearch index {index} does not exists')
-                mapping = self.load_settings(ES_CONFIG['movies_settings'][index])
                 self.es.indices.create(index=index, body=mapping)
                 logging.debug(f'Elasticsearch index {index} created')
+            else:
+                # новые поля настроек добавляются в существующий индекс, существующие поля не меняются
+                self.es.indices.put_mapping(index=index, body=mapping['mappings'])
+            self.checked_indexes.add(index)
         logging.debug(f'Elasticsearch connection complete')
         return self.es
 
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
-        self.es.close()
-        logging.debug('Elasticsearch connection closed')
+        logging.debug('Elasticsearch connection released')
 
     @staticmethod
     def load_settings(file_path: str) -> dict:
@@ -81,7 +109,7 @@ class ElasticsearchLoader:
             return json.load(file)
 
 
-@dataclass
+@dataclass(slots=True)
 class Filmwork:
     id: str
     title: str
@@ -99,9 +127,7 @@ class Filmwork:
     actors_names: Optional[list] = None
     writers_names: Optional[list] = None
     genres_names: Optional[list] = None
-    filmwork_latest_modified = None
-    genre_latest_modified = None
-    person_latest_modified = None
+    state_keys: ClassVar[tuple] = ('filmwork_date', 'person_date', 'genre_date')
 
     def __post_init__(self):
         self.actors_names, self.actors = self.format_obj_agg(data=self.actors)
@@ -109,38 +135,43 @@ class Filmwork:
         self.directors_names, self.director = self.format_obj_agg(data=self.director)
         self.genres_names, self.genre = self.format_obj_agg(data=self.genre)
 
-        self.set_latest(fw_time=self.filmwork_time, person_time=self.person_time, genre_time=self.genre_time)
-
-    @classmethod
-    def set_latest(cls, *, fw_time, person_time, genre_time):
-        cls.filmwork_latest_modified = latest_datetime(current=cls.filmwork_latest_modified, obj_time=fw_time)
-        cls.person_latest_modified = latest_datetime_from_list(current=cls.person_latest_modified, obj_time=person_time)
-        cls.genre_latest_modified = latest_datetime_from_list(current=cls.genre_latest_modified, obj_time=genre_time)
-
     def get_bulk_format(self) -> dict:
         """
         Метод возврата словаря для bulk запроса elasticsearch
 
         :return: словарь для bulk запросов elasticsearch
         """
-        source = self.__dict__.copy()
-        del source['person_time'], source['genre_time'], source['filmwork_time']
-        if all((source.get('filmwork_latest_modified'),
-                source.get('genre_latest_modified'),
-                source.get('person_latest_modified'))):
-            del source['filmwork_latest_modified'], source['genre_latest_modified'], source['person_latest_modified']
         return {
             '_index': ES_CONFIG['index_names']['movies'],
             '_id': self.id,
-            '_source': {**source}
+            '_source': {
+                'id': self.id,
+                'title': self.title,
+                'description': self.description,
+                'imdb_rating': self.imdb_rating,
+                'creation_date': self.creation_date,
+                'genre': self.genre,
+                'actors': self.actors,
+                'director': self.director,
+                'writers': self.writers,
+                'directors_names': self.directors_names,
+                'actors_names': self.actors_names,
+                'writers_names': self.writers_names,
+                'genres_names': self.genres_names,
+                'modified': doc_version(self.get_db_state())
+            }
         }
 
-    @classmethod
-    def get_db_state(cls):
+    def get_db_state(self) -> dict:
+        """
+        Метод возврата времени последнего изменения записей, из которых собран документ
+
+        :return: словарь ключ состояния: время
+        """
         return {
-            'filmwork_date': cls.filmwork_latest_modified,
-            'person_date': cls.person_latest_modified,
-            'genre_date': cls.genre_latest_modified
+            'filmwork_date': self.filmwork_time,
+            'person_date': latest_datetime_from_list(obj_time=self.person_time),
+            'genre_date': latest_datetime_from_list(obj_time=self.genre_time)
         }
 
     @staticmethod
@@ -157,32 +188,17 @@ class Filmwork:
             return None, None
 
 
-@dataclass
+@dataclass(slots=True)
 class Person:
     id: str
     name: str
     roles: list | None
-    films_as_actor: str | None
-    films_as_director: str | None
-    films_as_writer: str | None
+    films_as_actor: list | None
+    films_as_director: list | None
+    films_as_writer: list | None
     person_time: datetime
     filmwork_time: list
-    filmwork_latest_modified = None
-    person_latest_modified = None
-
-    def __post_init__(self):
-        self.set_latest(fw_time=self.filmwork_time, person_time=self.person_time)
-        self.films_as_actor = self.films_as_actor.replace('{', '').replace('}', '').split(
-            ',') if self.films_as_actor else None
-        self.films_as_director = self.films_as_director.replace('{', '').replace('}', '').split(
-            ',') if self.films_as_director else None
-        self.films_as_writer = self.films_as_writer.replace('{', '').replace('}', '').split(
-            ',') if self.films_as_writer else None
-
-    @classmethod
-    def set_latest(cls, *, fw_time, person_time):
-        cls.filmwork_latest_modified = latest_datetime_from_list(current=cls.filmwork_latest_modified, obj_time=fw_time)
-        cls.person_latest_modified = latest_datetime(current=cls.person_latest_modified, obj_time=person_time)
+    state_keys: ClassVar[tuple] = ('filmwork_date', 'person_date')
 
     def get_bulk_format(self) -> dict:
         """
@@ -190,38 +206,39 @@ class Person:
 
         :return: словарь для bulk запросов elasticsearch
         """
-        source = self.__dict__.copy()
-        del source['person_time'], source['filmwork_time']
-        if all((source.get('filmwork_latest_modified'), source.get('person_latest_modified'))):
-            del source['filmwork_latest_modified'], source['person_latest_modified']
         return {
             '_index': ES_CONFIG['index_names']['persons'],
             '_id': self.id,
-            '_source': {**source}
+            '_source': {
+                'id': self.id,
+                'name': self.name,
+                'roles': self.roles,
+                'films_as_actor': self.films_as_actor,
+                'films_as_director': self.films_as_director,
+                'films_as_writer': self.films_as_writer,
+                'modified': doc_version(self.get_db_state())
+            }
         }
 
-    @classmethod
-    def get_db_state(cls):
+    def get_db_state(self) -> dict:
+        """
+        Метод возврата времени последнего изменения записей, из которых собран документ
+
+        :return: словарь ключ состояния: время
+        """
         return {
-            'filmwork_date': cls.filmwork_latest_modified,
-            'person_date': cls.person_latest_modified
+            'filmwork_date': latest_datetime_from_list(obj_time=self.filmwork_time),
+            'person_date': self.person_time
         }
 
 
-@dataclass
+@dataclass(slots=True)
 class Genre:
     id: str
     name: str
     description: str
     genre_time: datetime
-    genre_latest_modified = None
-
-    def __post_init__(self):
-        self.set_latest(genre_time=self.genre_time)
-
-    @classmethod
-    def set_latest(cls, *, genre_time):
-        cls.genre_latest_modified = latest_datetime(current=cls.genre_latest_modified, obj_time=genre_time)
+    state_keys: ClassVar[tuple] = ('genre_date',)
 
     def get_bulk_format(self) -> dict:
         """
@@ -229,16 +246,21 @@ class Genre:
 
         :return: словарь для bulk запросов elasticsearch
         """
-        source = self.__dict__.copy()
-        del source['genre_time']
-        if source.get('genre_latest_modified'):
-            del source['genre_latest_modified']
         return {
             '_index': ES_CONFIG['index_names']['genres'],
             '_id': self.id,
-            '_source': {**source}
+            '_source': {
+                'id': self.id,
+                'name': self.name,
+                'description': self.description,
+                'modified': doc_version(self.get_db_state())
+            }
         }
 
-    @classmethod
-    def get_db_state(cls):
-        return {'genre_date': cls.genre_latest_modified}
+    def get_db_state(self) -> dict:
+        """
+        Метод возврата времени последнего изменения записей, из которых собран документ
+
+        :return: словарь ключ состояния: время
+        """
+        return {'genre_date': self.genre_time}
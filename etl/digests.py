@@ -0,0 +1,211 @@
+import json
+import logging
+import sqlite3
+import threading
+from hashlib import blake2b
+from typing import AsyncGenerator, AsyncIterable, Callable, Generator, Iterable, Optional
+
+# поле версии документа: меняется при любом изменении его записей, даже если тело документа осталось прежним,
+# поэтому в хеш не входит, иначе неизменившиеся документы не пропускались бы
+VERSION_FIELD = 'modified'
+
+
+class DigestStore:
+    """
+    Класс хранения хешей документов, загруженных в elasticsearch, в файле sqlite
+    """
+
+    def __init__(self, *, file_path: str):
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS digests (
+                    doc_index TEXT NOT NULL,
+                    doc_id TEXT NOT NULL,
+                    digest BLOB NOT NULL,
+                    version TEXT,
+                    PRIMARY KEY (doc_index, doc_id)
+                ) WITHOUT ROWID
+            ''')
+            columns = {row[1] for row in self.connection.execute('PRAGMA table_info(digests)')}
+            if 'version' not in columns:
+                self.connection.execute('ALTER TABLE digests ADD COLUMN version TEXT')
+
+    @staticmethod
+    def digest(source: dict) -> bytes:
+        """
+        Метод вычисления хеша документа без поля версии
+
+        :param source: тело документа
+        :return: хеш документа
+        """
+        source = {key: value for key, value in source.items() if key != VERSION_FIELD}
+        dump = json.dumps(source, sort_keys=True, default=str, separators=(',', ':'), ensure_ascii=False)
+        return blake2b(dump.encode(), digest_size=16).digest()
+
+    def retrieve(self, *, index: str, ids: list[str]) -> dict:
+        """
+        Метод получения сохраненных хешей и версий документов
+
+        :param index: индекс документов
+        :param ids: идентификаторы документов
+        :return: словарь идентификатор: (хеш, версия)
+        """
+        placeholders = ','.join('?' * len(ids))
+        with self.lock:
+            rows = self.connection.execute(
+                f'SELECT doc_id, digest, version FROM digests WHERE doc_index = ? AND doc_id IN ({placeholders})',
+                [index, *ids]
+            ).fetchall()
+        return {doc_id: (digest, version) for doc_id, digest, version in rows}
+
+    def save(self, *, index: str, digests: Iterable[tuple[str, bytes, Optional[str]]]) -> None:
+        """
+        Метод сохранения хешей документов
+
+        :param index: индекс документов
+        :param digests: тройки идентификатор, хеш, версия
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO digests (doc_index, doc_id, digest, version) VALUES (?, ?, ?, ?)',
+                ((index, doc_id, digest, version) for doc_id, digest, version in digests)
+            )
+
+    def delete(self, *, index: str, ids: list[str]) -> None:
+        """
+        Метод удаления хешей документов, чтобы они были загружены повторно
+
+        :param index: индекс документов
+        :param ids: идентификаторы документов
+        """
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM digests WHERE doc_index = ? AND doc_id = ?',
+                                        ((index, doc_id) for doc_id in ids))
+
+    def clear(self, *, index: str) -> None:
+        """
+        Метод удаления хешей индекса, содержимое которого загружено в обход ETL
+
+        :param index: индекс документов
+        """
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM digests WHERE doc_index = ?', [index])
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+class DigestFilter:
+    """
+    Класс отбрасывания документов, не изменившихся с последней загрузки.
+    Если изменилась только версия документа, вместо него отправляется частичное обновление поля версии.
+    Хеш документа сохраняется только после подтверждения загрузки от elasticsearch.
+    """
+
+    def __init__(self, *, store: DigestStore, index: str, skip_unchanged: bool = True, save: bool = True,
+                 batch_size: int = 500, on_skip: Optional[Callable[..., None]] = None):
+        self.store = store
+        self.on_skip = on_skip
+        self.index = index
+        self.skip_unchanged = skip_unchanged
+        # хеши описывают содержимое индекса таблицы, загрузка в другой индекс (перестройка) их не сохраняет
+        self.save = save
+        self.batch_size = batch_size
+        self.pending: dict[str, tuple[bytes, Optional[str]]] = {}
+        self.acked: list[tuple[str, bytes, Optional[str]]] = []
+        self.hits = 0
+        self.misses = 0
+
+    def filter(self, actions: Iterable[dict]) -> Generator:
+        """
+        Метод фильтрации документов bulk запроса
+
+        :param actions: документы в формате bulk запроса
+        :yield: action: измененный документ
+        """
+        batch = []
+        for action in actions:
+            batch.append(action)
+            if len(batch) >= self.batch_size:
+                yield from self._filter_batch(batch)
+                batch = []
+        yield from self._filter_batch(batch)
+
+    async def filter_async(self, actions: AsyncIterable[dict]) -> AsyncGenerator:
+        """
+        Асинхронный вариант filter, обращения к локальному sqlite выполняются синхронно пачками
+
+        :param actions: документы в формате bulk запроса
+        :yield: action: измененный документ
+        """
+        batch = []
+        async for action in actions:
+            batch.append(action)
+            if len(batch) >= self.batch_size:
+                for changed in self._filter_batch(batch):
+                    yield changed
+                batch = []
+        for changed in self._filter_batch(batch):
+            yield changed
+
+    def ack(self, *, doc_id: str) -> None:
+        """
+        Метод подтверждения загрузки документа
+
+        :param doc_id: идентификатор документа
+        """
+        if (pending := self.pending.pop(doc_id, None)) is not None:
+            self.acked.append((doc_id, *pending))
+        if len(self.acked) >= self.batch_size:
+            self.flush()
+
+    def reject(self, *, doc_id: str) -> None:
+        """
+        Метод учета документа, отклоненного elasticsearch: сохраненный хеш удаляется,
+        чтобы повторная загрузка документа не была пропущена как неизменившаяся
+
+        :param doc_id: идентификатор документа
+        """
+        self.pending.pop(doc_id, None)
+        self.store.delete(index=self.index, ids=[doc_id])
+
+    def flush(self) -> None:
+        if self.acked:
+            self.store.save(index=self.index, digests=self.acked)
+            self.acked = []
+
+    def _filter_batch(self, batch: list[dict]) -> Generator:
+        if not batch:
+            return
+        digests = [self.store.digest(action['_source']) for action in batch]
+        stored = self.store.retrieve(index=self.index, ids=[action['_id'] for action in batch]) \
+            if self.skip_unchanged else {}
+        for action, digest in zip(batch, digests):
+            version = action['_source'].get(VERSION_FIELD)
+            stored_digest, stored_version = stored.get(action['_id'], (None, None))
+            if stored_digest == digest and stored_version == version:
+                self.hits += 1
+                if self.on_skip:
+                    self.on_skip(doc_id=action['_id'])
+                continue
+            self.misses += 1
+            if self.save:
+                self.pending[action['_id']] = (digest, version)
+            yield action if stored_digest != digest else version_update(action=action, version=version)
+        logging.debug(f'Digest store {self.index}: {self.hits} hits, {self.misses} misses')
+
+
+def version_update(*, action: dict, version: Optional[str]) -> dict:
+    """
+    Функция частичного обновления поля версии документа, тело которого не изменилось
+
+    :param action: документ в формате bulk запроса
+    :param version: новая версия документа
+    :return: действие update в формате bulk запроса
+    """
+    return {'_op_type': 'update', '_index': action['_index'], '_id': action['_id'], 'doc': {VERSION_FIELD: version}}
@@ -0,0 +1,147 @@
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from typing import Optional
+
+from data_workers import PostgresLoader
+from etc.queries import QUERIES
+from utils import latest_datetime
+
+# роль персоны в фильме: поле строки фильма
+ROLE_FIELDS = {'actor': 'actors', 'director': 'director', 'writer': 'writers'}
+
+
+class DimensionCache:
+    """
+    Класс кеша справочника (персон или жанров) в памяти процесса: идентификатор - имя и время изменения.
+    Вытесняются давно не использованные записи (LRU), отсутствующие записи запрашиваются одним запросом на пачку.
+    Кеш обновляется инкрементально: перечитываются только записи, измененные после времени последнего обновления
+    """
+
+    def __init__(self, *, name: str, state_key: str, maxsize: int):
+        self.name = name
+        self.state_key = state_key
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, tuple[str, datetime]] = OrderedDict()
+        self.watermark: Optional[datetime] = None
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, *, pg: PostgresLoader, ids: set) -> dict:
+        """
+        Метод получения записей справочника
+
+        :param pg: соединение postgresql
+        :param ids: идентификаторы записей
+        :return: словарь идентификатор: (имя, время изменения)
+        """
+        found, missing = {}, []
+        with self.lock:
+            for entry_id in ids:
+                if (entry := self.entries.get(entry_id)) is not None:
+                    self.entries.move_to_end(entry_id)
+                    found[entry_id] = entry
+                else:
+                    missing.append(entry_id)
+            self.hits += len(found)
+            self.misses += len(missing)
+        if missing:
+            rows = [row for data in pg.batch_execute(query=QUERIES[f'{self.name}_dimension'], params={'ids': missing})
+                    for row in data]
+            fetched = {row[0]: (row[1], row[2]) for row in rows}
+            self._put(fetched)
+            found.update(fetched)
+        return found
+
+    def refresh(self, *, pg: PostgresLoader) -> None:
+        """
+        Метод обновления записей кеша, измененных после последнего обновления.
+        Пока кеш пуст, обновлять нечего, запоминается только время последнего изменения справочника
+
+        :param pg: соединение postgresql
+        """
+        with self.lock:
+            empty, watermark = not self.entries, self.watermark
+        if empty or watermark is None:
+            pg.cursor.execute(QUERIES[f'{self.name}_dimension_watermark'])
+            latest = pg.cursor.fetchone()[0]
+            with self.lock:
+                self.watermark = latest_datetime(current=self.watermark, obj_time=latest)
+            return
+
+        params = {self.state_key: watermark, 'shard_count': None, 'shard': None}
+        updated = 0
+        for data in pg.batch_execute(query=QUERIES[f'{self.name}_renames'], params=params):
+            with self.lock:
+                for entry_id, name, modified in data:
+                    if entry_id in self.entries:
+                        self.entries[entry_id] = (name, modified)
+                        updated += 1
+                    self.watermark = latest_datetime(current=self.watermark, obj_time=modified)
+        logging.debug(f'Dimension {self.name} refreshed: {updated} updated, {self.hits} hits, {self.misses} misses')
+
+    def _put(self, entries: dict) -> None:
+        with self.lock:
+            self.entries.update(entries)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+class Dimensions:
+    """
+    Класс сборки строк фильмов из таблицы фильмов, таблиц связей и кешей персон и жанров.
+    Строка имеет тот же вид, что и результат QUERIES['filmwork'], но агрегация с соединением персон и жанров
+    выполняется в процессе ETL, а не в postgresql
+    """
+
+    def __init__(self, *, maxsize: int):
+        self.persons = DimensionCache(name='person', state_key='person_date', maxsize=maxsize)
+        self.genres = DimensionCache(name='genre', state_key='genre_date', maxsize=maxsize)
+
+    def refresh(self, *, pg: PostgresLoader) -> None:
+        """
+        Метод обновления кешей персон и жанров
+
+        :param pg: соединение postgresql
+        """
+        self.persons.refresh(pg=pg)
+        self.genres.refresh(pg=pg)
+
+    def filmwork_rows(self, *, pg: PostgresLoader, ids: list) -> list[tuple]:
+        """
+        Метод получения строк фильмов
+
+        :param pg: соединение postgresql
+        :param ids: идентификаторы фильмов
+        :return: строки в виде результата QUERIES['filmwork'] в порядке времени изменения фильмов
+        """
+        films = [row for data in pg.batch_execute(query=QUERIES['filmwork_slim'], params={'ids': ids})
+                 for row in data]
+        links = defaultdict(list)
+        for data in pg.batch_execute(query=QUERIES['filmwork_links'], params={'ids': ids}):
+            for film_id, entry_id, role in data:
+                links[film_id].append((entry_id, role))
+        person_ids = {entry_id for film_links in links.values() for entry_id, role in film_links if role}
+        genre_ids = {entry_id for film_links in links.values() for entry_id, role in film_links if not role}
+        persons = self.persons.get_many(pg=pg, ids=person_ids)
+        genres = self.genres.get_many(pg=pg, ids=genre_ids)
+
+        rows = []
+        for film_id, title, description, rating, creation_date, modified in films:
+            fields = {'genre': [], 'actors': [], 'director': [], 'writers': []}
+            person_time, genre_time = set(), set()
+            for entry_id, role in links.get(film_id, ()):
+                if role is None:
+                    if (genre := genres.get(entry_id)) is not None:
+                        fields['genre'].append((genre[0], entry_id))
+                        genre_time.add(genre[1])
+                elif (person := persons.get(entry_id)) is not None:
+                    if role in ROLE_FIELDS:
+                        fields[ROLE_FIELDS[role]].append((person[0], entry_id))
+                    person_time.add(person[1])
+            aggs = {field: dict(sorted(set(pairs))) or None for field, pairs in fields.items()}
+            rows.append((film_id, title, description, rating, creation_date, aggs['genre'], aggs['actors'],
+                         aggs['director'], aggs['writers'], list(person_time), list(genre_time), modified))
+        return rows
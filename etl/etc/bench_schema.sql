@@ -0,0 +1,37 @@
+-- Минимальная схема для бенчмарка: только колонки, которые читает ETL.
+-- Выполняется benchmark.py --generate в отдельной базе BENCHMARK['db_name']
+CREATE TABLE IF NOT EXISTS film_work
+(
+    id            uuid PRIMARY KEY,
+    title         text        NOT NULL,
+    description   text,
+    rating        float,
+    creation_date date,
+    modified      timestamptz NOT NULL
+);
+CREATE TABLE IF NOT EXISTS person
+(
+    id        uuid PRIMARY KEY,
+    full_name text        NOT NULL,
+    modified  timestamptz NOT NULL
+);
+CREATE TABLE IF NOT EXISTS genre
+(
+    id          uuid PRIMARY KEY,
+    name        text        NOT NULL,
+    description text,
+    modified    timestamptz NOT NULL
+);
+CREATE TABLE IF NOT EXISTS person_film_work
+(
+    id           uuid PRIMARY KEY,
+    film_work_id uuid NOT NULL REFERENCES film_work (id),
+    person_id    uuid NOT NULL REFERENCES person (id),
+    role         text NOT NULL
+);
+CREATE TABLE IF NOT EXISTS genre_film_work
+(
+    id           uuid PRIMARY KEY,
+    film_work_id uuid NOT NULL REFERENCES film_work (id),
+    genre_id     uuid NOT NULL REFERENCES genre (id)
+);
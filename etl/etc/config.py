@@ -13,8 +13,14 @@ DSL = {
     'port': os.environ.get('DB_PORT', 5432)
 }
 
+PG_POOL = {
+    'minconn': int(os.environ.get('PG_POOL_MIN', 1)),
+    'maxconn': int(os.environ.get('PG_POOL_MAX', 5))
+}
+
 ES_CONFIG = {
     'hosts': json.loads(os.environ.get('ES_HOSTS', '["127.0.0.1"]')),
+    'maxsize': int(os.environ.get('ES_MAXSIZE', 10)),
     'index_names': json.loads(
         os.environ.get('INDEX_NAMES', '{"movies": "movies", "persons": "persons", "genres": "genres"}')),
     'movies_settings': {
@@ -24,8 +30,88 @@ ES_CONFIG = {
     }
 }
 
+TABLE_INDEXES = {
+    'filmwork': 'movies',
+    'person': 'persons',
+    'genre': 'genres'
+}
+
+REBUILD = {
+    'keep_versions': int(os.environ.get('REBUILD_KEEP_VERSIONS', 2)),
+    'timeout': int(os.environ.get('REBUILD_TIMEOUT', 3600))
+}
+
 LOGGER_CONF_PATH = 'etc/logger.conf'
 STATE_FILE_PATH = 'state.json'
+DIGEST_DB_PATH = os.environ.get('DIGEST_DB_PATH', 'digests.db')
 BATCH_SIZE = 500
+CHECKPOINT_CHUNKS = int(os.environ.get('CHECKPOINT_CHUNKS', 10))
+BULK = {
+    'thread_count': int(os.environ.get('BULK_THREADS', 1)),
+    'max_chunk_bytes': int(os.environ.get('BULK_MAX_CHUNK_BYTES', 10 * 1024 * 1024)),
+    'min_chunk_size': int(os.environ.get('BULK_MIN_CHUNK_SIZE', 50)),
+    'max_chunk_size': int(os.environ.get('BULK_MAX_CHUNK_SIZE', 5000)),
+    'target_latency': float(os.environ.get('BULK_TARGET_LATENCY', 1.0)),
+    'max_retries': int(os.environ.get('BULK_MAX_RETRIES', 3)),
+    'initial_backoff': float(os.environ.get('BULK_INITIAL_BACKOFF', 1))
+}
+RETRY = {
+    'jitter': os.environ.get('RETRY_JITTER', 'true').lower() == 'true',
+    'breaker_threshold': int(os.environ.get('BREAKER_THRESHOLD', 5)),
+    'breaker_reset': float(os.environ.get('BREAKER_RESET', 30))
+}
+MEMORY = {
+    'max_rows': int(os.environ.get('MEMORY_MAX_ROWS', 20000)),
+    'max_bytes': int(os.environ.get('MEMORY_MAX_BYTES', 256 * 1024 * 1024)),
+    'max_chunks': int(os.environ.get('MEMORY_MAX_CHUNKS', 0))
+}
+COPY_EXTRACT = os.environ.get('COPY_EXTRACT', 'false').lower() == 'true'
+DIMENSIONS = {
+    'enabled': os.environ.get('DIMENSION_CACHE', 'false').lower() == 'true',
+    'cache_size': int(os.environ.get('DIMENSION_CACHE_SIZE', 200000))
+}
+PARTIAL_UPDATES = os.environ.get('PARTIAL_UPDATES', 'false').lower() == 'true'
+PIPELINE_MODE = os.environ.get('PIPELINE_MODE', 'serial')
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 4))
+
+SHARD = {
+    'spec': os.environ.get('ETL_SHARD'),
+    'lock_namespace': int(os.environ.get('SHARD_LOCK_NAMESPACE', 4541))
+}
+
+BENCHMARK = {
+    'db_name': os.environ.get('BENCH_DB_NAME', 'movies_bench'),
+    'baseline_path': os.environ.get('BENCH_BASELINE_PATH', 'benchmark_baseline.json'),
+    'tolerance': float(os.environ.get('BENCH_TOLERANCE', 0.2)),
+    'rss_interval': float(os.environ.get('BENCH_RSS_INTERVAL', 0.5)),
+    'rss_growth': float(os.environ.get('BENCH_RSS_GROWTH', 0.1))
+}
+
+SNAPSHOT = {
+    'dir': os.environ.get('SNAPSHOT_DIR', 'snapshots'),
+    'docs_per_file': int(os.environ.get('SNAPSHOT_DOCS_PER_FILE', 100000)),
+    'compresslevel': int(os.environ.get('SNAPSHOT_COMPRESSLEVEL', 6)),
+    'import_threads': int(os.environ.get('SNAPSHOT_IMPORT_THREADS', 4))
+}
+
+VERIFY = {
+    'prefix_length': int(os.environ.get('VERIFY_PREFIX_LENGTH', 2)),
+    'slices': int(os.environ.get('VERIFY_SLICES', 4)),
+    'scroll_size': int(os.environ.get('VERIFY_SCROLL_SIZE', 1000))
+}
+
+METRICS = {
+    'host': os.environ.get('METRICS_HOST', '127.0.0.1'),
+    'port': int(os.environ.get('METRICS_PORT', 9108)),
+    'summary': os.environ.get('METRICS_SUMMARY', 'false').lower() == 'true'
+}
 
 AWAIT_TIME = 60
+ETL_WORKERS = int(os.environ.get('ETL_WORKERS', 3))
+
+LISTEN = {
+    'channel': os.environ.get('LISTEN_CHANNEL', 'etl_changes'),
+    'max_latency': float(os.environ.get('LISTEN_MAX_LATENCY', 0.5)),
+    'max_batch': int(os.environ.get('LISTEN_MAX_BATCH', 1000)),
+    'poll_interval': int(os.environ.get('LISTEN_POLL_INTERVAL', 600))
+}
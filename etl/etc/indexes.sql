@@ -0,0 +1,9 @@
+-- Индексы, необходимые для инкрементальной загрузки: каждый запрос QUERIES['*_ids']
+-- выполняется как диапазонный поиск по modified одной таблицы с переходом по таблице связей
+CREATE INDEX IF NOT EXISTS film_work_modified_idx ON film_work (modified, id);
+CREATE INDEX IF NOT EXISTS person_modified_idx ON person (modified, id);
+CREATE INDEX IF NOT EXISTS genre_modified_idx ON genre (modified, id);
+CREATE INDEX IF NOT EXISTS person_film_work_person_idx ON person_film_work (person_id);
+CREATE INDEX IF NOT EXISTS person_film_work_film_work_idx ON person_film_work (film_work_id);
+CREATE INDEX IF NOT EXISTS genre_film_work_genre_idx ON genre_film_work (genre_id);
+CREATE INDEX IF NOT EXISTS genre_film_work_film_work_idx ON genre_film_work (film_work_id);
@@ -0,0 +1,56 @@
+-- Триггеры для событийного режима загрузки (loader.py --listen):
+-- каждое изменение строки отправляет в канал идентификаторы затронутых записей.
+-- Канал задается настройкой базы etl.notify_channel и должен совпадать с LISTEN_CHANNEL процесса загрузки,
+-- без настройки используется канал etl_changes:
+-- ALTER DATABASE movies SET etl.notify_channel = 'etl_changes';
+CREATE OR REPLACE FUNCTION etl_notify_change() RETURNS trigger AS
+$$
+DECLARE
+    row_data jsonb := to_jsonb(COALESCE(NEW, OLD));
+BEGIN
+    PERFORM pg_notify(coalesce(nullif(current_setting('etl.notify_channel', true), ''), 'etl_changes'),
+                      json_build_object(
+                              'table', TG_TABLE_NAME,
+                              'id', row_data ->> 'id',
+                              'film_work_id', row_data ->> 'film_work_id',
+                              'person_id', row_data ->> 'person_id',
+                              'genre_id', row_data ->> 'genre_id'
+                          )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS etl_notify_change ON film_work;
+CREATE TRIGGER etl_notify_change
+    AFTER INSERT OR UPDATE OR DELETE
+    ON film_work
+    FOR EACH ROW
+EXECUTE FUNCTION etl_notify_change();
+
+DROP TRIGGER IF EXISTS etl_notify_change ON person;
+CREATE TRIGGER etl_notify_change
+    AFTER INSERT OR UPDATE OR DELETE
+    ON person
+    FOR EACH ROW
+EXECUTE FUNCTION etl_notify_change();
+
+DROP TRIGGER IF EXISTS etl_notify_change ON genre;
+CREATE TRIGGER etl_notify_change
+    AFTER INSERT OR UPDATE OR DELETE
+    ON genre
+    FOR EACH ROW
+EXECUTE FUNCTION etl_notify_change();
+
+DROP TRIGGER IF EXISTS etl_notify_change ON person_film_work;
+CREATE TRIGGER etl_notify_change
+    AFTER INSERT OR UPDATE OR DELETE
+    ON person_film_work
+    FOR EACH ROW
+EXECUTE FUNCTION etl_notify_change();
+
+DROP TRIGGER IF EXISTS etl_notify_change ON genre_film_work;
+CREATE TRIGGER etl_notify_change
+    AFTER INSERT OR UPDATE OR DELETE
+    ON genre_film_work
+    FOR EACH ROW
+EXECUTE FUNCTION etl_notify_change();
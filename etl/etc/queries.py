@@ -1,19 +1,38 @@
+# формат версии документа в postgresql, совпадает с VERSION_FORMAT в python
+VERSION_SQL_FORMAT = 'YYYY-MM-DD"T"HH24:MI:SS.US"Z"'
+VERSION_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+# формат времени COPY, читается datetime.fromisoformat
+COPY_TIME_FORMAT = 'YYYY-MM-DD"T"HH24:MI:SS.US"+00:00"'
+
+
+def shard_filter(column: str) -> str:
+    """
+    Функция условия принадлежности записи шарду по последним 32 битам uuid, совпадает с Shard.owns.
+    Без шардирования (shard_count NULL) условие выполняется для всех записей
+
+    :param column: столбец с uuid записи
+    :return: условие sql запроса
+    """
+    return (f"(%(shard_count)s::int IS NULL OR "
+            f"mod(('x' || right({column}::text, 8))::bit(32)::bigint, %(shard_count)s::int) = %(shard)s::int)")
+
+
 QUERIES = {
-    'filmwork': lambda ids: f'''
+    'filmwork': '''
 SELECT film_work.id,
        film_work.title,
        film_work.description,
        film_work.rating,
        film_work.creation_date,
-       JSON_OBJECT_AGG(DISTINCT genre.name, genre.id)                             AS genre,
+       JSON_OBJECT_AGG(DISTINCT genre.name, genre.id)        AS genre,
        JSON_OBJECT_AGG(DISTINCT person.full_name, person.id)
-       FILTER (WHERE UPPER(person_film_work.role::text) LIKE UPPER('%actor%'))    AS actors,
+       FILTER (WHERE person_film_work.role = 'actor')        AS actors,
        JSON_OBJECT_AGG(DISTINCT person.full_name, person.id)
-       FILTER (WHERE UPPER(person_film_work.role::text) LIKE UPPER('%director%')) AS director,
+       FILTER (WHERE person_film_work.role = 'director')     AS director,
        JSON_OBJECT_AGG(DISTINCT person.full_name, person.id)
-       FILTER (WHERE UPPER(person_film_work.role::text) LIKE UPPER('%writer%'))   AS writers,
-       ARRAY_AGG(DISTINCT person.modified)                                        AS person_time,
-       ARRAY_AGG(DISTINCT genre.modified)                                         AS genres_time,
+       FILTER (WHERE person_film_work.role = 'writer')       AS writers,
+       ARRAY_AGG(DISTINCT person.modified)                   AS person_time,
+       ARRAY_AGG(DISTINCT genre.modified)                    AS genres_time,
        film_work.modified
 FROM film_work
          LEFT OUTER JOIN genre_film_work
@@ -24,77 +43,298 @@ FROM film_work
                          ON (film_work.id = person_film_work.film_work_id)
          LEFT OUTER JOIN person
                          ON (person_film_work.person_id = person.id)
-WHERE film_work.id {f'in {ids}' if len(ids) > 1 else f"= '{ids[0]}'"}
+WHERE film_work.id = ANY(%(ids)s::uuid[])
 GROUP BY film_work.id
-ORDER BY film_work.modified;
+ORDER BY film_work.modified, film_work.id;
 ''',
-    'genre': lambda ids: f'''
+    'filmwork_slim': '''
+SELECT film_work.id,
+       film_work.title,
+       film_work.description,
+       film_work.rating,
+       film_work.creation_date,
+       film_work.modified
+FROM film_work
+WHERE film_work.id = ANY(%(ids)s::uuid[])
+ORDER BY film_work.modified, film_work.id;
+''',
+    'filmwork_links': '''
+SELECT person_film_work.film_work_id, person_film_work.person_id, person_film_work.role::text
+FROM person_film_work
+WHERE person_film_work.film_work_id = ANY(%(ids)s::uuid[])
+UNION ALL
+SELECT genre_film_work.film_work_id, genre_film_work.genre_id, NULL
+FROM genre_film_work
+WHERE genre_film_work.film_work_id = ANY(%(ids)s::uuid[]);
+''',
+    'person_dimension': '''
+SELECT person.id, person.full_name, person.modified
+FROM person
+WHERE person.id = ANY(%(ids)s::uuid[]);
+''',
+    'genre_dimension': '''
+SELECT genre.id, genre.name, genre.modified
+FROM genre
+WHERE genre.id = ANY(%(ids)s::uuid[]);
+''',
+    'person_dimension_watermark': '''
+SELECT max(person.modified)
+FROM person;
+''',
+    'genre_dimension_watermark': '''
+SELECT max(genre.modified)
+FROM genre;
+''',
+    'filmwork_copy': f'''
+COPY (
+    SELECT film_work.id, 0, film_work.title, film_work.description, film_work.rating::text,
+           to_char(film_work.creation_date, 'YYYY-MM-DD'),
+           to_char(film_work.modified AT TIME ZONE 'UTC', '{COPY_TIME_FORMAT}')
+    FROM film_work
+    WHERE {shard_filter("film_work.id")}
+      AND (%(after)s::uuid IS NULL OR film_work.id > %(after)s::uuid)
+    UNION ALL
+    SELECT person_film_work.film_work_id, 1, person_film_work.role::text, person.id::text, person.full_name, NULL,
+           to_char(person.modified AT TIME ZONE 'UTC', '{COPY_TIME_FORMAT}')
+    FROM person_film_work
+             JOIN person
+                  ON (person_film_work.person_id = person.id)
+    WHERE {shard_filter("person_film_work.film_work_id")}
+      AND (%(after)s::uuid IS NULL OR person_film_work.film_work_id > %(after)s::uuid)
+    UNION ALL
+    SELECT genre_film_work.film_work_id, 2, NULL, genre.id::text, genre.name, NULL,
+           to_char(genre.modified AT TIME ZONE 'UTC', '{COPY_TIME_FORMAT}')
+    FROM genre_film_work
+             JOIN genre
+                  ON (genre_film_work.genre_id = genre.id)
+    WHERE {shard_filter("genre_film_work.film_work_id")}
+      AND (%(after)s::uuid IS NULL OR genre_film_work.film_work_id > %(after)s::uuid)
+    ORDER BY 1, 2
+) TO STDOUT;
+''',
+    'person_copy': f'''
+COPY (
+    SELECT person.id, 0, person.full_name, NULL,
+           to_char(person.modified AT TIME ZONE 'UTC', '{COPY_TIME_FORMAT}')
+    FROM person
+    WHERE {shard_filter("person.id")}
+      AND (%(after)s::uuid IS NULL OR person.id > %(after)s::uuid)
+    UNION ALL
+    SELECT person_film_work.person_id, 1, person_film_work.role::text, film_work.id::text,
+           to_char(film_work.modified AT TIME ZONE 'UTC', '{COPY_TIME_FORMAT}')
+    FROM person_film_work
+             JOIN film_work
+                  ON (person_film_work.film_work_id = film_work.id)
+    WHERE {shard_filter("person_film_work.person_id")}
+      AND (%(after)s::uuid IS NULL OR person_film_work.person_id > %(after)s::uuid)
+    ORDER BY 1, 2
+) TO STDOUT;
+''',
+    'genre_copy': f'''
+COPY (
+    SELECT genre.id, genre.name, genre.description,
+           to_char(genre.modified AT TIME ZONE 'UTC', '{COPY_TIME_FORMAT}')
+    FROM genre
+    WHERE {shard_filter("genre.id")}
+      AND (%(after)s::uuid IS NULL OR genre.id > %(after)s::uuid)
+    ORDER BY genre.id
+) TO STDOUT;
+''',
+    'filmwork_versions': f'''
+SELECT film_work.id::text AS id,
+       to_char(greatest(film_work.modified,
+                        (SELECT max(person.modified)
+                         FROM person_film_work
+                                  JOIN person
+                                       ON (person_film_work.person_id = person.id)
+                         WHERE person_film_work.film_work_id = film_work.id),
+                        (SELECT max(genre.modified)
+                         FROM genre_film_work
+                                  JOIN genre
+                                       ON (genre_film_work.genre_id = genre.id)
+                         WHERE genre_film_work.film_work_id = film_work.id))
+                   AT TIME ZONE 'UTC', '{VERSION_SQL_FORMAT}') AS version
+FROM film_work
+WHERE (%(lower)s::uuid IS NULL OR film_work.id BETWEEN %(lower)s::uuid AND %(upper)s::uuid)
+ORDER BY film_work.id
+''',
+    'person_versions': f'''
+SELECT person.id::text AS id,
+       to_char(greatest(person.modified,
+                        (SELECT max(film_work.modified)
+                         FROM person_film_work
+                                  JOIN film_work
+                                       ON (person_film_work.film_work_id = film_work.id)
+                         WHERE person_film_work.person_id = person.id))
+                   AT TIME ZONE 'UTC', '{VERSION_SQL_FORMAT}') AS version
+FROM person
+WHERE (%(lower)s::uuid IS NULL OR person.id BETWEEN %(lower)s::uuid AND %(upper)s::uuid)
+ORDER BY person.id
+''',
+    'genre_versions': f'''
+SELECT genre.id::text AS id,
+       to_char(genre.modified AT TIME ZONE 'UTC', '{VERSION_SQL_FORMAT}') AS version
+FROM genre
+WHERE (%(lower)s::uuid IS NULL OR genre.id BETWEEN %(lower)s::uuid AND %(upper)s::uuid)
+ORDER BY genre.id
+''',
+    # {versions} - один из запросов *_versions без ограничения диапазона
+    'version_buckets': '''
+SELECT left(docs.id, %(prefix_length)s::int)                                                  AS bucket,
+       count(*),
+       sum(('x' || left(md5(docs.id || '|' || coalesce(docs.version, '')), 15))::bit(60)::bigint) AS digest
+FROM ({versions}) AS docs
+GROUP BY 1;
+''',
+    'genre': '''
 SELECT genre.id,
        genre.name,
        genre.description,
        genre.modified
 FROM genre
-WHERE genre.id {f'in {ids}' if len(ids) > 1 else f"= '{ids[0]}'"}
+WHERE genre.id = ANY(%(ids)s::uuid[])
 GROUP BY genre.id
-ORDER BY genre.modified;
+ORDER BY genre.modified, genre.id;
 ''',
-    'person': lambda ids: f'''
+    'person': '''
 SELECT person.id,
        person.full_name,
-       ARRAY_AGG(DISTINCT person_film_work.role)                                  AS roles,
-       ARRAY_AGG(DISTINCT film_work.id)
-       FILTER (WHERE UPPER(person_film_work.role::text) LIKE UPPER('%actor%'))    AS films_as_actor,
-       ARRAY_AGG(DISTINCT film_work.id)
-       FILTER (WHERE UPPER(person_film_work.role::text) LIKE UPPER('%director%')) AS films_as_director,
-       ARRAY_AGG(DISTINCT film_work.id)
-       FILTER (WHERE UPPER(person_film_work.role::text) LIKE UPPER('%writer%'))   AS films_as_writer,
+       ARRAY_AGG(DISTINCT person_film_work.role::text)   AS roles,
+       ARRAY_AGG(DISTINCT film_work.id::text)
+       FILTER (WHERE person_film_work.role = 'actor')    AS films_as_actor,
+       ARRAY_AGG(DISTINCT film_work.id::text)
+       FILTER (WHERE person_film_work.role = 'director') AS films_as_director,
+       ARRAY_AGG(DISTINCT film_work.id::text)
+       FILTER (WHERE person_film_work.role = 'writer')   AS films_as_writer,
        person.modified,
-       ARRAY_AGG(DISTINCT film_work.modified)                                         AS filmwork_time
+       ARRAY_AGG(DISTINCT film_work.modified)            AS filmwork_time
 FROM person
          LEFT OUTER JOIN person_film_work
                          ON (person.id = person_film_work.person_id)
          LEFT OUTER JOIN film_work
                          ON (person_film_work.film_work_id = film_work.id)
-WHERE person.id {f'in {ids}' if len(ids) > 1 else f"= '{ids[0]}'"}
+WHERE person.id = ANY(%(ids)s::uuid[])
 GROUP BY person.id
-ORDER BY person.modified;
-    ''',
-    'genre_ids': lambda genre_date: f'''
-SELECT genre.id
+ORDER BY person.modified, person.id;
+''',
+    'genre_ids': (
+        f'''
+SELECT genre.id, genre.modified, genre.id
 FROM genre
-WHERE {genre_date if genre_date else 'to_timestamp(0)'} < genre.modified
-GROUP BY genre.id
-ORDER BY genre.modified;
+WHERE COALESCE(%(genre_date)s::timestamptz, to_timestamp(0)) < genre.modified
+  AND (%(cursor_modified)s::timestamptz IS NULL OR
+       (genre.modified, genre.id) >= (%(cursor_modified)s::timestamptz, %(cursor_id)s::uuid))
+  AND {shard_filter("genre.id")}
+ORDER BY genre.modified, genre.id;
 ''',
-    'person_ids': lambda person_date, filmwork_date: f'''
-SELECT person.id
+    ),
+    'person_ids': (
+        f'''
+SELECT person.id, person.modified, person.id
 FROM person
-         LEFT OUTER JOIN person_film_work
-                         ON (person.id = person_film_work.person_id)
-         LEFT OUTER JOIN film_work
-                         ON (person_film_work.film_work_id = film_work.id)
-WHERE
-{person_date if person_date else 'to_timestamp(0)'} < person.modified OR
-{filmwork_date if filmwork_date else 'to_timestamp(0)'} < film_work.modified
-GROUP BY person.id
-ORDER BY person.modified;
-    ''',
-    'filmwork_ids': lambda filmwork_date=None, genre_date=None, person_date=None: f'''
-SELECT film_work.id
+WHERE COALESCE(%(person_date)s::timestamptz, to_timestamp(0)) < person.modified
+  AND (%(cursor_modified)s::timestamptz IS NULL OR
+       (person.modified, person.id) >= (%(cursor_modified)s::timestamptz, %(cursor_id)s::uuid))
+  AND {shard_filter("person.id")}
+ORDER BY person.modified, person.id;
+''',
+        f'''
+SELECT person_film_work.person_id, film_work.modified, film_work.id
 FROM film_work
-         LEFT OUTER JOIN genre_film_work
-                         ON (film_work.id = genre_film_work.film_work_id)
-         LEFT OUTER JOIN genre
-                         ON (genre_film_work.genre_id = genre.id)
-         LEFT OUTER JOIN person_film_work
-                         ON (film_work.id = person_film_work.film_work_id)
-         LEFT OUTER JOIN person
-                         ON (person_film_work.person_id = person.id)
-WHERE
-{filmwork_date if filmwork_date else 'to_timestamp(0)'} < film_work.modified OR 
-{genre_date if genre_date else 'to_timestamp(0)'} < genre.modified OR
-{person_date if person_date else 'to_timestamp(0)'} < person.modified
-GROUP BY film_work.id
-ORDER BY film_work.modified;
-    '''
+         JOIN person_film_work
+              ON (film_work.id = person_film_work.film_work_id)
+WHERE COALESCE(%(filmwork_date)s::timestamptz, to_timestamp(0)) < film_work.modified
+  AND (%(cursor_modified)s::timestamptz IS NULL OR
+       (film_work.modified, film_work.id) >= (%(cursor_modified)s::timestamptz, %(cursor_id)s::uuid))
+  AND {shard_filter("person_film_work.person_id")}
+ORDER BY film_work.modified, film_work.id;
+''',
+    ),
+    'filmwork_ids': (
+        f'''
+SELECT film_work.id, film_work.modified, film_work.id
+FROM film_work
+WHERE COALESCE(%(filmwork_date)s::timestamptz, to_timestamp(0)) < film_work.modified
+  AND (%(cursor_modified)s::timestamptz IS NULL OR
+       (film_work.modified, film_work.id) >= (%(cursor_modified)s::timestamptz, %(cursor_id)s::uuid))
+  AND {shard_filter("film_work.id")}
+ORDER BY film_work.modified, film_work.id;
+''',
+        f'''
+SELECT genre_film_work.film_work_id, genre.modified, genre.id
+FROM genre
+         JOIN genre_film_work
+              ON (genre.id = genre_film_work.genre_id)
+WHERE COALESCE(%(genre_date)s::timestamptz, to_timestamp(0)) < genre.modified
+  AND (%(cursor_modified)s::timestamptz IS NULL OR
+       (genre.modified, genre.id) >= (%(cursor_modified)s::timestamptz, %(cursor_id)s::uuid))
+  AND {shard_filter("genre_film_work.film_work_id")}
+ORDER BY genre.modified, genre.id;
+''',
+        f'''
+SELECT person_film_work.film_work_id, person.modified, person.id
+FROM person
+         JOIN person_film_work
+              ON (person.id = person_film_work.person_id)
+WHERE COALESCE(%(person_date)s::timestamptz, to_timestamp(0)) < person.modified
+  AND (%(cursor_modified)s::timestamptz IS NULL OR
+       (person.modified, person.id) >= (%(cursor_modified)s::timestamptz, %(cursor_id)s::uuid))
+  AND {shard_filter("person_film_work.film_work_id")}
+ORDER BY person.modified, person.id;
+''',
+    ),
+    'filmwork_by_person': '''
+SELECT DISTINCT person_film_work.film_work_id
+FROM person_film_work
+WHERE person_film_work.person_id = ANY(%(ids)s::uuid[]);
+''',
+    'filmwork_by_genre': '''
+SELECT DISTINCT genre_film_work.film_work_id
+FROM genre_film_work
+WHERE genre_film_work.genre_id = ANY(%(ids)s::uuid[]);
+''',
+    'person_by_filmwork': '''
+SELECT DISTINCT person_film_work.person_id
+FROM person_film_work
+WHERE person_film_work.film_work_id = ANY(%(ids)s::uuid[]);
+''',
+    'person_renames': f'''
+SELECT person.id, person.full_name, person.modified
+FROM person
+WHERE COALESCE(%(person_date)s::timestamptz, to_timestamp(0)) < person.modified
+  AND {shard_filter("person.id")}
+ORDER BY person.modified, person.id;
+''',
+    'genre_renames': f'''
+SELECT genre.id, genre.name, genre.modified
+FROM genre
+WHERE COALESCE(%(genre_date)s::timestamptz, to_timestamp(0)) < genre.modified
+  AND {shard_filter("genre.id")}
+ORDER BY genre.modified, genre.id;
+''',
+    'shard_lock': '''
+SELECT pg_try_advisory_lock(%(namespace)s::int, %(key)s::int);
+''',
+    # ключи шардов, закрепленных другими процессами
+    'shard_owners': '''
+SELECT locks.objid::bigint
+FROM pg_locks AS locks
+WHERE locks.locktype = 'advisory'
+  AND locks.database = (SELECT oid FROM pg_database WHERE datname = current_database())
+  AND locks.classid = %(namespace)s::int::oid
+  AND locks.objsubid = 2
+  AND locks.granted
+  AND locks.pid <> pg_backend_pid();
+''',
+    # канал уведомлений триггеров etc/notify.sql, вычисляется так же, как в etl_notify_change,
+    # функция, установленная до появления настройки etl.notify_channel, всегда уведомляет канал etl_changes
+    'notify_channel': '''
+SELECT CASE
+           WHEN proc.prosrc LIKE '%etl.notify_channel%'
+               THEN coalesce(nullif(current_setting('etl.notify_channel', true), ''), 'etl_changes')
+           ELSE 'etl_changes'
+           END
+FROM pg_proc AS proc
+WHERE proc.oid = to_regproc('etl_notify_change');
+'''
 }
@@ -0,0 +1,67 @@
+import json
+import logging
+import select
+from time import monotonic
+from typing import Generator
+
+import psycopg2
+from psycopg2 import sql
+
+from etc.config import DSL
+from etc.queries import QUERIES
+
+
+class ChangeListener:
+    """
+    Класс получения уведомлений об изменениях из postgresql через LISTEN/NOTIFY.
+    Уведомления собираются в пачки: пачка отдается не позже, чем через max_latency секунд
+    после первого уведомления, или раньше, если набралось max_batch уведомлений.
+    """
+
+    def __init__(self, *, channel: str, max_latency: float, max_batch: int):
+        self.channel = channel
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+
+    def __enter__(self):
+        logging.debug('Connecting to postgres for notifications')
+        self.connection = psycopg2.connect(**DSL)
+        self.connection.autocommit = True
+        with self.connection.cursor() as cursor:
+            cursor.execute(QUERIES['notify_channel'])
+            if (row := cursor.fetchone()) is None:
+                self.connection.close()
+                raise RuntimeError('Trigger function etl_notify_change is not installed, run etc/notify.sql')
+            if (channel := row[0]) != self.channel:
+                self.connection.close()
+                raise RuntimeError(f'Triggers notify channel {channel}, but the loader listens to {self.channel}: '
+                                   f'set LISTEN_CHANNEL or the etl.notify_channel database setting to match')
+            cursor.execute(sql.SQL('LISTEN {}').format(sql.Identifier(self.channel)))
+        logging.info(f'Listening postgres channel {self.channel}')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.connection.close()
+        logging.debug('Postgres notification connection closed')
+
+    def changes(self, *, timeout: float) -> Generator:
+        """
+        Метод получения пачек уведомлений
+
+        :param timeout: время ожидания первого уведомления
+        :yield: events: пачка уведомлений, пустой список, если за timeout изменений не было
+        """
+        while True:
+            events = self._wait(timeout=timeout)
+            deadline = monotonic() + self.max_latency
+            while events and len(events) < self.max_batch and (remaining := deadline - monotonic()) > 0:
+                events += self._wait(timeout=remaining)
+            yield events
+
+    def _wait(self, *, timeout: float) -> list[dict]:
+        if select.select([self.connection], [], [], timeout) == ([], [], []):
+            return []
+        self.connection.poll()
+        events = [json.loads(notify.payload) for notify in self.connection.notifies]
+        self.connection.notifies.clear()
+        return events
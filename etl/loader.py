@@ -1,16 +1,38 @@
+import argparse
 import logging
-from collections import deque
+from itertools import chain
 from logging import config
-from time import sleep
-from typing import Generator
+from time import perf_counter
+from typing import Generator, Optional
 
 from elasticsearch import helpers
 
+from budget import MemoryBudget
+from bulk import AdaptiveChunkSize, adaptive_parallel_bulk
+from connections import close_connections, get_es_client
+from copy_extract import CopyExtractor
 from data_workers import PostgresLoader, ElasticsearchLoader, Filmwork, Person, Genre
-from etc.config import BATCH_SIZE, AWAIT_TIME, LOGGER_CONF_PATH, STATE_FILE_PATH
+from digests import VERSION_FIELD, DigestStore
+from dimensions import Dimensions
+from etc.config import (BATCH_SIZE, BULK, AWAIT_TIME, CHECKPOINT_CHUNKS, COPY_EXTRACT, DIGEST_DB_PATH, DIMENSIONS,
+                        ES_CONFIG, ETL_WORKERS, LISTEN, LOGGER_CONF_PATH, MEMORY, METRICS, PARTIAL_UPDATES,
+                        PIPELINE_MODE, PIPELINE_QUEUE_SIZE, SHARD, SNAPSHOT, STATE_FILE_PATH, TABLE_INDEXES, VERIFY)
 from etc.queries import QUERIES
+from listener import ChangeListener
+from metrics import CYCLE_SECONDS, DOCS_INDEXED, TRANSFORM_SECONDS, start_metrics_server
+from partial import RenamePropagator
+from pipeline import StagedPipeline
+from planner import ChangePlanner
+from progress import Progress
+from rebuild import IndexRebuilder
+from scheduler import TableScheduler
+from serializers import expand_serialized, serialized_source
+from shard import Shard
+from snapshot import SnapshotReader, SnapshotWriter
 from state import State, JsonFileStorage
-from utils import backoff, get_format_time
+from table_run import TableRun, rejected_ids, report_lag, resume_point
+from utils import backoff
+from verify import ConsistencyChecker
 
 tables = {
     'filmwork': Filmwork,
@@ -18,82 +40,472 @@ tables = {
     'genre': Genre
 }
 
+shard = Shard()
+dimensions = Dimensions(maxsize=DIMENSIONS['cache_size']) if DIMENSIONS['enabled'] else None
 
-@backoff()
-def extract_data(*, table: str, table_state: dict) -> Generator:
+bulk_chunk_sizes = {
+    table: AdaptiveChunkSize(initial=BATCH_SIZE, minimum=BULK['min_chunk_size'], maximum=BULK['max_chunk_size'],
+                             target_latency=BULK['target_latency'])
+    for table in tables
+}
+
+
+def extract_data(*, table: str, table_state: Optional[dict] = None, ids: Optional[list] = None,
+                 cursor: Optional[dict] = None, rejected: Optional[list] = None) -> Generator:
     """
     Функция извлечения данных из postgresql
 
     :param table: название таблицы
     :param table_state: состояние загрузки последней таблицы
-    :yield: item: единичный результат выполнения sql запроса
+    :param ids: идентификаторы записей, если известны заранее, иначе ищутся изменения после table_state
+    :param cursor: позиция, с которой нужно продолжить прерванную загрузку таблицы
+    :param rejected: идентификаторы отклоненных ранее документов, извлекаются повторно после изменений
+    :yield: item, cursor: единичный результат выполнения sql запроса и позиция извлечения,
+        если строка завершает группу извлечения
     """
-    with PostgresLoader(fetch_size=BATCH_SIZE) as pg_ids:
-        for ids in pg_ids.batch_execute(query=QUERIES[f'{table}_ids'](**table_state)):
-            pretty_ids = tuple([i.pop() for i in ids])
+    with PostgresLoader(fetch_size=BATCH_SIZE) as pg:
+        copy_resumed = cursor is not None and 'copy' in cursor
+        if ids is None and (copy_resumed or COPY_EXTRACT and cursor is None and not any((table_state or {}).values())):
+            after = cursor['copy'] if copy_resumed else None
+            logging.info(f'Full load of {table} through COPY' + (f' after {after}' if after else ''))
+            rows = CopyExtractor(pg=pg, shard=shard).rows(table=table, after=after)
+            # строки COPY упорядочены по идентификатору, поэтому он сам служит позицией продолжения
+            for number, item in enumerate(rows, start=1):
+                yield item, {'copy': item[0]} if number % BATCH_SIZE == 0 else None
+            batches = iter(())
+        elif ids is None:
+            planner = ChangePlanner(pg=pg, batch_size=BATCH_SIZE, shard=shard, partial_updates=PARTIAL_UPDATES)
+            batches = planner.changed_ids(table=table, table_state=table_state, cursor=cursor)
+        else:
+            batches = id_batches(ids=ids)
+        if rejected:
+            batches = chain(batches, id_batches(ids=rejected))
+        use_dimensions = table == 'filmwork' and dimensions is not None
+        if use_dimensions:
+            dimensions.refresh(pg=pg)
+        for batch, position in batches:
+            last = None
+            if use_dimensions:
+                data_batches = [dimensions.filmwork_rows(pg=pg, ids=batch)]
+            else:
+                data_batches = pg.batch_execute(query=QUERIES[table], params={'ids': batch})
+            for data in data_batches:
+                for item in data:
+                    if last is not None:
+                        yield last, None
+                    last = item
+            if last is not None:
+                yield last, position
 
-            with PostgresLoader(fetch_size=BATCH_SIZE) as pg_filmworks:
-                for data in pg_filmworks.batch_execute(query=QUERIES[table](pretty_ids)):
-                    for item in data:
-                        yield item
+
+def id_batches(*, ids: list) -> Generator:
+    """
+    Функция деления известных заранее идентификаторов на пачки запроса обогащения
+
+    :param ids: идентификаторы записей
+    :yield: ids, cursor: пачка идентификаторов без позиции извлечения
+    """
+    for i in range(0, len(ids), BATCH_SIZE):
+        yield ids[i:i + BATCH_SIZE], None
 
 
-def transform_data(*, data: Generator, table: str) -> Generator:
+def transform_data(*, data: Generator, table: str, progress: Progress, index: Optional[str] = None) -> Generator:
     """
     Функция форматирования сырого sql поля в требуемый elasticsearch
 
-    :param data: строка tuple - результат выполнения sql запроса
+    :param data: строка tuple - результат выполнения sql запроса и позиция извлечения
     :param table: название таблицы
+    :param progress: учет подтвержденных документов запуска
+    :param index: индекс для загрузки, если отличается от индекса таблицы по умолчанию
     :yield: dict: отформатированный словарь для bulk запроса Elasticsearch
     """
-    for item in data:
-        yield tables[table](*item).get_bulk_format()
+    elapsed, count = 0.0, 0
+    for item, cursor in data:
+        started = perf_counter()
+        doc = tables[table](*item)
+        progress.register(doc_id=doc.id, times=doc.get_db_state(), cursor=cursor)
+        action = doc.get_bulk_format()
+        if index:
+            action['_index'] = index
+        elapsed, count = elapsed + perf_counter() - started, count + 1
+        if count == BATCH_SIZE:
+            TRANSFORM_SECONDS.observe(elapsed, table=table)
+            elapsed, count = 0.0, 0
+        yield action
+    if count:
+        TRANSFORM_SECONDS.observe(elapsed, table=table)
 
 
-@backoff()
-def load_data(*, data: Generator, table: str) -> None:
+def weigh(action: dict) -> tuple[str, int]:
+    """
+    Функция оценки размера документа для бюджета памяти по размеру его json.
+    Json сохраняется в действии и используется bulk запросом без повторной сериализации
+
+    :param action: документ в формате bulk запроса
+    :return: идентификатор и размер документа в байтах
+    """
+    return action['_id'], len(serialized_source(action))
+
+
+def load_data(*, data: Generator, table: str, progress: Progress, skip_unchanged: bool = True,
+              save_digests: bool = True, save_state: bool = True, checkpoint: bool = True,
+              budget: Optional[MemoryBudget] = None) -> None:
     """
     Функция загрузки данных в elasticsearch
 
     :param table: название таблицы
     :param data: начальное время повтора
+    :param progress: учет подтвержденных документов запуска
+    :param skip_unchanged: не загружать документы, хеш которых не изменился с последней загрузки
+    :param save_digests: сохранить хеши загруженных документов
+    :param save_state: сохранить состояние загрузки таблицы после загрузки
+    :param checkpoint: сохранять позицию извлечения каждые CHECKPOINT_CHUNKS пачек
+    :param budget: бюджет памяти, в котором зарезервированы документы
     """
-    last_event = None
+    run = TableRun(state=state, digest_store=digest_store, table=table, index=TABLE_INDEXES[table],
+                   progress=progress, checkpoint_every=CHECKPOINT_CHUNKS * BATCH_SIZE,
+                   skip_unchanged=skip_unchanged, save_digests=save_digests, save_state=save_state,
+                   checkpoint=checkpoint, budget=budget)
     with ElasticsearchLoader() as es:
-        response = helpers.streaming_bulk(es, data, chunk_size=BATCH_SIZE)
+        data = run.digests.filter(data)
+        if BULK['thread_count'] > 1:
+            response = adaptive_parallel_bulk(es, data, chunk_size=bulk_chunk_sizes[table],
+                                              thread_count=BULK['thread_count'],
+                                              max_chunk_bytes=BULK['max_chunk_bytes'],
+                                              max_retries=BULK['max_retries'],
+                                              initial_backoff=BULK['initial_backoff'],
+                                              raise_on_error=False, max_in_flight=MEMORY['max_chunks'])
+        else:
+            response = helpers.streaming_bulk(es, data, chunk_size=BATCH_SIZE,
+                                              max_chunk_bytes=BULK['max_chunk_bytes'],
+                                              max_retries=BULK['max_retries'],
+                                              initial_backoff=BULK['initial_backoff'], raise_on_error=False,
+                                              expand_action_callback=expand_serialized)
         try:
-            last_result = deque(response, maxlen=1)
-            _, last_event = last_result.pop() if len(last_result) == 1 else (None, None)
+            for ok, item in response:
+                run.result(ok=ok, item=item)
+        except BaseException:
+            run.interrupted()
+            raise
         finally:
-            logging.info('Loading is complete')
-            if last_event:
-                db_sate = {k: v.isoformat() for k, v in tables[table].get_db_state().items()}
-                state.set_state(key=table, value=db_sate)
+            run.close()
+    run.complete()
 
 
-def main(*, table: str, table_state: dict) -> None:
+def main(*, table: str, table_state: Optional[dict] = None, index: Optional[str] = None,
+         ids: Optional[list] = None, cursor: Optional[dict] = None, watermark: Optional[dict] = None) -> dict:
     """
     Отказоустойчивая ETL функция
 
     :param table: название таблицы
     :param table_state: состояние загрузки последней таблицы
+    :param index: индекс для загрузки, если отличается от индекса таблицы по умолчанию,
+        при загрузке в него состояние таблицы и хеши документов не сохраняются
+    :param ids: идентификаторы измененных записей, при загрузке по ним состояние таблицы не сохраняется
+    :param cursor: позиция, с которой нужно продолжить прерванную загрузку таблицы
+    :param watermark: время последнего изменения документов, подтвержденных до прерывания загрузки
+    :return: время последнего изменения подтвержденных документов запуска
+    """
+    progress = Progress(watermark=watermark or table_state)
+    save_state = index is None and ids is None
+    load_options = {'table': table, 'progress': progress, 'skip_unchanged': index is None,
+                    'save_digests': index is None, 'save_state': save_state, 'checkpoint': save_state}
+    data = extract_data(table=table, table_state=table_state, ids=ids, cursor=cursor,
+                        rejected=rejected_ids(state=state, table=table) if save_state else None)
+    if PIPELINE_MODE != 'staged':
+        load_data(data=transform_data(data=data, table=table, progress=progress, index=index), **load_options)
+        return progress.get_state()
+
+    budget = MemoryBudget(max_rows=MEMORY['max_rows'], max_bytes=MEMORY['max_bytes'])
+    pipeline = StagedPipeline(queue_size=PIPELINE_QUEUE_SIZE, batch_size=BATCH_SIZE, budget=budget)
+    data = pipeline.stage(name=f'{table}.extract', data=data)
+    pretty_data = pipeline.stage(name=f'{table}.transform', weigh=weigh,
+                                 data=transform_data(data=data, table=table, progress=progress, index=index))
+    try:
+        load_data(data=pipeline.measure(name=f'{table}.load', data=pretty_data), budget=budget, **load_options)
+    finally:
+        budget.close()
+        pretty_data.close()
+        pipeline.log_stats()
+    return progress.get_state()
+
+
+@backoff()
+def run_table(*, table: str) -> None:
+    """
+    Функция запуска ETL процесса для одной таблицы с ее собственным состоянием.
+    При повторяемой ошибке запуск повторяется целиком и продолжается с сохраненной позиции
+
+    :param table: название таблицы
+    """
+    logging.info(f'Query {table} started')
+    table_state, cursor, watermark = resume_point(state=state, table=table, state_keys=tables[table].state_keys)
+    with CYCLE_SECONDS.time(table=table):
+        main(table=table, table_state=table_state, cursor=cursor, watermark=watermark)
+        if PARTIAL_UPDATES and table == 'filmwork':
+            propagate_changes()
+    report_lag(state=state, table=table)
+
+
+def propagate_changes() -> None:
+    """
+    Функция распространения изменений персон и жанров в индекс фильмов частичными обновлениями.
+    Выполняется после загрузки фильмов, чтобы частичное обновление не перезаписывалось документами,
+    извлеченными до изменения. У распространения собственное состояние: состояние фильмов сдвигается
+    по персонам и жанрам загруженных фильмов и могло бы пропустить еще не распространенные изменения
+    """
+    partial_state = state.get_state(key='filmwork_partial')
+    if partial_state is None:
+        filmwork_state = state.get_state(key='filmwork') or {}
+        partial_state = {key: filmwork_state.get(key) for key in ('person_date', 'genre_date')}
+        state.set_state(key='filmwork_partial', value=partial_state)
+    with PostgresLoader(fetch_size=BATCH_SIZE) as pg:
+        propagator = RenamePropagator(pg=pg, es=get_es_client(), index=ES_CONFIG['index_names']['movies'],
+                                      shard=shard, max_retries=BULK['max_retries'],
+                                      initial_backoff=BULK['initial_backoff'])
+        for partial_state in propagator.propagate(state=partial_state):
+            state.set_state(key='filmwork_partial', value=partial_state)
+
+
+def rebuild(*, table: str) -> None:
+    """
+    Функция полной перестройки индекса таблицы в новую версию с переключением алиаса.
+    Перестройка не меняет состояние таблицы: работающий параллельно процесс загрузки продолжает писать изменения
+    в алиас, то есть в старую версию индекса. Поэтому изменения после последнего документа перестройки
+    догружаются в новую версию перед переключением алиаса и еще раз после него, когда процесс загрузки уже
+    пишет в новую версию
+
+    :param table: название таблицы
+    """
+    index_key = TABLE_INDEXES[table]
+    rebuilder = IndexRebuilder(es=get_es_client(), alias=ES_CONFIG['index_names'][index_key],
+                               settings_path=ES_CONFIG['movies_settings'][index_key])
+    with rebuilder as index:
+        logging.info(f'Rebuild {table} into {index} started')
+        watermark = backoff()(main)(table=table, table_state=dict.fromkeys(tables[table].state_keys), index=index)
+        logging.info(f'Rebuild {table} replays changes after {watermark} before alias swap')
+        watermark = backoff()(main)(table=table, table_state=watermark, index=index)
+    logging.info(f'Rebuild {table} replays changes after {watermark} after alias swap')
+    backoff()(main)(table=table, table_state=watermark, index=index)
+
+
+def export_snapshot(*, table: str, directory: str) -> None:
     """
-    data = extract_data(table=table, table_state=table_state)
-    pretty_data = transform_data(data=data, table=table)
-    load_data(data=pretty_data, table=table)
+    Функция выгрузки всех документов таблицы (шарда) в снимок без загрузки в elasticsearch
+
+    :param table: название таблицы
+    :param directory: каталог снимка
+    """
+    logging.info(f'Export of {table} into {directory} started')
+    progress = Progress()
+    data = extract_data(table=table, table_state=dict.fromkeys(tables[table].state_keys))
+    writer = SnapshotWriter(directory=directory, table=table, shard=shard, docs_per_file=SNAPSHOT['docs_per_file'],
+                            compresslevel=SNAPSHOT['compresslevel'])
+    writer.write(data=transform_data(data=data, table=table, progress=progress), progress=progress)
+
+
+def import_snapshot(*, table: str, directory: str, index: Optional[str] = None) -> None:
+    """
+    Функция загрузки снимка таблицы в elasticsearch без обращения к postgresql.
+    Без index индекс таблицы перестраивается в новую версию, а состояние таблицы сдвигается
+    на время последнего изменения документов снимка. Состояние и хеши документов принадлежат постоянной загрузке,
+    которая держит их в памяти и перезаписала бы изменения импорта, поэтому импорт закрепляет шард
+    и отказывается работать, пока загрузка запущена. С index документы загружаются только в него,
+    состояние не меняется
+
+    :param table: название таблицы
+    :param directory: каталог снимка
+    :param index: индекс для загрузки
+    """
+    reader = SnapshotReader(directory=directory, table=table)
+    if index is not None:
+        load_snapshot(reader=reader, index=index)
+        return
+
+    index_key = TABLE_INDEXES[table]
+    rebuilder = IndexRebuilder(es=get_es_client(), alias=ES_CONFIG['index_names'][index_key],
+                               settings_path=ES_CONFIG['movies_settings'][index_key])
+    with shard:
+        with rebuilder as index:
+            load_snapshot(reader=reader, index=index)
+        state.update_state(values={table: reader.watermark, f'{table}_checkpoint': None})
+        digest_store.clear(index=index_key)
+
+
+def load_snapshot(*, reader: SnapshotReader, index: str) -> None:
+    """
+    Функция параллельной загрузки документов снимка в индекс
+
+    :param reader: снимок таблицы
+    :param index: индекс для загрузки
+    """
+    logging.info(f'Import of {reader.docs} {reader.table} document(s) into {index} started')
+    chunk_size = AdaptiveChunkSize(initial=BATCH_SIZE, minimum=BULK['min_chunk_size'],
+                                   maximum=BULK['max_chunk_size'], target_latency=BULK['target_latency'])
+    loaded = 0
+    with ElasticsearchLoader() as es:
+        for ok, item in adaptive_parallel_bulk(es, reader.pairs(), chunk_size=chunk_size,
+                                               thread_count=SNAPSHOT['import_threads'],
+                                               max_chunk_bytes=BULK['max_chunk_bytes'],
+                                               max_retries=BULK['max_retries'],
+                                               initial_backoff=BULK['initial_backoff'], index=index):
+            loaded += 1
+            DOCS_INDEXED.inc(index=next(iter(item.values())).get('_index'))
+    logging.info(f'Import is complete: {loaded} loaded')
+
+
+def verify(*, table: str, repair: bool = False) -> int:
+    """
+    Функция проверки соответствия индекса таблице и точечного исправления расхождений:
+    отсутствующие и устаревшие документы загружаются повторно, лишние удаляются, у документов с прежним телом
+    обновляется только версия. Устаревшая версия при прежнем теле расхождением не считается:
+    она остается после пропуска неизменившихся документов
+
+    :param table: название таблицы
+    :param repair: исправлять расхождения
+    :return: количество расходящихся документов
+    """
+    index_key = TABLE_INDEXES[table]
+    es = get_es_client()
+    divergent = 0
+    with PostgresLoader(fetch_size=BATCH_SIZE) as pg:
+        checker = ConsistencyChecker(pg=pg, es=es, table=table, index=ES_CONFIG['index_names'][index_key],
+                                     document=tables[table], prefix_length=VERIFY['prefix_length'],
+                                     slices=VERIFY['slices'], scroll_size=VERIFY['scroll_size'])
+        for bucket, reindex, outdated, delete in checker.check():
+            divergent += len(reindex) + len(delete)
+            logging.warning(f'Bucket {bucket} of {checker.index}: {len(reindex)} missing or stale, '
+                            f'{len(outdated)} outdated version(s), {len(delete)} extra document(s)')
+            if not repair:
+                continue
+            digest_store.delete(index=index_key, ids=reindex + delete)
+            if reindex:
+                backoff()(main)(table=table, ids=reindex)
+            actions = [
+                *({'_op_type': 'update', '_index': checker.index, '_id': doc_id, 'doc': {VERSION_FIELD: version}}
+                  for doc_id, version in outdated.items()),
+                *({'_op_type': 'delete', '_index': checker.index, '_id': doc_id} for doc_id in delete)
+            ]
+            if actions:
+                backoff()(helpers.bulk)(es, actions, raise_on_error=False)
+    logging.info(f'Verification of {table} is complete: {divergent} divergent document(s)'
+                 f'{", repaired" if repair and divergent else ""}')
+    return divergent
+
+
+def migrate_versions(*, table: str) -> int:
+    """
+    Функция разового переноса индекса, загруженного до появления версии документов:
+    документы без версии загружаются повторно. Их хеши предварительно удаляются,
+    иначе документы с прежним телом были бы пропущены и остались без версии
+
+    :param table: название таблицы
+    :return: количество загруженных повторно документов
+    """
+    index_key = TABLE_INDEXES[table]
+    query = {'query': {'bool': {'must_not': {'exists': {'field': VERSION_FIELD}}}}, '_source': False}
+    hits = helpers.scan(get_es_client(), index=ES_CONFIG['index_names'][index_key], query=query,
+                        size=VERIFY['scroll_size'])
+    migrated = 0
+    while ids := [hit['_id'] for _, hit in zip(range(BATCH_SIZE), hits)]:
+        digest_store.delete(index=index_key, ids=ids)
+        backoff()(main)(table=table, ids=ids)
+        migrated += len(ids)
+        logging.info(f'Versions of {table}: {migrated} document(s) reloaded')
+    logging.info(f'Migration of {table} versions is complete: {migrated} document(s) reloaded')
+    return migrated
+
+
+@backoff()
+def listen() -> None:
+    """
+    Функция событийной загрузки по уведомлениям postgresql.
+    Перед подпиской и при отсутствии уведомлений дольше LISTEN['poll_interval'] выполняется обычный опрос таблиц.
+    """
+    with ChangeListener(channel=LISTEN['channel'], max_latency=LISTEN['max_latency'],
+                        max_batch=LISTEN['max_batch']) as listener:
+        for table in tables:
+            run_table(table=table)
+        for events in listener.changes(timeout=LISTEN['poll_interval']):
+            if not events:
+                for table in tables:
+                    run_table(table=table)
+                continue
+
+            with PostgresLoader(fetch_size=BATCH_SIZE) as pg:
+                planner = ChangePlanner(pg=pg, batch_size=BATCH_SIZE, shard=shard, partial_updates=PARTIAL_UPDATES)
+                affected = planner.affected_ids(events=events)
+            for table, ids in affected.items():
+                logging.info(f'Notified {table} changes: {len(ids)}')
+                backoff()(main)(table=table, ids=ids)
+            if PARTIAL_UPDATES and any(event['table'] in ('person', 'genre') for event in events):
+                backoff()(propagate_changes)()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ETL процесс переноса данных из postgresql в elasticsearch')
+    parser.add_argument('--rebuild', choices=tables.keys(),
+                        help='полностью перестроить индекс таблицы в новой версии и переключить на нее алиас')
+    parser.add_argument('--listen', action='store_true',
+                        help='загружать изменения по уведомлениям postgresql (требует etc/notify.sql)')
+    parser.add_argument('--shard', default=SHARD['spec'], metavar='INDEX/COUNT',
+                        help='загружать только записи шарда, у каждого шарда свои файлы состояния')
+    parser.add_argument('--export', choices=tables.keys(),
+                        help='выгрузить все документы таблицы в снимок (сжатые файлы NDJSON) без загрузки')
+    parser.add_argument('--import', dest='import_', choices=tables.keys(),
+                        help='загрузить снимок таблицы без обращения к postgresql: перестроить индекс таблицы '
+                             'и сдвинуть ее состояние (только при остановленной загрузке) или, с --index, '
+                             'загрузить в указанный индекс')
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT['dir'], help='каталог снимков')
+    parser.add_argument('--index', help='индекс или алиас для --import, состояние при этом не меняется')
+    parser.add_argument('--verify', choices=tables.keys(),
+                        help='сравнить индекс таблицы с postgresql, код завершения 1 при расхождениях без --repair')
+    parser.add_argument('--repair', action='store_true',
+                        help='с --verify загрузить расходящиеся документы повторно и удалить лишние')
+    parser.add_argument('--migrate-versions', choices=tables.keys(),
+                        help='разово загрузить повторно документы индекса таблицы без версии (поле modified), '
+                             'загруженные до ее появления')
+    args = parser.parse_args()
+    if args.rebuild and args.shard:
+        parser.error('--rebuild cannot be sharded, run shards with empty state instead')
+    if args.import_ and args.shard:
+        parser.error('--import cannot be sharded, a snapshot is imported with all its shards')
+    if args.verify and args.shard:
+        parser.error('--verify cannot be sharded, it compares the whole index')
+    if args.migrate_versions and args.shard:
+        parser.error('--migrate-versions cannot be sharded, it migrates the whole index')
+    if args.repair and not args.verify:
+        parser.error('--repair is used only with --verify')
+    if args.index and not args.import_:
+        parser.error('--index is used only with --import')
+
     config.fileConfig(LOGGER_CONF_PATH)
-    state = State(storage=JsonFileStorage(file_path=STATE_FILE_PATH))
-    while True:
-        for table in tables.keys():
-            logging.info(f'Query {table} started')
-            result_state = state.get_state(key=table)
-            if result_state:
-                table_state = {k: get_format_time(time=v) for k, v in result_state.items()}
-            else:
-                table_state = tables[table].get_db_state()
-            main(table=table, table_state=table_state)
-        logging.info(f'Wait time {AWAIT_TIME}')
-        sleep(AWAIT_TIME)
+    shard = Shard.parse(spec=args.shard, lock_namespace=SHARD['lock_namespace'])
+    state = State(storage=JsonFileStorage(file_path=shard.file_path(path=STATE_FILE_PATH)))
+    digest_store = DigestStore(file_path=shard.file_path(path=DIGEST_DB_PATH))
+    try:
+        if args.rebuild:
+            rebuild(table=args.rebuild)
+        elif args.export:
+            export_snapshot(table=args.export, directory=args.snapshot_dir)
+        elif args.import_:
+            import_snapshot(table=args.import_, directory=args.snapshot_dir, index=args.index)
+        elif args.verify:
+            if verify(table=args.verify, repair=args.repair) and not args.repair:
+                raise SystemExit(1)
+        elif args.migrate_versions:
+            migrate_versions(table=args.migrate_versions)
+        else:
+            # шард и порт метрик закрепляются постоянной загрузкой, разовые команды работают рядом с ней,
+            # кроме импорта снимка, который меняет состояние таблицы
+            with shard:
+                if METRICS['port']:
+                    start_metrics_server(host=METRICS['host'], port=METRICS['port'] + shard.index)
+                if args.listen:
+                    listen()
+                else:
+                    TableScheduler(tables=tables.keys(), job=run_table, max_workers=ETL_WORKERS,
+                                   await_time=AWAIT_TIME).run()
+    finally:
+        digest_store.close()
+        close_connections()
@@ -0,0 +1,218 @@
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Generator
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+class Registry:
+    """
+    Класс реестра метрик процесса
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics: list['Metric'] = []
+
+    def register(self, metric: 'Metric') -> None:
+        with self.lock:
+            self.metrics.append(metric)
+
+    def exposition(self) -> str:
+        """
+        Метод вывода метрик в текстовом формате prometheus
+
+        :return: текст метрик
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        return ''.join(line + '\n' for metric in metrics for line in metric.collect())
+
+    def summary(self) -> dict:
+        """
+        Метод краткой сводки метрик: значения счетчиков и датчиков, количество и среднее гистограмм
+
+        :return: словарь имя метрики с метками: значение
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        return {name: value for metric in metrics for name, value in metric.summarize().items()}
+
+
+registry = Registry()
+
+
+class Metric:
+    """
+    Базовый класс метрики с набором меток
+    """
+
+    type = 'untyped'
+
+    def __init__(self, *, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values: dict[tuple, object] = {}
+        registry.register(self)
+
+    def collect(self) -> list[str]:
+        with self.lock:
+            values = dict(self.values)
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for key, value in sorted(values.items()):
+            lines += self._samples(key=key, value=value)
+        return lines
+
+    def summarize(self) -> dict:
+        with self.lock:
+            return {f'{self.name}{self._format(key=key)}': value for key, value in self.values.items()}
+
+    def _samples(self, *, key: tuple, value) -> list[str]:
+        return [f'{self.name}{self._format(key=key)} {value}']
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format(self, *, key: tuple, extra: tuple = ()) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"') for _, value in pairs)
+        return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter(Metric):
+    """
+    Класс монотонно возрастающего счетчика
+    """
+
+    type = 'counter'
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    """
+    Класс датчика, хранящего последнее установленное значение
+    """
+
+    type = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Класс гистограммы с накопительными корзинами
+    """
+
+    type = 'histogram'
+
+    def __init__(self, *, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name=name, documentation=documentation, labels=labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for n, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[n] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels) -> Generator:
+        """
+        Контекстный менеджер замера времени выполнения блока
+        """
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, **labels)
+
+    def summarize(self) -> dict:
+        with self.lock:
+            values = dict(self.values)
+        summary = {}
+        for key, (counts, total) in values.items():
+            count = counts[-1]
+            summary[f'{self.name}{self._format(key=key)}'] = {
+                'count': count,
+                'sum': round(total, 3),
+                'avg': round(total / count, 3) if count else 0.0
+            }
+        return summary
+
+    def _samples(self, *, key: tuple, value) -> list[str]:
+        counts, total = value
+        lines = []
+        for bound, count in zip(self.buckets, counts):
+            le = '+Inf' if bound == float('inf') else str(bound)
+            lines.append(f'{self.name}_bucket{self._format(key=key, extra=(("le", le),))} {count}')
+        return lines + [f'{self.name}_sum{self._format(key=key)} {total}',
+                        f'{self.name}_count{self._format(key=key)} {counts[-1]}']
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Обработчик http запросов к /metrics
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = registry.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(*, host: str, port: int) -> ThreadingHTTPServer:
+    """
+    Функция запуска http сервера метрик в фоновом потоке
+
+    :param host: адрес
+    :param port: порт
+    :return: http сервер
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f'Metrics available on http://{host}:{server.server_port}/metrics')
+    return server
+
+
+PG_FETCH_SECONDS = Histogram(name='etl_pg_fetch_seconds',
+                             documentation='Latency of a postgres query execution or server-side cursor fetch')
+TRANSFORM_SECONDS = Histogram(name='etl_transform_seconds', labels=('table',),
+                              documentation='Time spent transforming a batch of rows into bulk actions')
+BULK_SECONDS = Histogram(name='etl_bulk_seconds', documentation='Latency of an elasticsearch bulk request')
+DOCS_INDEXED = Counter(name='etl_docs_indexed_total', labels=('index',),
+                       documentation='Documents acknowledged by elasticsearch')
+DOCS_FAILED = Counter(name='etl_docs_failed_total', labels=('index',),
+                      documentation='Documents rejected by elasticsearch')
+BACKOFF_RETRIES = Counter(name='etl_backoff_retries_total', labels=('function',),
+                          documentation='Retries made by the backoff decorator')
+WATERMARK_LAG = Gauge(name='etl_watermark_lag_seconds', labels=('table', 'key'),
+                      documentation='Time between the end of the last cycle and the saved modified watermark')
+CYCLE_SECONDS = Histogram(name='etl_cycle_seconds', labels=('table',),
+                          documentation='Duration of a table ETL cycle')
@@ -0,0 +1,108 @@
+import logging
+from time import sleep
+from typing import Generator, Optional
+
+from elasticsearch import Elasticsearch
+
+from data_workers import PostgresLoader
+from etc.queries import QUERIES
+from shard import Shard
+from utils import doc_version, jitter
+
+RENAME_SCRIPT = '''
+for (entry in params.fields.entrySet()) {
+    def items = ctx._source[entry.getKey()];
+    if (items == null) {
+        continue;
+    }
+    List names = new ArrayList();
+    for (item in items) {
+        if (params.names.containsKey(item['id'])) {
+            item['name'] = params.names.get(item['id']);
+            String modified = params.modified.get(item['id']);
+            if (ctx._source.modified == null || modified.compareTo(ctx._source.modified) > 0) {
+                ctx._source.modified = modified;
+            }
+        }
+        names.add(item['name']);
+    }
+    ctx._source[entry.getValue()] = names;
+}
+'''
+
+# вложенное поле документа фильма: поле со списком имен
+RENAME_FIELDS = {
+    'person': {'actors': 'actors_names', 'writers': 'writers_names', 'director': 'directors_names'},
+    'genre': {'genre': 'genres_names'}
+}
+
+
+class RenamePropagator:
+    """
+    Класс распространения изменений персон и жанров в документы фильмов частичными обновлениями.
+    Вместо пересборки каждого фильма персоны или жанра выполняется один update_by_query на пачку измененных записей,
+    который меняет имя во вложенных объектах и пересобирает списки *_names.
+    Пачка определяется размером выборки соединения postgresql.
+    Документы, которые update_by_query пропустил из-за одновременной записи (конфликт версий), обновляются
+    повторно, состояние сдвигается только после пачки без конфликтов.
+    """
+
+    def __init__(self, *, pg: PostgresLoader, es: Elasticsearch, index: str, shard: Optional[Shard] = None,
+                 timeout: int = 3600, max_retries: int = 3, initial_backoff: float = 1):
+        self.pg = pg
+        self.es = es
+        self.index = index
+        self.shard = shard or Shard()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+
+    def propagate(self, *, state: dict) -> Generator:
+        """
+        Метод распространения изменений, найденных после времени состояния
+
+        :param state: время последнего распространенного изменения персон (person_date) и жанров (genre_date)
+        :yield: state: состояние после очередной пачки
+        """
+        state = dict(state)
+        for kind, key in (('person', 'person_date'), ('genre', 'genre_date')):
+            params = {key: state.get(key), **self.shard.params}
+            for rows in self.pg.batch_execute(query=QUERIES[f'{kind}_renames'], params=params,
+                                              name=f'{kind}_renames'):
+                self.update(kind=kind, names={row[0]: row[1] for row in rows},
+                            modified={row[0]: doc_version({key: row[2]}) for row in rows})
+                state[key] = rows[-1][2].isoformat()
+                yield state
+
+    def update(self, *, kind: str, names: dict, modified: dict) -> None:
+        """
+        Метод частичного обновления документов фильмов, в которые входят записи.
+        Версия документа сдвигается до версии записи, если запись изменена позже.
+        Скрипт только присваивает имена, поэтому при конфликтах версий запрос безопасно повторяется целиком
+
+        :param kind: person или genre
+        :param names: словарь идентификатор записи: новое имя
+        :param modified: словарь идентификатор записи: версия записи
+        """
+        fields = RENAME_FIELDS[kind]
+        body = {
+            'query': {'bool': {'should': [
+                {'nested': {'path': field, 'query': {'terms': {f'{field}.id': list(names)}}}} for field in fields
+            ]}},
+            'script': {'lang': 'painless', 'source': RENAME_SCRIPT,
+                       'params': {'names': names, 'modified': modified, 'fields': fields}}
+        }
+        for attempt in range(self.max_retries + 1):
+            response = self.es.update_by_query(index=self.index, body=body, conflicts='proceed', slices='auto',
+                                               request_timeout=self.timeout)
+            logging.info(f'Propagated {len(names)} {kind} change(s) to {response.get("updated", 0)} document(s)')
+            if failures := response.get('failures'):
+                raise RuntimeError(f'Partial update of {self.index} failed: {failures[:3]}')
+            if not (conflicts := response.get('version_conflicts', 0)):
+                return
+            if attempt < self.max_retries:
+                logging.warning(f'Partial update of {self.index} skipped {conflicts} document(s) changed '
+                                f'concurrently, retry {attempt + 1}')
+                sleep(jitter(self.initial_backoff * 2 ** attempt))
+        raise RuntimeError(f'Partial update of {self.index} kept conflicting with concurrent writes '
+                           f'on {conflicts} document(s)')
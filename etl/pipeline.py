@@ -0,0 +1,176 @@
+import logging
+import threading
+from queue import Empty, Full, Queue
+from time import monotonic
+from typing import Any, Callable, Generator, Iterable, Optional
+
+from budget import MemoryBudget
+
+_DONE = object()
+
+
+class StageError:
+    """
+    Обертка исключения, возникшего в потоке этапа, для передачи потребителю
+    """
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class StageStats:
+    """
+    Класс статистики этапа конвейера: количество элементов, пропускная способность и глубина очереди
+    """
+
+    def __init__(self, *, name: str, queue: Optional[Queue] = None):
+        self.name = name
+        self.queue = queue
+        self.items = 0
+        self.max_depth = 0
+        self.started = monotonic()
+        self.finished = None
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    @property
+    def throughput(self) -> float:
+        elapsed = (self.finished or monotonic()) - self.started
+        return self.items / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'stage': self.name,
+            'items': self.items,
+            'throughput': round(self.throughput, 1),
+            'queue_depth': self.depth,
+            'max_queue_depth': self.max_depth
+        }
+
+
+class StagedPipeline:
+    """
+    Класс конвейера, в котором каждый этап выполняется в отдельном потоке.
+    Этапы связаны ограниченными очередями, поэтому быстрый этап ждет медленный (backpressure),
+    а общее время работы определяется самым медленным этапом, а не суммой всех этапов.
+    Очереди ограничены количеством пачек, а с бюджетом памяти этап с weigh дополнительно резервирует
+    каждый элемент и ждет, пока загрузка не освободит место.
+    """
+
+    def __init__(self, *, queue_size: int, batch_size: int, budget: Optional[MemoryBudget] = None):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.budget = budget
+        self.stats: list[StageStats] = []
+
+    def stage(self, *, name: str, data: Iterable,
+              weigh: Optional[Callable[[Any], tuple[str, int]]] = None) -> Generator:
+        """
+        Метод запуска итерации по data в отдельном потоке
+
+        :param name: название этапа
+        :param data: итерируемый источник этапа
+        :param weigh: функция получения идентификатора и размера элемента для резервирования в бюджете памяти
+        :return: генератор, читающий результаты этапа из ограниченной очереди
+        """
+        queue = Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        stats = StageStats(name=name, queue=queue)
+        self.stats.append(stats)
+        worker = threading.Thread(target=self._produce, kwargs={'data': data, 'queue': queue, 'stop': stop,
+                                                                'stats': stats, 'weigh': weigh},
+                                  name=f'stage-{name}', daemon=True)
+        worker.start()
+        budget = self.budget if weigh is not None else None
+        return self._consume(queue=queue, stop=stop, worker=worker, budget=budget)
+
+    def measure(self, *, name: str, data: Iterable) -> Generator:
+        """
+        Метод подсчета элементов этапа, выполняемого в текущем потоке
+
+        :param name: название этапа
+        :param data: итерируемый источник этапа
+        :yield: item: элемент источника
+        """
+        stats = StageStats(name=name)
+        self.stats.append(stats)
+        try:
+            for item in data:
+                stats.items += 1
+                yield item
+        finally:
+            stats.finished = monotonic()
+
+    def log_stats(self) -> None:
+        for stats in self.stats:
+            logging.info(f'Pipeline stage: {stats.as_dict()}')
+
+    def _produce(self, *, data: Iterable, queue: Queue, stop: threading.Event, stats: StageStats,
+                 weigh: Optional[Callable[[Any], tuple[str, int]]] = None) -> None:
+        batch = []
+        budget = self.budget if weigh is not None else None
+        try:
+            for item in data:
+                if budget is not None:
+                    doc_id, size = weigh(item)
+                    # неполная пачка отдается до ожидания, иначе ее элементы держали бы бюджет
+                    if batch and budget.exhausted(size=size):
+                        if not self._put(queue=queue, item=batch, stop=stop, stats=stats):
+                            return
+                        batch = []
+                    budget.reserve(doc_id=doc_id, size=size)
+                batch.append(item)
+                stats.items += 1
+                if len(batch) >= self.batch_size:
+                    if not self._put(queue=queue, item=batch, stop=stop, stats=stats):
+                        return
+                    batch = []
+            if batch and not self._put(queue=queue, item=batch, stop=stop, stats=stats):
+                return
+            self._put(queue=queue, item=_DONE, stop=stop, stats=stats)
+        except BaseException as e:
+            # уже полученные элементы отдаются до ошибки, как и успешные документы bulk запроса
+            if batch and not self._put(queue=queue, item=batch, stop=stop, stats=stats):
+                return
+            self._put(queue=queue, item=StageError(e), stop=stop, stats=stats)
+        finally:
+            stats.finished = monotonic()
+            if close := getattr(data, 'close', None):
+                close()
+
+    @staticmethod
+    def _put(*, queue: Queue, item: Any, stop: threading.Event, stats: StageStats) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            stats.max_depth = max(stats.max_depth, queue.qsize())
+            return True
+        return False
+
+    @staticmethod
+    def _consume(*, queue: Queue, stop: threading.Event, worker: threading.Thread,
+                 budget: Optional[MemoryBudget] = None) -> Generator:
+        try:
+            while True:
+                try:
+                    batch = queue.get(timeout=0.1)
+                except Empty:
+                    if budget is not None:
+                        budget.starving()
+                    if not worker.is_alive() and queue.empty():
+                        return
+                    continue
+                if budget is not None:
+                    budget.fed()
+                if batch is _DONE:
+                    return
+                if isinstance(batch, StageError):
+                    raise batch.error
+                yield from batch
+        finally:
+            stop.set()
+            worker.join()
@@ -0,0 +1,140 @@
+import logging
+from typing import AsyncGenerator, Generator, Optional
+
+from data_workers import PostgresLoader
+from etc.queries import QUERIES
+from shard import Shard
+
+
+class _IdBatcher:
+    """
+    Группировка строк поиска изменений в пачки уникальных идентификаторов, общая для синхронного
+    и асинхронного поиска. Позиция пачки указывает на ее последнюю строку, включая отброшенные повторы
+    """
+
+    def __init__(self, *, batch_size: int):
+        self.batch_size = batch_size
+        self.seen = set()
+        self.batch = []
+        self.position = None
+
+    def add(self, *, branch: int, rows: list) -> Generator:
+        """
+        Метод добавления строк ветки поиска изменений
+
+        :param branch: номер ветки QUERIES['*_ids']
+        :param rows: строки target_id, modified, source_id
+        :yield: ids, cursor: заполненная пачка идентификаторов и позиция после ее последней строки
+        """
+        for target_id, modified, source_id in rows:
+            self.position = {'branch': branch, 'modified': modified.isoformat(), 'id': source_id}
+            if target_id in self.seen:
+                continue
+            self.seen.add(target_id)
+            self.batch.append(target_id)
+            if len(self.batch) >= self.batch_size:
+                yield self.batch, self.position
+                self.batch = []
+
+    def rest(self) -> Generator:
+        """
+        Метод получения последней неполной пачки
+
+        :yield: ids, cursor: пачка идентификаторов и позиция после последней строки
+        """
+        if self.batch:
+            yield self.batch, self.position
+
+
+class ChangePlanner:
+    """
+    Класс планирования инкрементальной загрузки.
+    Измененные строки ищутся отдельным запросом по каждой базовой таблице (индексируемый диапазон по modified),
+    затем через таблицы связей находятся затронутые идентификаторы и отбрасываются повторы,
+    прежде чем идентификаторы попадут в запрос обогащения.
+    При шардированной загрузке ищутся только идентификаторы, принадлежащие шарду.
+    При частичных обновлениях фильмы пересобираются только по изменениям самих фильмов и связей,
+    изменения персон и жанров распространяются partial.RenamePropagator.
+    """
+
+    # ветки QUERIES['*_ids'], которые не нужны при частичных обновлениях
+    partial_skipped_branches = {'filmwork': (1, 2)}
+
+    def __init__(self, *, pg: PostgresLoader, batch_size: int, shard: Optional[Shard] = None,
+                 partial_updates: bool = False):
+        self.pg = pg
+        self.batch_size = batch_size
+        self.shard = shard or Shard()
+        self.partial_updates = partial_updates
+
+    def changed_ids(self, *, table: str, table_state: dict, cursor: Optional[dict] = None) -> Generator:
+        """
+        Метод получения идентификаторов измененных записей таблицы
+
+        :param table: название таблицы
+        :param table_state: состояние загрузки последней таблицы
+        :param cursor: позиция, с которой нужно продолжить прерванную загрузку
+        :yield: ids, cursor: группа уникальных идентификаторов и позиция после ее последней строки
+        """
+        batcher = _IdBatcher(batch_size=self.batch_size)
+        for n, query, params in self._branches(table=table, table_state=table_state, cursor=cursor):
+            for rows in self.pg.batch_execute(query=query, params=params, name=f'{table}_ids_{n}'):
+                yield from batcher.add(branch=n, rows=rows)
+        yield from batcher.rest()
+        logging.info(f'Changes planned for {table}: {len(batcher.seen)}')
+
+    async def changed_ids_async(self, *, table: str, table_state: dict,
+                                cursor: Optional[dict] = None) -> AsyncGenerator:
+        """
+        Асинхронный вариант changed_ids для загрузчика с асинхронным batch_execute
+        """
+        batcher = _IdBatcher(batch_size=self.batch_size)
+        for n, query, params in self._branches(table=table, table_state=table_state, cursor=cursor):
+            async for rows in self.pg.batch_execute(query=query, params=params, name=f'{table}_ids_{n}'):
+                for item in batcher.add(branch=n, rows=rows):
+                    yield item
+        for item in batcher.rest():
+            yield item
+        logging.info(f'Changes planned for {table}: {len(batcher.seen)}')
+
+    def affected_ids(self, *, events: list[dict]) -> dict:
+        """
+        Метод получения идентификаторов записей, затронутых уведомлениями об изменениях
+
+        :param events: уведомления об изменениях строк базовых таблиц и таблиц связей
+        :return: словарь название таблицы: список уникальных идентификаторов
+        """
+        changed = {table: set() for table in ('film_work', 'person', 'genre')}
+        affected = {'filmwork': set(), 'person': set(), 'genre': set()}
+        for event in events:
+            if event['table'] in changed:
+                changed[event['table']].add(event['id'])
+            if event['table'] in ('person_film_work', 'genre_film_work'):
+                affected['filmwork'].add(event['film_work_id'])
+            if event['table'] == 'person_film_work':
+                affected['person'].add(event['person_id'])
+
+        affected['filmwork'] |= changed['film_work']
+        affected['person'] |= changed['person']
+        affected['genre'] |= changed['genre']
+        fan_out = (
+            ('filmwork', 'filmwork_by_person', set() if self.partial_updates else changed['person']),
+            ('filmwork', 'filmwork_by_genre', set() if self.partial_updates else changed['genre']),
+            ('person', 'person_by_filmwork', changed['film_work'])
+        )
+        for table, query, ids in fan_out:
+            if not ids:
+                continue
+            for rows in self.pg.batch_execute(query=QUERIES[query], params={'ids': list(ids)}):
+                affected[table].update(row[0] for row in rows)
+        owned = {table: [doc_id for doc_id in ids if self.shard.owns(doc_id=doc_id)] for table, ids in affected.items()}
+        return {table: ids for table, ids in owned.items() if ids}
+
+    def _branches(self, *, table: str, table_state: dict, cursor: Optional[dict] = None) -> Generator:
+        skipped = self.partial_skipped_branches.get(table, ()) if self.partial_updates else ()
+        for n, query in enumerate(QUERIES[f'{table}_ids']):
+            if (cursor and n < cursor['branch']) or n in skipped:
+                continue
+            resume = cursor if cursor and n == cursor['branch'] else {}
+            yield n, query, {**table_state, **self.shard.params, 'cursor_modified': resume.get('modified'),
+                             'cursor_id': resume.get('id')}
@@ -0,0 +1,79 @@
+import threading
+from collections import defaultdict, deque
+from datetime import datetime
+from typing import Optional
+
+from utils import latest_datetime
+
+
+class Progress:
+    """
+    Класс учета подтвержденных elasticsearch документов одного запуска.
+    Документы нумеруются в порядке извлечения, позиция возобновления загрузки и время последнего изменения
+    продвигаются только по непрерывному префиксу подтвержденных документов, поэтому подтверждения могут приходить
+    в любом порядке, а неподтвержденный документ задерживает их до следующего запуска.
+    """
+
+    def __init__(self, *, watermark: Optional[dict] = None):
+        self.lock = threading.Lock()
+        self.next_seq = 0
+        self.prefix = 0
+        self.pending: dict[str, deque] = defaultdict(deque)
+        self.acked: set[int] = set()
+        self.cursors: dict[int, dict] = {}
+        self.times: dict[int, dict] = {}
+        self.cursor: Optional[dict] = None
+        self.watermark = {k: datetime.fromisoformat(v) if isinstance(v, str) else v
+                          for k, v in (watermark or {}).items()}
+
+    @property
+    def complete(self) -> bool:
+        """
+        Все ли зарегистрированные документы подтверждены
+        """
+        with self.lock:
+            return self.prefix == self.next_seq
+
+    def get_state(self) -> dict:
+        """
+        Метод получения времени последнего изменения подтвержденных документов для сохранения в состояние
+
+        :return: словарь ключ состояния: время в формате iso
+        """
+        with self.lock:
+            return {k: v.isoformat() if v else None for k, v in self.watermark.items()}
+
+    def register(self, *, doc_id: str, times: dict, cursor: Optional[dict] = None) -> None:
+        """
+        Метод регистрации извлеченного документа
+
+        :param doc_id: идентификатор документа
+        :param times: время последнего изменения документа по ключам состояния таблицы
+        :param cursor: позиция извлечения, если документ завершает группу извлечения
+        """
+        with self.lock:
+            self.pending[doc_id].append(self.next_seq)
+            self.times[self.next_seq] = times
+            if cursor:
+                self.cursors[self.next_seq] = cursor
+            self.next_seq += 1
+
+    def ack(self, *, doc_id: str) -> None:
+        """
+        Метод подтверждения загрузки документа или его пропуска как неизменившегося
+
+        :param doc_id: идентификатор документа
+        """
+        with self.lock:
+            if not (seqs := self.pending.get(doc_id)):
+                return
+            self.acked.add(seqs.popleft())
+            if not seqs:
+                del self.pending[doc_id]
+            while self.prefix in self.acked:
+                self.acked.remove(self.prefix)
+                for key, time in self.times.pop(self.prefix).items():
+                    self.watermark[key] = latest_datetime(current=self.watermark.get(key), obj_time=time)
+                if self.prefix in self.cursors:
+                    self.cursor = self.cursors.pop(self.prefix)
+                self.prefix += 1
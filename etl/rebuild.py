@@ -0,0 +1,83 @@
+import logging
+import re
+
+from elasticsearch import Elasticsearch
+
+from data_workers import ElasticsearchLoader
+from etc.config import REBUILD
+
+
+class IndexRebuilder:
+    """
+    Класс полной перестройки индекса без простоя.
+    Данные загружаются в новую версию индекса (например movies_v2) с отключенными refresh и репликами,
+    после загрузки настройки восстанавливаются, индекс сливается в один сегмент,
+    а алиас атомарно переключается на новую версию.
+    """
+
+    def __init__(self, *, es: Elasticsearch, alias: str, settings_path: str):
+        self.es = es
+        self.alias = alias
+        self.settings = ElasticsearchLoader.load_settings(settings_path)
+        self.index = None
+
+    def __enter__(self) -> str:
+        self.index = f'{self.alias}_v{self.latest_version() + 1}'
+        body = {**self.settings, 'settings': {**self.settings.get('settings', {}),
+                                              'refresh_interval': '-1', 'number_of_replicas': 0}}
+        self.es.indices.create(index=self.index, body=body)
+        logging.info(f'Elasticsearch index {self.index} created for rebuild of {self.alias}')
+        return self.index
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is not None:
+            logging.error(f'Rebuild of {self.alias} failed, index {self.index} deleted')
+            self.es.indices.delete(index=self.index, ignore_unavailable=True)
+            return
+
+        settings = self.settings.get('settings', {})
+        self.es.indices.put_settings(index=self.index, body={'index': {
+            'refresh_interval': settings.get('refresh_interval'),
+            'number_of_replicas': settings.get('number_of_replicas')
+        }})
+        self.es.indices.refresh(index=self.index)
+        self.es.indices.forcemerge(index=self.index, max_num_segments=1, request_timeout=REBUILD['timeout'])
+        self.es.cluster.health(index=self.index, wait_for_status='yellow', request_timeout=REBUILD['timeout'])
+        self.swap_alias()
+
+    def latest_version(self) -> int:
+        """
+        Метод поиска последней версии индекса
+
+        :return: номер последней версии, 0 если версий нет
+        """
+        return max(self.versions().values(), default=0)
+
+    def versions(self) -> dict:
+        """
+        Метод получения версий индекса
+
+        :return: словарь название индекса: номер версии
+        """
+        pattern = re.compile(rf'^{re.escape(self.alias)}_v(\d+)$')
+        return {index: int(match.group(1)) for index in self.es.indices.get_alias(index=f'{self.alias}_v*')
+                if (match := pattern.match(index))}
+
+    def swap_alias(self) -> None:
+        """
+        Метод атомарного переключения алиаса на новую версию индекса и удаления устаревших версий
+        """
+        actions = []
+        if self.es.indices.exists_alias(name=self.alias):
+            actions += [{'remove': {'index': index, 'alias': self.alias}}
+                        for index in self.es.indices.get_alias(name=self.alias)]
+        elif self.es.indices.exists(index=self.alias):
+            actions.append({'remove_index': {'index': self.alias}})
+        actions.append({'add': {'index': self.index, 'alias': self.alias}})
+        self.es.indices.update_aliases(body={'actions': actions})
+        logging.info(f'Elasticsearch alias {self.alias} moved to {self.index}')
+
+        outdated = sorted(self.versions().items(), key=lambda item: item[1], reverse=True)[REBUILD['keep_versions']:]
+        for index, _ in outdated:
+            self.es.indices.delete(index=index, ignore_unavailable=True)
+            logging.info(f'Elasticsearch index {index} deleted')
@@ -0,0 +1,48 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from time import monotonic, sleep
+from typing import Callable, Iterable
+
+
+class TableScheduler:
+    """
+    Класс для параллельного запуска ETL процесса по таблицам.
+    Каждая таблица запускается в отдельном потоке не чаще, чем раз в await_time секунд,
+    одновременно выполняется не более max_workers таблиц.
+    """
+
+    def __init__(self, *, tables: Iterable[str], job: Callable[..., None], max_workers: int, await_time: int):
+        self.tables = list(tables)
+        self.job = job
+        self.max_workers = max_workers
+        self.await_time = await_time
+
+    def run(self) -> None:
+        """
+        Метод бесконечного цикла планирования запусков таблиц
+        """
+        schedule = {table: monotonic() for table in self.tables}
+        running: dict[Future, str] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='etl') as executor:
+            while True:
+                now = monotonic()
+                for table, due in sorted(schedule.items(), key=lambda item: item[1]):
+                    if due > now or len(running) >= self.max_workers:
+                        break
+                    del schedule[table]
+                    running[executor.submit(self.job, table=table)] = table
+
+                timeout = None
+                if schedule and len(running) < self.max_workers:
+                    timeout = max(min(schedule.values()) - now, 0)
+                if not running:
+                    sleep(timeout)
+                    continue
+
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    table = running.pop(future)
+                    if exc := future.exception():
+                        logging.error(f'Table {table} failed: {exc}')
+                    logging.info(f'Table {table} wait time {self.await_time}')
+                    schedule[table] = monotonic() + self.await_time
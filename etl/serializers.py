@@ -0,0 +1,96 @@
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Optional
+from uuid import UUID
+
+from elasticsearch import JSONSerializer
+from elasticsearch.helpers import expand_action
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BulkPair = tuple[bytes, Optional[bytes]]
+# ключ действия bulk запроса с уже сериализованным телом документа, elasticsearch-py его не читает
+SERIALIZED_SOURCE = '_serialized_source'
+
+
+def default(data: Any) -> Any:
+    """
+    Функция сериализации типов, которые не поддерживаются json
+
+    :param data: сериализуемый объект
+    :return: объект, поддерживаемый json
+    """
+    if isinstance(data, (date, datetime)):
+        return data.isoformat()
+    if isinstance(data, UUID):
+        return str(data)
+    if isinstance(data, Decimal):
+        return float(data)
+    raise TypeError(f'Unable to serialize {data!r} (type: {type(data)})')
+
+
+def dumps(data: Any) -> bytes:
+    """
+    Функция сериализации в json, использует orjson, если он установлен
+
+    :param data: сериализуемый объект
+    :return: json в кодировке utf-8
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=default)
+    return json.dumps(data, default=default, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def serialized_source(action: dict) -> bytes:
+    """
+    Функция сериализации тела документа действия bulk запроса. Результат сохраняется в действии,
+    поэтому документ, размер которого понадобился до отправки, не сериализуется повторно
+
+    :param action: документ в формате bulk запроса
+    :return: json тела документа
+    """
+    if (source := action.get(SERIALIZED_SOURCE)) is None:
+        source = action[SERIALIZED_SOURCE] = dumps(action['_source'])
+    return source
+
+
+def bulk_pair(data: dict) -> BulkPair:
+    """
+    Функция сериализации документа в строки NDJSON bulk запроса
+
+    :param data: документ в формате bulk запроса
+    :return: строка действия и строка документа, завершенные переводом строки
+    """
+    action, source = expand_action(data)
+    if source is None:
+        return dumps(action) + b'\n', None
+    return dumps(action) + b'\n', (data.get(SERIALIZED_SOURCE) or dumps(source)) + b'\n'
+
+
+def expand_serialized(data: dict) -> tuple:
+    """
+    Функция разбора документа для helpers.streaming_bulk (expand_action_callback):
+    уже сериализованное тело документа передается строкой, которую сериализатор клиента не меняет
+
+    :param data: документ в формате bulk запроса
+    :return: действие и тело документа
+    """
+    action, source = expand_action(data)
+    if (serialized := data.get(SERIALIZED_SOURCE)) is not None:
+        source = serialized.decode()
+    return action, source
+
+
+class FastJSONSerializer(JSONSerializer):
+    """
+    Сериализатор клиента elasticsearch на основе orjson, если он установлен
+    """
+
+    def dumps(self, data: Any) -> str:
+        if isinstance(data, (str, bytes)):
+            return data
+        return dumps(data).decode()
@@ -0,0 +1,143 @@
+import logging
+import os
+from math import gcd
+
+import psycopg2
+
+from etc.config import DSL
+from etc.queries import QUERIES
+from utils import backoff
+
+# наибольшее количество шардов, определяет ключи advisory lock
+MAX_COUNT = 1024
+
+
+class Shard:
+    """
+    Класс диапазона идентификаторов, которым владеет процесс при шардированной загрузке.
+    Запись принадлежит шарду index из count по последним 32 битам uuid (одинаково в postgresql и python),
+    у каждого шарда свои файлы состояния и хешей документов, владение закрепляется advisory lock в postgresql.
+    Ключ блокировки кодирует раскладку шарда, поэтому процессы одной раскладки блокируют разные ключи,
+    а пересечение с шардами другой раскладки (например 0/2 и 0/4) проверяется по блокировкам других процессов.
+    """
+
+    def __init__(self, *, index: int = 0, count: int = 1, lock_namespace: int = 0):
+        if not 0 < count <= MAX_COUNT:
+            raise ValueError(f'Shard count {count} is out of range 1..{MAX_COUNT}')
+        if not 0 <= index < count:
+            raise ValueError(f'Shard index {index} is out of range 0..{count - 1}')
+        self.index = index
+        self.count = count
+        self.lock_namespace = lock_namespace
+        self.connection = None
+
+    @classmethod
+    def parse(cls, *, spec: str | None, lock_namespace: int = 0) -> 'Shard':
+        """
+        Метод создания шарда из строки вида index/count
+
+        :param spec: строка шарда, без нее процесс владеет всеми записями
+        :param lock_namespace: первый ключ advisory lock
+        :return: шард
+        """
+        if not spec:
+            return cls(lock_namespace=lock_namespace)
+        index, count = spec.split('/')
+        return cls(index=int(index), count=int(count), lock_namespace=lock_namespace)
+
+    @classmethod
+    def from_lock_key(cls, key: int) -> 'Shard':
+        """
+        Метод создания шарда по ключу его блокировки
+
+        :param key: второй ключ advisory lock
+        :return: шард
+        """
+        count, index = divmod(key, MAX_COUNT)
+        return cls(index=index, count=count)
+
+    def __str__(self):
+        return f'{self.index}/{self.count}'
+
+    def __enter__(self):
+        self.acquire()
+        logging.info(f'Shard {self} acquired')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+            logging.info(f'Shard {self} released')
+
+    @property
+    def lock_key(self) -> int:
+        """
+        Второй ключ advisory lock шарда
+        """
+        return self.count * MAX_COUNT + self.index
+
+    @backoff()
+    def acquire(self) -> None:
+        """
+        Метод закрепления шарда за процессом: блокировка держится, пока открыто соединение.
+        После блокировки своего ключа проверяются блокировки других процессов: если два процесса одновременно
+        закрепляют пересекающиеся шарды, каждый видит блокировку другого и оба отказываются
+        """
+        connection = psycopg2.connect(**DSL)
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(QUERIES['shard_lock'], {'namespace': self.lock_namespace, 'key': self.lock_key})
+                if not cursor.fetchone()[0]:
+                    raise RuntimeError(f'Shard {self} is already owned by another process')
+                cursor.execute(QUERIES['shard_owners'], {'namespace': self.lock_namespace})
+                owners = [self.from_lock_key(key) for key, in cursor.fetchall()]
+            if overlapping := [str(owner) for owner in owners if self.overlaps(owner)]:
+                raise RuntimeError(f'Shard {self} overlaps shard(s) {", ".join(overlapping)} owned by other processes')
+        except BaseException:
+            connection.close()
+            raise
+        self.connection = connection
+
+    def overlaps(self, other: 'Shard') -> bool:
+        """
+        Метод проверки пересечения диапазонов шардов разных раскладок:
+        значение x с x mod count = index и x mod other.count = other.index существует (китайская теорема об остатках),
+        только если index и other.index совпадают по модулю НОД количеств шардов
+
+        :param other: другой шард
+        :return: есть ли записи, которые принадлежат обоим шардам
+        """
+        common = gcd(self.count, other.count)
+        return self.index % common == other.index % common
+
+    @property
+    def params(self) -> dict:
+        """
+        Параметры sql запросов поиска изменений, для единственного шарда фильтр отключен
+        """
+        if self.count == 1:
+            return {'shard': None, 'shard_count': None}
+        return {'shard': self.index, 'shard_count': self.count}
+
+    def owns(self, *, doc_id: str) -> bool:
+        """
+        Метод проверки принадлежности записи шарду
+
+        :param doc_id: uuid записи
+        :return: принадлежит ли запись шарду
+        """
+        return self.count == 1 or int(doc_id[-8:], 16) % self.count == self.index
+
+    def file_path(self, *, path: str) -> str:
+        """
+        Метод получения пути файла шарда
+
+        :param path: путь файла без шардирования
+        :return: путь файла шарда, для единственного шарда не меняется
+        """
+        if self.count == 1:
+            return path
+        root, ext = os.path.splitext(path)
+        return f'{root}.{self.index}of{self.count}{ext}'
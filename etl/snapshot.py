@@ -0,0 +1,153 @@
+import glob
+import gzip
+import json
+import logging
+import mmap
+import os
+from datetime import datetime, timezone
+from typing import Generator, Iterable, Optional
+
+from progress import Progress
+from serializers import BulkPair, bulk_pair
+from shard import Shard
+
+
+class SnapshotWriter:
+    """
+    Класс выгрузки преобразованных документов таблицы в сжатые файлы NDJSON формата bulk запроса.
+    Документы пишутся потоково, файл закрывается после docs_per_file документов, поэтому память не растет
+    с размером таблицы. Строки действий не содержат индекса: он задается при загрузке, что позволяет загружать
+    снимок в любую версию индекса или кластер. Описание снимка (manifest) со временем последнего изменения
+    выгруженных документов пишется последним, снимок без него считается незавершенным.
+    """
+
+    def __init__(self, *, directory: str, table: str, shard: Optional[Shard] = None, docs_per_file: int = 100000,
+                 compresslevel: int = 6):
+        self.directory = directory
+        self.table = table
+        self.shard = shard or Shard()
+        self.prefix = self.shard.file_path(path=table)
+        self.docs_per_file = docs_per_file
+        self.compresslevel = compresslevel
+        self.files: list[dict] = []
+
+    def write(self, *, data: Iterable[dict], progress: Progress) -> dict:
+        """
+        Метод выгрузки документов
+
+        :param data: документы в формате bulk запроса
+        :param progress: учет документов запуска, документ подтверждается после записи в файл
+        :return: описание снимка
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        for path in glob.glob(os.path.join(self.directory, f'{glob.escape(self.prefix)}-*.ndjson.gz')):
+            os.remove(path)
+        manifest_path = os.path.join(self.directory, f'{self.prefix}.manifest.json')
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        file, docs = None, 0
+        try:
+            for action in data:
+                if file is None:
+                    file = self._open()
+                action = dict(action)
+                action.pop('_index', None)
+                file.write(b''.join(line for line in bulk_pair(action) if line is not None))
+                progress.ack(doc_id=action['_id'])
+                docs += 1
+                if docs == self.docs_per_file:
+                    self._close(file=file, docs=docs)
+                    file, docs = None, 0
+            if file is not None:
+                self._close(file=file, docs=docs)
+                file = None
+        finally:
+            if file is not None:
+                file.close()
+
+        manifest = {
+            'table': self.table,
+            'shard': {'index': self.shard.index, 'count': self.shard.count},
+            'created': datetime.now(timezone.utc).isoformat(),
+            'watermark': progress.get_state(),
+            'files': self.files
+        }
+        with open(f'{manifest_path}.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(f'{manifest_path}.tmp', manifest_path)
+        logging.info(f'Snapshot of {self.table} written to {self.directory}: '
+                     f'{sum(file["docs"] for file in self.files)} document(s) in {len(self.files)} file(s)')
+        return manifest
+
+    def _open(self) -> gzip.GzipFile:
+        name = f'{self.prefix}-{len(self.files):05d}.ndjson.gz'
+        return gzip.open(os.path.join(self.directory, f'{name}.tmp'), 'wb', compresslevel=self.compresslevel)
+
+    def _close(self, *, file: gzip.GzipFile, docs: int) -> None:
+        file.close()
+        path = file.name[:-len('.tmp')]
+        os.replace(file.name, path)
+        self.files.append({'name': os.path.basename(path), 'docs': docs, 'bytes': os.path.getsize(path)})
+
+
+class SnapshotReader:
+    """
+    Класс чтения снимка таблицы. Снимок может состоять из выгрузок нескольких шардов,
+    он считается полным, только если в каталоге есть описания всех шардов.
+    """
+
+    def __init__(self, *, directory: str, table: str):
+        self.directory = directory
+        self.table = table
+        self.manifests = self._load_manifests()
+
+    def _load_manifests(self) -> list[dict]:
+        paths = glob.glob(os.path.join(self.directory, f'{glob.escape(self.table)}*.manifest.json'))
+        manifests = []
+        for path in sorted(paths):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest['table'] == self.table:
+                manifests.append(manifest)
+        if not manifests:
+            raise FileNotFoundError(f'No snapshot of {self.table} in {self.directory}')
+        counts = {manifest['shard']['count'] for manifest in manifests}
+        indexes = {manifest['shard']['index'] for manifest in manifests}
+        if len(counts) != 1 or indexes != set(range(counts.pop())):
+            raise ValueError(f'Snapshot of {self.table} in {self.directory} is incomplete: shards {sorted(indexes)}')
+        return manifests
+
+    @property
+    def docs(self) -> int:
+        """
+        Количество документов снимка
+        """
+        return sum(file['docs'] for manifest in self.manifests for file in manifest['files'])
+
+    @property
+    def watermark(self) -> dict:
+        """
+        Время последнего изменения документов снимка: для нескольких шардов берется наименьшее,
+        чтобы после загрузки снимка обычный запуск не пропустил изменения ни одного из шардов
+        """
+        keys = {key for manifest in self.manifests for key in manifest['watermark']}
+        watermark = {}
+        for key in keys:
+            values = [manifest['watermark'].get(key) for manifest in self.manifests]
+            watermark[key] = None if None in values else min(values, key=datetime.fromisoformat)
+        return watermark
+
+    def pairs(self) -> Generator[BulkPair, None, None]:
+        """
+        Метод чтения документов снимка. Файлы отображаются в память и распаковываются потоково
+
+        :yield: строка действия и строка документа bulk запроса
+        """
+        for manifest in self.manifests:
+            for file in manifest['files']:
+                with open(os.path.join(self.directory, file['name']), 'rb') as f, \
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                        gzip.GzipFile(fileobj=mm, mode='rb') as lines:
+                    for action in lines:
+                        yield action, next(lines)
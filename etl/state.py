@@ -2,6 +2,7 @@ import abc
 import json
 import logging
 import os
+import threading
 from typing import Any, Optional
 
 
@@ -18,6 +19,8 @@ class BaseStorage:
 class JsonFileStorage(BaseStorage):
     """
     Класс для хранения состояния в файле.
+    Файл перезаписывается атомарно: состояние пишется во временный файл, сбрасывается на диск
+    и подменяет старый файл, поэтому падение во время записи не портит сохраненное состояние.
     """
 
     def __init__(self, *, file_path: Optional[str] = None):
@@ -34,8 +37,18 @@ class JsonFileStorage(BaseStorage):
         return state
 
     def save_state(self, *, state: dict) -> None:
-        with open(self.file_path, 'w') as file:
+        # временный файл свой у каждого процесса, чтобы разовые команды не писали в файл постоянной загрузки
+        tmp_path = f'{self.file_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as file:
             file.write(json.dumps(state))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.file_path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.file_path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
         logging.debug(f'State: {state} saved')
 
 
@@ -44,16 +57,23 @@ class State:
     Класс для хранения состояния при работе с данными, чтобы постоянно не перечитывать данные с начала.
     Здесь представлена реализация с сохранением состояния в файл.
     В целом ничего не мешает поменять это поведение на работу с БД или распределённым хранилищем.
+    Состояние читается из хранилища один раз и дальше хранится в памяти.
     """
 
     def __init__(self, *, storage: BaseStorage):
         self.storage = storage
+        self.lock = threading.Lock()
+        self.state = storage.retrieve_state()
 
     def set_state(self, *, key: str, value: Any) -> None:
-        state = self.storage.retrieve_state()
-        state[key] = value
-        logging.debug(f'State query: {key}: {value} set')
-        self.storage.save_state(state=state)
+        self.update_state(values={key: value})
+
+    def update_state(self, *, values: dict) -> None:
+        with self.lock:
+            self.state.update(values)
+            logging.debug(f'State query: {values} set')
+            self.storage.save_state(state=self.state)
 
     def get_state(self, *, key: str) -> Any:
-        return self.storage.retrieve_state().get(key)
+        with self.lock:
+            return self.state.get(key)
@@ -0,0 +1,160 @@
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+from budget import MemoryBudget
+from bulk import dead_letter
+from digests import DigestFilter, DigestStore
+from etc.config import METRICS
+from metrics import DOCS_FAILED, DOCS_INDEXED, WATERMARK_LAG, registry
+from progress import Progress
+from state import State
+
+
+def resume_point(*, state: State, table: str, state_keys: tuple) -> tuple[dict, Optional[dict], Optional[dict]]:
+    """
+    Функция получения состояния таблицы и позиции, с которой нужно продолжить прерванную загрузку
+
+    :param state: состояние процесса
+    :param table: название таблицы
+    :param state_keys: ключи состояния таблицы
+    :return: table_state, cursor, watermark: состояние таблицы, позиция извлечения и время последнего изменения
+        документов, подтвержденных до прерывания загрузки
+    """
+    table_state = state.get_state(key=table) or dict.fromkeys(state_keys)
+    checkpoint = state.get_state(key=f'{table}_checkpoint') or {}
+    if checkpoint:
+        logging.info(f'Query {table} resumed from {checkpoint["cursor"]}')
+    return table_state, checkpoint.get('cursor'), checkpoint.get('watermark')
+
+
+def rejected_ids(*, state: State, table: str) -> list:
+    """
+    Функция получения документов таблицы, отклоненных elasticsearch в предыдущих запусках,
+    следующий запуск извлекает их повторно после изменений
+
+    :param state: состояние процесса
+    :param table: название таблицы
+    :return: идентификаторы отклоненных документов
+    """
+    return state.get_state(key=f'{table}_rejected') or []
+
+
+def report_lag(*, state: State, table: str) -> None:
+    """
+    Функция обновления отставания сохраненного состояния таблицы от текущего времени после запуска
+
+    :param state: состояние процесса
+    :param table: название таблицы
+    """
+    now = datetime.now(timezone.utc)
+    for key, value in (state.get_state(key=table) or {}).items():
+        if value:
+            WATERMARK_LAG.set((now - datetime.fromisoformat(value)).total_seconds(), table=table, key=key)
+    if METRICS['summary']:
+        logging.info(f'Metrics after {table} cycle: {registry.summary()}')
+
+
+class TableRun:
+    """
+    Класс учета результатов загрузки таблицы, общий для синхронного и асинхронного загрузчиков.
+    Подтверждает документы по ответам bulk запросов и пропуску неизменившихся документов,
+    каждые checkpoint_every документов сохраняет позицию возобновления, при прерывании сохраняет ее еще раз,
+    а после полной загрузки сохраняет состояние таблицы.
+    Документ, отклоненный с неповторяемой ошибкой, откладывается в список {table}_rejected: состояние
+    продвигается за него только одной записью вместе с этим списком, а следующий запуск извлекает его повторно
+    """
+
+    def __init__(self, *, state: State, digest_store: DigestStore, table: str, index: str, progress: Progress,
+                 checkpoint_every: int, skip_unchanged: bool = True, save_digests: bool = True,
+                 save_state: bool = True, checkpoint: bool = True, budget: Optional[MemoryBudget] = None):
+        self.state = state
+        self.table = table
+        self.progress = progress
+        self.checkpoint_every = checkpoint_every
+        self.save_state = save_state
+        self.checkpoint = checkpoint
+        self.budget = budget
+        self.digests = DigestFilter(store=digest_store, index=index, skip_unchanged=skip_unchanged,
+                                    save=save_digests, on_skip=self.skip)
+        self.loaded = 0
+        self.next_checkpoint = checkpoint_every
+        # отложенные предыдущими запусками документы извлекаются повторно в этом запуске
+        self.deferred = set(rejected_ids(state=state, table=table)) if save_state else set()
+        self.rejected = set()
+
+    def skip(self, *, doc_id: str) -> None:
+        """
+        Метод подтверждения документа, пропущенного как неизменившийся
+
+        :param doc_id: идентификатор документа
+        """
+        self.progress.ack(doc_id=doc_id)
+        if self.budget is not None:
+            self.budget.release(doc_id=doc_id)
+
+    def result(self, *, ok: bool, item: dict) -> None:
+        """
+        Метод учета результата индексации документа
+
+        :param ok: проиндексирован ли документ
+        :param item: результат индексации документа, как в helpers.streaming_bulk
+        """
+        self.loaded += 1
+        result = next(iter(item.values()))
+        if ok:
+            DOCS_INDEXED.inc(index=result.get('_index'))
+            self.digests.ack(doc_id=result['_id'])
+            self.progress.ack(doc_id=result['_id'])
+        else:
+            DOCS_FAILED.inc(index=result.get('_index'))
+            if dead_letter(result=result):
+                self.digests.reject(doc_id=result['_id'])
+                if self.save_state:
+                    self.rejected.add(result['_id'])
+                    self.progress.ack(doc_id=result['_id'])
+        if self.budget is not None:
+            self.budget.release(doc_id=result['_id'])
+        if self.checkpoint and self.loaded + self.digests.hits >= self.next_checkpoint:
+            self.next_checkpoint += self.checkpoint_every
+            self.save_checkpoint()
+
+    def interrupted(self) -> None:
+        """
+        Метод сохранения позиции после прерывания загрузки
+        """
+        if self.checkpoint:
+            self.save_checkpoint()
+
+    def close(self) -> None:
+        """
+        Метод сохранения хешей подтвержденных документов, вызывается и после прерывания загрузки
+        """
+        self.digests.flush()
+        logging.info(f'Loading is complete: {self.loaded} loaded, {self.digests.hits} unchanged skipped')
+
+    def complete(self) -> None:
+        """
+        Метод сохранения состояния таблицы после загрузки: время последнего изменения, если подтверждены
+        все документы, иначе позиция, с которой продолжит следующий запуск
+        """
+        if not self.save_state or not (self.loaded or self.digests.hits or self.deferred or
+                                       self.state.get_state(key=f'{self.table}_checkpoint')):
+            return
+        if self.progress.complete:
+            self.state.update_state(values={self.table: self.progress.get_state(), f'{self.table}_checkpoint': None,
+                                            f'{self.table}_rejected': sorted(self.rejected) or None})
+        elif self.checkpoint:
+            self.save_checkpoint()
+
+    def save_checkpoint(self) -> None:
+        """
+        Метод сохранения позиции, с которой можно продолжить загрузку таблицы после сбоя,
+        вместе со временем последнего изменения уже подтвержденных документов и отложенными документами
+        """
+        if self.progress.cursor:
+            values = {f'{self.table}_checkpoint': {'cursor': self.progress.cursor,
+                                                   'watermark': self.progress.get_state()}}
+            if self.save_state:
+                values[f'{self.table}_rejected'] = sorted(self.deferred | self.rejected) or None
+            self.state.update_state(values=values)
@@ -0,0 +1,21 @@
+import psycopg2
+import pytest
+
+from etc.config import DSL
+
+
+@pytest.fixture(scope='session')
+def pg_cursor():
+    """
+    Курсор postgresql для сверки вычислений python с sql запросами, без доступной базы тесты пропускаются
+    """
+    try:
+        connection = psycopg2.connect(**DSL, connect_timeout=3)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f'Postgres is not available: {e}')
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            yield cursor
+    finally:
+        connection.close()
@@ -0,0 +1,127 @@
+import threading
+
+import pytest
+
+from budget import MemoryBudget
+from pipeline import StagedPipeline
+
+
+def reserve_in_thread(budget: MemoryBudget, *, doc_id: str, size: int) -> threading.Event:
+    reserved = threading.Event()
+
+    def reserve():
+        budget.reserve(doc_id=doc_id, size=size)
+        reserved.set()
+
+    threading.Thread(target=reserve, daemon=True).start()
+    return reserved
+
+
+def test_reserve_blocks_until_release():
+    budget = MemoryBudget(max_rows=2, max_bytes=1000)
+    budget.reserve(doc_id='a', size=10)
+    budget.reserve(doc_id='b', size=10)
+    reserved = reserve_in_thread(budget, doc_id='c', size=10)
+    assert not reserved.wait(0.2)
+    budget.release(doc_id='a')
+    assert reserved.wait(2)
+    assert (budget.rows, budget.bytes, budget.waits) == (2, 20, 1)
+
+
+def test_reserve_blocks_on_bytes():
+    budget = MemoryBudget(max_rows=100, max_bytes=100)
+    budget.reserve(doc_id='a', size=60)
+    assert budget.exhausted(size=50)
+    assert not budget.exhausted(size=40)
+
+
+def test_oversize_document_is_reserved_in_empty_budget():
+    budget = MemoryBudget(max_rows=10, max_bytes=100)
+    budget.reserve(doc_id='a', size=1000)
+    assert (budget.rows, budget.bytes) == (1, 1000)
+    reserved = reserve_in_thread(budget, doc_id='b', size=1)
+    assert not reserved.wait(0.2)
+    budget.release(doc_id='a')
+    assert reserved.wait(2)
+
+
+def test_starving_load_lets_reservation_through():
+    budget = MemoryBudget(max_rows=1, max_bytes=1000)
+    budget.reserve(doc_id='a', size=10)
+    reserved = reserve_in_thread(budget, doc_id='b', size=10)
+    assert not reserved.wait(0.2)
+    budget.starving()
+    assert reserved.wait(2)
+    budget.fed()
+    assert budget.exhausted(size=10)
+
+
+def test_close_releases_waiting_threads():
+    budget = MemoryBudget(max_rows=1, max_bytes=1000)
+    budget.reserve(doc_id='a', size=10)
+    reserved = reserve_in_thread(budget, doc_id='b', size=10)
+    budget.close()
+    assert reserved.wait(2)
+
+
+def test_repeated_document_is_released_per_reservation():
+    budget = MemoryBudget(max_rows=10, max_bytes=1000)
+    budget.reserve(doc_id='a', size=10)
+    budget.reserve(doc_id='a', size=20)
+    budget.release(doc_id='a')
+    assert (budget.rows, budget.bytes) == (1, 20)
+    budget.release(doc_id='a')
+    budget.release(doc_id='a')
+    assert (budget.rows, budget.bytes) == (0, 0)
+
+
+def test_pipeline_keeps_order_within_budget():
+    budget = MemoryBudget(max_rows=3, max_bytes=10 ** 6)
+    pipeline = StagedPipeline(queue_size=2, batch_size=2, budget=budget)
+    items = pipeline.stage(name='weighed', data=range(20), weigh=lambda item: (str(item), 1))
+    received = []
+    for item in items:
+        assert budget.rows <= 3 or budget.starved
+        received.append(item)
+        budget.release(doc_id=str(item))
+    assert received == list(range(20))
+
+
+def test_pipeline_releases_oversize_batch_before_waiting():
+    budget = MemoryBudget(max_rows=10, max_bytes=100)
+    pipeline = StagedPipeline(queue_size=2, batch_size=10, budget=budget)
+    items = pipeline.stage(name='weighed', data=['big', 'small'], weigh=lambda item: (item, 1000))
+    assert next(items) == 'big'
+    budget.release(doc_id='big')
+    assert list(items) == ['small']
+
+
+def test_producer_error_is_raised_after_produced_items():
+    def source():
+        yield from range(3)
+        raise ValueError('broken row')
+
+    pipeline = StagedPipeline(queue_size=2, batch_size=2)
+    received = []
+    with pytest.raises(ValueError, match='broken row'):
+        for item in pipeline.stage(name='extract', data=source()):
+            received.append(item)
+    assert received == [0, 1, 2]
+
+
+def test_closing_consumer_stops_producer():
+    closed = threading.Event()
+
+    def source():
+        try:
+            number = 0
+            while True:
+                yield number
+                number += 1
+        finally:
+            closed.set()
+
+    items = StagedPipeline(queue_size=1, batch_size=1).stage(name='endless', data=source())
+    assert next(items) == 0
+    items.close()
+    assert closed.wait(2)
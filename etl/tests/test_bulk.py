@@ -0,0 +1,36 @@
+import pytest
+
+from bulk import AdaptiveChunkSize
+
+
+@pytest.fixture
+def chunk_size():
+    return AdaptiveChunkSize(initial=100, minimum=10, maximum=150, target_latency=1.0)
+
+
+def test_rejection_halves_size(chunk_size):
+    chunk_size.observe(latency=0.1, rejected=True)
+    assert chunk_size.size == 50
+
+
+def test_slow_response_shrinks_size(chunk_size):
+    chunk_size.observe(latency=1.5, rejected=False)
+    assert chunk_size.size == 75
+
+
+def test_fast_response_grows_size_up_to_maximum(chunk_size):
+    chunk_size.observe(latency=0.1, rejected=False)
+    assert chunk_size.size == 126
+    chunk_size.observe(latency=0.1, rejected=False)
+    assert chunk_size.size == 150
+
+
+def test_latency_near_target_keeps_size(chunk_size):
+    chunk_size.observe(latency=0.8, rejected=False)
+    assert chunk_size.size == 100
+
+
+def test_size_stays_above_minimum(chunk_size):
+    for _ in range(10):
+        chunk_size.observe(latency=0.1, rejected=True)
+    assert chunk_size.size == 10
@@ -0,0 +1,39 @@
+import threading
+
+import psycopg2
+
+from connections import BlockingConnectionPool
+
+
+class FakeConnection:
+    closed = 0
+
+    def close(self):
+        self.closed = 1
+
+
+def test_exhausted_pool_waits_for_returned_connection(monkeypatch):
+    monkeypatch.setattr(psycopg2, 'connect', lambda *args, **kwargs: FakeConnection())
+    pool = BlockingConnectionPool(0, 1)
+    connection = pool.getconn()
+    borrowed = threading.Event()
+    waiter = threading.Thread(target=lambda: pool.getconn() and borrowed.set(), daemon=True)
+    waiter.start()
+    assert not borrowed.wait(0.2)
+    pool.putconn(connection)
+    assert borrowed.wait(2)
+
+
+def test_failed_connection_frees_slot(monkeypatch):
+    def refuse(*args, **kwargs):
+        raise psycopg2.OperationalError('connection refused')
+
+    monkeypatch.setattr(psycopg2, 'connect', refuse)
+    pool = BlockingConnectionPool(0, 1)
+    for _ in range(2):
+        try:
+            pool.getconn()
+        except psycopg2.OperationalError:
+            pass
+    monkeypatch.setattr(psycopg2, 'connect', lambda *args, **kwargs: FakeConnection())
+    assert isinstance(pool.getconn(), FakeConnection)
@@ -0,0 +1,133 @@
+from datetime import date, datetime
+
+import pytest
+
+import loader
+from copy_extract import CopyExtractor, unescape
+from data_workers import Filmwork, Person
+
+TIME = '2021-01-01T00:00:0{}.000000+00:00'
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('\\N', None),
+    ('plain', 'plain'),
+    ('', ''),
+    ('tab\\there', 'tab\there'),
+    ('line\\nbreak\\r', 'line\nbreak\r'),
+    ('back\\\\slash', 'back\\slash'),
+    ('\\\\N', '\\N'),
+    ('\\b\\f\\v', '\b\f\v'),
+    ('\\x41\\x7', 'A\x07'),
+    ('\\101\\7', 'A\x07'),
+    ('unicode ё\x1c', 'unicode ё\x1c'),
+])
+def test_unescape(value, expected):
+    assert unescape(value) == expected
+
+
+def test_unescape_matches_postgres(pg_cursor):
+    values = ['tab\there', 'line\nbreak\r\n', 'back\\slash', '\\N', 'ctrl\b\f\v\x01\x1c', 'unicode ё', None]
+
+    class Lines:
+        data = ''
+
+        def write(self, chunk):
+            self.data += chunk.decode() if isinstance(chunk, bytes) else chunk
+
+    lines = Lines()
+    pg_cursor.copy_expert(pg_cursor.mogrify('COPY (SELECT unnest(%s::text[])) TO STDOUT', (values,)), lines)
+    assert [unescape(line) for line in lines.data.split('\n')[:-1]] == values
+
+
+class FakeCursor:
+    def __init__(self, lines: list[str]):
+        self.lines = lines
+        self.params = None
+
+    def mogrify(self, query: str, params: dict) -> bytes:
+        self.params = params
+        return query.encode()
+
+    def copy_expert(self, query: bytes, file) -> None:
+        for line in self.lines:
+            if self.params['after'] is None or line.split('\t')[0] > self.params['after']:
+                file.write(line + '\n')
+
+
+class FakePG:
+    def __init__(self, lines: list[str]):
+        self.cursor = FakeCursor(lines)
+
+
+FILMWORK_LINES = [
+    'f1\t0\tTitle\\twith tab\t\\N\t7.5\t2001-02-03\t' + TIME.format(9),
+    'f1\t1\tactor\tp2\tAnn\t\\N\t' + TIME.format(2),
+    'f1\t1\tactor\tp1\tBob\t\\N\t' + TIME.format(1),
+    'f1\t1\tdirector\tp1\tBob\t\\N\t' + TIME.format(1),
+    'f1\t2\t\\N\tg1\tDrama\t\\N\t' + TIME.format(3),
+    'f2\t1\tactor\tp1\tBob\t\\N\t' + TIME.format(1),
+    'f3\t0\tAlone\t\\N\t\\N\t\\N\t' + TIME.format(8),
+]
+
+
+def test_filmwork_rows_are_grouped_by_document():
+    rows = list(CopyExtractor(pg=FakePG(FILMWORK_LINES)).rows(table='filmwork'))
+    assert [row[0] for row in rows] == ['f1', 'f3']
+    film = Filmwork(*rows[0])
+    assert film.title == 'Title\twith tab'
+    assert (film.imdb_rating, film.creation_date) == (7.5, date(2001, 2, 3))
+    assert film.actors == [{'id': 'p2', 'name': 'Ann'}, {'id': 'p1', 'name': 'Bob'}]
+    assert film.director == [{'id': 'p1', 'name': 'Bob'}]
+    assert film.genre == [{'id': 'g1', 'name': 'Drama'}]
+    assert film.get_db_state()['person_date'] == datetime.fromisoformat(TIME.format(2))
+    assert Filmwork(*rows[1]).get_db_state() == {'filmwork_date': datetime.fromisoformat(TIME.format(8)),
+                                                 'person_date': None, 'genre_date': None}
+
+
+def test_person_rows_are_grouped_by_document():
+    lines = ['p1\t0\tBob\t\\N\t' + TIME.format(1), 'p1\t1\tactor\tf1\t' + TIME.format(9),
+             'p1\t1\tdirector\tf1\t' + TIME.format(9), 'p1\t1\tactor\tf2\t' + TIME.format(5)]
+    row, = CopyExtractor(pg=FakePG(lines)).rows(table='person')
+    person = Person(*row)
+    assert (person.films_as_actor, person.films_as_director, person.films_as_writer) == (['f1', 'f2'], ['f1'], None)
+    assert person.roles == ['actor', 'director']
+
+
+def test_rows_resume_after_document():
+    pg = FakePG(FILMWORK_LINES)
+    rows = list(CopyExtractor(pg=pg).rows(table='filmwork', after='f1'))
+    assert pg.cursor.params['after'] == 'f1'
+    assert [row[0] for row in rows] == ['f3']
+
+
+def test_full_load_emits_copy_cursors(monkeypatch):
+    calls = []
+
+    class Extractor:
+        def __init__(self, *, pg, shard):
+            pass
+
+        def rows(self, *, table, after=None):
+            calls.append(after)
+            return iter([(f'g{number}',) for number in range(5)])
+
+    class Loader:
+        def __init__(self, **kwargs):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+    monkeypatch.setattr(loader, 'CopyExtractor', Extractor)
+    monkeypatch.setattr(loader, 'PostgresLoader', Loader)
+    monkeypatch.setattr(loader, 'COPY_EXTRACT', True)
+    monkeypatch.setattr(loader, 'BATCH_SIZE', 2)
+
+    data = list(loader.extract_data(table='genre', table_state={'genre_date': None}))
+    assert [cursor for _, cursor in data] == [None, {'copy': 'g1'}, None, {'copy': 'g3'}, None]
+    list(loader.extract_data(table='genre', table_state={'genre_date': None}, cursor={'copy': 'g3'}))
+    assert calls == [None, 'g3']
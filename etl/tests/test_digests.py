@@ -0,0 +1,69 @@
+import sqlite3
+
+import pytest
+
+from digests import VERSION_FIELD, DigestFilter, DigestStore
+
+
+@pytest.fixture
+def digest_store(tmp_path):
+    store = DigestStore(file_path=str(tmp_path / 'digests.db'))
+    yield store
+    store.close()
+
+
+def action(doc_id: str, name: str, version: str) -> dict:
+    return {'_index': 'genres', '_id': doc_id, '_source': {'id': doc_id, 'name': name, VERSION_FIELD: version}}
+
+
+def load(digests: DigestFilter, actions: list[dict]) -> list[dict]:
+    sent = list(digests.filter(actions))
+    for item in sent:
+        digests.ack(doc_id=item['_id'])
+    digests.flush()
+    return sent
+
+
+def test_unchanged_document_is_skipped(digest_store):
+    load(DigestFilter(store=digest_store, index='genres'), [action('a', 'Drama', 'v1')])
+    digests = DigestFilter(store=digest_store, index='genres')
+    assert load(digests, [action('a', 'Drama', 'v1')]) == []
+    assert digests.hits == 1
+
+
+def test_version_only_change_is_sent_as_partial_update(digest_store):
+    load(DigestFilter(store=digest_store, index='genres'), [action('a', 'Drama', 'v1')])
+    digests = DigestFilter(store=digest_store, index='genres')
+    assert load(digests, [action('a', 'Drama', 'v2')]) == [
+        {'_op_type': 'update', '_index': 'genres', '_id': 'a', 'doc': {VERSION_FIELD: 'v2'}}
+    ]
+    assert digest_store.retrieve(index='genres', ids=['a'])['a'][1] == 'v2'
+    assert load(DigestFilter(store=digest_store, index='genres'), [action('a', 'Drama', 'v2')]) == []
+
+
+def test_changed_document_is_sent_in_full(digest_store):
+    load(DigestFilter(store=digest_store, index='genres'), [action('a', 'Drama', 'v1')])
+    changed = action('a', 'Comedy', 'v2')
+    assert load(DigestFilter(store=digest_store, index='genres'), [changed]) == [changed]
+
+
+def test_load_into_other_index_does_not_save_digests(digest_store):
+    sent = load(DigestFilter(store=digest_store, index='genres', skip_unchanged=False, save=False),
+                [action('a', 'Drama', 'v1')])
+    assert len(sent) == 1
+    assert digest_store.retrieve(index='genres', ids=['a']) == {}
+
+
+def test_store_without_version_column_is_migrated(tmp_path):
+    file_path = str(tmp_path / 'digests.db')
+    connection = sqlite3.connect(file_path)
+    with connection:
+        connection.execute('CREATE TABLE digests (doc_index TEXT NOT NULL, doc_id TEXT NOT NULL, '
+                           'digest BLOB NOT NULL, PRIMARY KEY (doc_index, doc_id)) WITHOUT ROWID')
+        connection.execute("INSERT INTO digests VALUES ('genres', 'a', x'00')")
+    connection.close()
+    store = DigestStore(file_path=file_path)
+    try:
+        assert store.retrieve(index='genres', ids=['a']) == {'a': (b'\x00', None)}
+    finally:
+        store.close()
@@ -0,0 +1,102 @@
+from datetime import datetime, timezone
+
+from data_workers import Filmwork
+from dimensions import DimensionCache, Dimensions
+from etc.queries import QUERIES
+
+
+def at(hour: int) -> datetime:
+    return datetime(2021, 1, 1, hour, tzinfo=timezone.utc)
+
+
+class FakeCursor:
+    def __init__(self, pg: 'FakePG'):
+        self.pg = pg
+
+    def execute(self, query: str, params=None) -> None:
+        self.pg.queries.append(query)
+        table = 'person' if query == QUERIES['person_dimension_watermark'] else 'genre'
+        self.result = max(modified for _, modified in getattr(self.pg, f'{table}s').values())
+
+    def fetchone(self) -> tuple:
+        return self.result,
+
+
+class FakePG:
+    def __init__(self):
+        self.films = [('f1', 'Film', None, 7.5, None, at(1))]
+        self.links = [('f1', 'p1', 'actor'), ('f1', 'p1', 'director'), ('f1', 'p2', 'producer'),
+                      ('f1', 'p3', 'writer'), ('f1', 'g1', None)]
+        self.persons = {'p1': ('Ann', at(2)), 'p2': ('Bob', at(3)), 'p3': ('Cid', at(1))}
+        self.genres = {'g1': ('Drama', at(4))}
+        self.queries = []
+        self.cursor = FakeCursor(self)
+
+    def batch_execute(self, *, query: str, params: dict):
+        self.queries.append(query)
+        if query == QUERIES['filmwork_slim']:
+            yield [film for film in self.films if film[0] in params['ids']]
+        elif query == QUERIES['filmwork_links']:
+            yield [link for link in self.links if link[0] in params['ids']]
+        elif query in (QUERIES['person_dimension'], QUERIES['genre_dimension']):
+            entries = self.persons if query == QUERIES['person_dimension'] else self.genres
+            yield [(entry_id, *entries[entry_id]) for entry_id in params['ids'] if entry_id in entries]
+        elif query in (QUERIES['person_renames'], QUERIES['genre_renames']):
+            entries, key = (self.persons, 'person_date') if query == QUERIES['person_renames'] else \
+                (self.genres, 'genre_date')
+            yield [(entry_id, name, modified) for entry_id, (name, modified) in entries.items()
+                   if modified > params[key]]
+
+
+def test_filmwork_row_matches_query_shape():
+    pg = FakePG()
+    row, = Dimensions(maxsize=10).filmwork_rows(pg=pg, ids=['f1'])
+    film = Filmwork(*row)
+    assert film.actors == [{'id': 'p1', 'name': 'Ann'}]
+    assert film.director == [{'id': 'p1', 'name': 'Ann'}]
+    assert film.writers == [{'id': 'p3', 'name': 'Cid'}]
+    assert film.genre == [{'id': 'g1', 'name': 'Drama'}]
+    # персона с ролью вне индекса не попадает в поля, но ее изменение меняет фильм
+    assert sorted(row[9]) == [at(1), at(2), at(3)]
+    assert film.get_db_state() == {'filmwork_date': at(1), 'person_date': at(3), 'genre_date': at(4)}
+
+
+def test_film_without_links():
+    pg = FakePG()
+    pg.links = []
+    row, = Dimensions(maxsize=10).filmwork_rows(pg=pg, ids=['f1'])
+    assert row[5:11] == (None, None, None, None, [], [])
+
+
+def test_cached_entries_are_not_fetched_again():
+    pg = FakePG()
+    dimensions = Dimensions(maxsize=10)
+    dimensions.filmwork_rows(pg=pg, ids=['f1'])
+    pg.queries.clear()
+    dimensions.filmwork_rows(pg=pg, ids=['f1'])
+    assert QUERIES['person_dimension'] not in pg.queries
+    assert QUERIES['genre_dimension'] not in pg.queries
+    assert dimensions.persons.hits == 3
+
+
+def test_least_recently_used_entries_are_evicted():
+    pg = FakePG()
+    cache = DimensionCache(name='person', state_key='person_date', maxsize=2)
+    cache.get_many(pg=pg, ids={'p1'})
+    cache.get_many(pg=pg, ids={'p2'})
+    cache.get_many(pg=pg, ids={'p1'})
+    cache.get_many(pg=pg, ids={'p3'})
+    assert list(cache.entries) == ['p1', 'p3']
+
+
+def test_refresh_updates_only_cached_entries():
+    pg = FakePG()
+    cache = DimensionCache(name='person', state_key='person_date', maxsize=10)
+    cache.refresh(pg=pg)
+    assert cache.watermark == at(3)
+    cache.get_many(pg=pg, ids={'p1'})
+    pg.persons['p1'] = ('Anna', at(5))
+    pg.persons['p2'] = ('Bobby', at(6))
+    cache.refresh(pg=pg)
+    assert cache.entries == {'p1': ('Anna', at(5))}
+    assert cache.watermark == at(6)
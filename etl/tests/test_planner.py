@@ -0,0 +1,48 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from planner import ChangePlanner
+
+START = datetime(2021, 1, 1, tzinfo=timezone.utc)
+# ветка 0 - сами фильмы, ветка 1 - жанры, ветка 2 - персоны; f2 и f3 повторяются в разных ветках
+BRANCHES = [
+    [('f1', START, 'f1'), ('f2', START + timedelta(seconds=1), 'f2')],
+    [('f2', START, 'g1'), ('f3', START, 'g1'), ('f4', START + timedelta(seconds=2), 'g2')],
+    [('f3', START, 'p1'), ('f5', START, 'p1')],
+]
+
+
+class FakePG:
+    def batch_execute(self, *, query, params, name):
+        rows = BRANCHES[int(name.rsplit('_', 1)[1])]
+        yield rows[:2]
+        yield rows[2:]
+
+
+class AsyncFakePG:
+    async def batch_execute(self, *, query, params, name):
+        for rows in FakePG().batch_execute(query=query, params=params, name=name):
+            yield rows
+
+
+def expected():
+    return [
+        (['f1', 'f2'], {'branch': 0, 'modified': (START + timedelta(seconds=1)).isoformat(), 'id': 'f2'}),
+        (['f3', 'f4'], {'branch': 1, 'modified': (START + timedelta(seconds=2)).isoformat(), 'id': 'g2'}),
+        (['f5'], {'branch': 2, 'modified': START.isoformat(), 'id': 'p1'}),
+    ]
+
+
+def test_changed_ids_deduplicates_across_branches():
+    planner = ChangePlanner(pg=FakePG(), batch_size=2)
+    state = dict.fromkeys(('filmwork_date', 'genre_date', 'person_date'))
+    assert list(planner.changed_ids(table='filmwork', table_state=state)) == expected()
+
+
+def test_async_changed_ids_matches_sync():
+    async def collect():
+        planner = ChangePlanner(pg=AsyncFakePG(), batch_size=2)
+        state = dict.fromkeys(('filmwork_date', 'genre_date', 'person_date'))
+        return [item async for item in planner.changed_ids_async(table='filmwork', table_state=state)]
+
+    assert asyncio.run(collect()) == expected()
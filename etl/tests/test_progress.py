@@ -0,0 +1,53 @@
+from datetime import datetime, timezone
+
+from progress import Progress
+
+
+def at(hour: int) -> datetime:
+    return datetime(2021, 1, 1, hour, tzinfo=timezone.utc)
+
+
+def test_watermark_advances_over_acked_prefix_only():
+    progress = Progress(watermark={'filmwork_date': at(0).isoformat()})
+    progress.register(doc_id='a', times={'filmwork_date': at(1)})
+    progress.register(doc_id='b', times={'filmwork_date': at(3)}, cursor={'id': 'b'})
+    progress.register(doc_id='c', times={'filmwork_date': at(2)})
+
+    progress.ack(doc_id='c')
+    progress.ack(doc_id='b')
+    assert progress.get_state() == {'filmwork_date': at(0).isoformat()}
+    assert progress.cursor is None
+    assert not progress.complete
+
+    progress.ack(doc_id='a')
+    assert progress.get_state() == {'filmwork_date': at(3).isoformat()}
+    assert progress.cursor == {'id': 'b'}
+    assert progress.complete
+
+
+def test_cursor_stops_at_first_unacked_document():
+    progress = Progress()
+    for number in range(6):
+        progress.register(doc_id=str(number), times={}, cursor={'id': number} if number % 2 else None)
+    for number in (0, 1, 2, 4, 5):
+        progress.ack(doc_id=str(number))
+    assert progress.cursor == {'id': 1}
+    assert not progress.complete
+
+
+def test_repeated_document_is_acked_per_registration():
+    progress = Progress()
+    progress.register(doc_id='a', times={'genre_date': at(1)})
+    progress.register(doc_id='a', times={'genre_date': at(2)})
+    progress.ack(doc_id='a')
+    assert progress.get_state() == {'genre_date': at(1).isoformat()}
+    progress.ack(doc_id='a')
+    assert progress.get_state() == {'genre_date': at(2).isoformat()}
+    assert progress.complete
+
+
+def test_unknown_ack_is_ignored():
+    progress = Progress()
+    progress.register(doc_id='a', times={})
+    progress.ack(doc_id='b')
+    assert not progress.complete
@@ -0,0 +1,74 @@
+from itertools import product
+from math import lcm
+from uuid import UUID
+
+import pytest
+
+from etc.queries import shard_filter
+from shard import MAX_COUNT, Shard
+
+# последние 8 символов покрывают границы 32 бит: ноль, старший бит и максимум
+IDS = ['00000000-0000-0000-0000-000000000000', '00000000-0000-0000-0000-00007fffffff',
+       '00000000-0000-0000-0000-000080000000', 'ffffffff-ffff-ffff-ffff-ffffffffffff',
+       *(str(UUID(int=n * 0x9E3779B97F4A7C15F39CC0605CEDC835 % 2 ** 128)) for n in range(1, 200))]
+
+
+@pytest.mark.parametrize('doc_id, index, count', [
+    ('00000000-0000-0000-0000-000000000000', 0, 7),
+    ('00000000-0000-0000-0000-0000ffffffff', 3, 7),
+    ('00000000-0000-0000-0000-000080000000', 3, 5),
+    ('ffffffff-ffff-ffff-ffff-fffe00000001', 1, 2),
+])
+def test_owns_uses_last_32_bits(doc_id, index, count):
+    assert Shard(index=index, count=count).owns(doc_id=doc_id)
+    assert not Shard(index=(index + 1) % count, count=count).owns(doc_id=doc_id)
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 7, MAX_COUNT])
+def test_every_id_has_one_owner(count):
+    for doc_id in IDS:
+        assert sum(Shard(index=index, count=count).owns(doc_id=doc_id) for index in range(count)) == 1
+
+
+@pytest.mark.parametrize('index, count', [(0, 2), (1, 2), (2, 3), (6, 7), (MAX_COUNT - 1, MAX_COUNT)])
+def test_owns_matches_sql(pg_cursor, index, count):
+    shard = Shard(index=index, count=count)
+    pg_cursor.execute(f'''
+        SELECT docs.id::text
+        FROM unnest(%(ids)s::uuid[]) AS docs(id)
+        WHERE {shard_filter("docs.id")}
+    ''', {'ids': IDS, **shard.params})
+    assert sorted(doc_id for doc_id, in pg_cursor.fetchall()) == sorted(
+        doc_id for doc_id in IDS if shard.owns(doc_id=doc_id))
+
+
+def test_shard_filter_is_disabled_for_single_shard(pg_cursor):
+    pg_cursor.execute(f'SELECT count(*) FROM unnest(%(ids)s::uuid[]) AS docs(id) WHERE {shard_filter("docs.id")}',
+                      {'ids': IDS, **Shard().params})
+    assert pg_cursor.fetchone()[0] == len(IDS)
+
+
+def test_overlaps_matches_brute_force():
+    layouts = [(index, count) for count in range(1, 13) for index in range(count)]
+    for (i, n), (j, m) in product(layouts, repeat=2):
+        expected = any(x % n == i and x % m == j for x in range(lcm(n, m)))
+        assert Shard(index=i, count=n).overlaps(Shard(index=j, count=m)) == expected
+
+
+def test_lock_key_round_trip():
+    for index, count in [(0, 1), (1, 2), (5, 8), (MAX_COUNT - 1, MAX_COUNT)]:
+        shard = Shard.from_lock_key(Shard(index=index, count=count).lock_key)
+        assert (shard.index, shard.count) == (index, count)
+
+
+@pytest.mark.parametrize('index, count', [(0, 0), (0, MAX_COUNT + 1), (2, 2), (-1, 2)])
+def test_invalid_layout(index, count):
+    with pytest.raises(ValueError):
+        Shard(index=index, count=count)
+
+
+def test_parse():
+    shard = Shard.parse(spec='2/4')
+    assert (shard.index, shard.count, str(shard)) == (2, 4, '2/4')
+    assert Shard.parse(spec=None).params == {'shard': None, 'shard_count': None}
+    assert shard.file_path(path='state/state.json') == 'state/state.2of4.json'
@@ -0,0 +1,84 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from digests import DigestStore
+from progress import Progress
+from state import JsonFileStorage, State
+from table_run import TableRun, rejected_ids
+
+TIME = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def state(tmp_path):
+    return State(storage=JsonFileStorage(file_path=str(tmp_path / 'state.json')))
+
+
+@pytest.fixture
+def digest_store(tmp_path):
+    store = DigestStore(file_path=str(tmp_path / 'digests.db'))
+    yield store
+    store.close()
+
+
+def make_run(*, state, digest_store, ids, **kwargs) -> TableRun:
+    progress = Progress(watermark={'genre_date': None})
+    for doc_id in ids:
+        progress.register(doc_id=doc_id, times={'genre_date': TIME}, cursor={'id': doc_id})
+    return TableRun(state=state, digest_store=digest_store, table='genre', index='genres', progress=progress,
+                    checkpoint_every=100, **kwargs)
+
+
+def result(doc_id: str, status: int) -> dict:
+    return {'index': {'_id': doc_id, '_index': 'genres', 'status': status, 'error': {'type': 'error'}}}
+
+
+def test_rejected_document_is_deferred_with_state(state, digest_store):
+    digest_store.save(index='genres', digests=[('b', b'old', None)])
+    run = make_run(state=state, digest_store=digest_store, ids=['a', 'b'])
+    run.result(ok=True, item=result('a', 201))
+    run.result(ok=False, item=result('b', 400))
+    run.close()
+    run.complete()
+    assert state.get_state(key='genre') == {'genre_date': TIME.isoformat()}
+    assert rejected_ids(state=state, table='genre') == ['b']
+    assert digest_store.retrieve(index='genres', ids=['b']) == {}
+
+
+def test_deferred_document_is_cleared_after_loading(state, digest_store):
+    state.set_state(key='genre_rejected', value=['b'])
+    run = make_run(state=state, digest_store=digest_store, ids=['b'])
+    run.result(ok=True, item=result('b', 200))
+    run.close()
+    run.complete()
+    assert rejected_ids(state=state, table='genre') == []
+
+
+def test_checkpoint_keeps_deferred_documents(state, digest_store):
+    state.set_state(key='genre_rejected', value=['c'])
+    run = make_run(state=state, digest_store=digest_store, ids=['a', 'b'])
+    run.result(ok=False, item=result('a', 400))
+    run.interrupted()
+    assert state.get_state(key='genre_checkpoint')['cursor'] == {'id': 'a'}
+    assert rejected_ids(state=state, table='genre') == ['a', 'c']
+
+
+def test_retriable_rejection_holds_state(state, digest_store):
+    run = make_run(state=state, digest_store=digest_store, ids=['a', 'b'])
+    run.result(ok=False, item=result('a', 429))
+    run.result(ok=True, item=result('b', 201))
+    run.close()
+    run.complete()
+    assert state.get_state(key='genre') is None
+    assert state.get_state(key='genre_checkpoint') is None
+    assert rejected_ids(state=state, table='genre') == []
+
+
+def test_rejection_outside_state_runs_is_not_deferred(state, digest_store):
+    run = make_run(state=state, digest_store=digest_store, ids=['a'], save_state=False, checkpoint=False)
+    run.result(ok=False, item=result('a', 400))
+    run.close()
+    run.complete()
+    assert not run.progress.complete
+    assert rejected_ids(state=state, table='genre') == []
@@ -0,0 +1,43 @@
+import psycopg2
+import pytest
+from elasticsearch import ConnectionError as ESConnectionError, TransportError, helpers
+
+from utils import CircuitBreaker, classify_error
+
+
+@pytest.mark.parametrize('error, backend', [
+    (psycopg2.OperationalError('server closed the connection unexpectedly'), 'postgres'),
+    (psycopg2.InterfaceError('connection already closed'), 'postgres'),
+    (ESConnectionError('N/A', 'Connection refused', OSError()), 'elasticsearch'),
+    (TransportError(503, 'unavailable', {}), 'elasticsearch'),
+    (TransportError(429, 'es_rejected_execution_exception', {}), 'elasticsearch'),
+    (helpers.BulkIndexError('1 document(s) failed to index.', [{'index': {'_id': 'a', 'status': 429}}]),
+     'elasticsearch'),
+    (TransportError(400, 'mapper_parsing_exception', {}), None),
+    (helpers.BulkIndexError('2 document(s) failed to index.',
+                            [{'index': {'_id': 'a', 'status': 429}}, {'index': {'_id': 'b', 'status': 400}}]), None),
+    (psycopg2.ProgrammingError('syntax error'), None),
+    (KeyError('id'), None),
+])
+def test_classify_error(error, backend):
+    assert classify_error(error) == backend
+
+
+def test_circuit_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(name='postgres', failure_threshold=2, reset_timeout=60)
+    breaker.failure()
+    assert breaker.remaining() == 0
+    breaker.failure()
+    assert 0 < breaker.remaining() <= 60
+    breaker.success()
+    assert breaker.remaining() == 0
+
+
+def test_circuit_breaker_reopens_on_first_failure_after_timeout():
+    breaker = CircuitBreaker(name='elasticsearch', failure_threshold=3, reset_timeout=0)
+    for _ in range(3):
+        breaker.failure()
+    assert breaker.remaining() == 0
+    breaker.reset_timeout = 60
+    breaker.failure()
+    assert breaker.remaining() > 0
@@ -0,0 +1,110 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from data_workers import Genre
+from digests import DigestStore
+from etc.queries import QUERIES, VERSION_FORMAT, VERSION_SQL_FORMAT
+from serializers import dumps
+from utils import doc_version
+from verify import ConsistencyChecker, version_digest
+
+TIMES = [datetime(2021, 1, 1, tzinfo=timezone.utc),
+         datetime(2021, 6, 30, 23, 59, 59, 999999, tzinfo=timezone.utc),
+         datetime(2021, 3, 28, 3, 30, 0, 1, tzinfo=timezone(timedelta(hours=3))),
+         datetime(1999, 12, 31, 20, 0, tzinfo=timezone(timedelta(hours=-5)))]
+
+
+def test_doc_version_is_latest_time_in_utc():
+    times = {'filmwork_date': TIMES[2], 'person_date': None, 'genre_date': TIMES[0]}
+    assert doc_version(times) == '2021-03-28T00:30:00.000001Z'
+    assert doc_version({'genre_date': None}) is None
+
+
+@pytest.mark.parametrize('table', ['filmwork', 'person', 'genre'])
+def test_versions_query_uses_version_format(table):
+    assert f"AT TIME ZONE 'UTC', '{VERSION_SQL_FORMAT}')" in QUERIES[f'{table}_versions']
+
+
+def test_version_formats_agree():
+    tokens = {'YYYY': '%Y', 'MM': '%m', 'DD': '%d', 'HH24': '%H', 'MI': '%M', 'SS': '%S', 'US': '%f', '"': ''}
+    sql_format = VERSION_SQL_FORMAT
+    for token, directive in tokens.items():
+        sql_format = sql_format.replace(token, directive)
+    assert sql_format == VERSION_FORMAT
+
+
+def test_doc_version_matches_postgres(pg_cursor):
+    pg_cursor.execute(f'''
+        SELECT to_char(times.time AT TIME ZONE 'UTC', '{VERSION_SQL_FORMAT}')
+        FROM unnest(%(times)s::timestamptz[]) AS times(time)
+    ''', {'times': TIMES})
+    assert [version for version, in pg_cursor.fetchall()] == [doc_version({'time': time}) for time in TIMES]
+
+
+def test_version_digest_fits_60_bits():
+    for version in ('2021-01-01T00:00:00.000000Z', None):
+        assert 0 <= version_digest(doc_id='ffffffff-ffff-ffff-ffff-ffffffffffff', version=version) < 2 ** 60
+    assert version_digest(doc_id='a', version=None) == version_digest(doc_id='a', version='')
+
+
+def test_version_buckets_match_postgres(pg_cursor):
+    docs = [('0a000000-0000-0000-0000-000000000001', '2021-01-01T00:00:00.000000Z'),
+            ('0a000000-0000-0000-0000-000000000002', None),
+            ('0b000000-0000-0000-0000-000000000003', '2021-06-30T23:59:59.999999Z')]
+    versions = 'SELECT docs.id, docs.version FROM unnest(%(ids)s::text[], %(versions)s::text[]) AS docs(id, version)'
+    pg_cursor.execute(QUERIES['version_buckets'].format(versions=versions),
+                      {'prefix_length': 2, 'ids': [doc_id for doc_id, _ in docs],
+                       'versions': [version for _, version in docs]})
+    expected = {}
+    for doc_id, version in docs:
+        count, digest = expected.get(doc_id[:2], (0, 0))
+        expected[doc_id[:2]] = (count + 1, digest + version_digest(doc_id=doc_id, version=version))
+    assert {bucket: (count, int(digest)) for bucket, count, digest in pg_cursor.fetchall()} == expected
+
+
+def test_digest_ignores_version():
+    source = {'id': 'g1', 'name': 'Drama', 'description': None, 'modified': '2021-01-01T00:00:00.000000Z'}
+    assert DigestStore.digest(source) == DigestStore.digest({**source, 'modified': '2022-01-01T00:00:00.000000Z'})
+    assert DigestStore.digest(source) == DigestStore.digest({key: source[key] for key in reversed(source)})
+    assert DigestStore.digest(source) != DigestStore.digest({**source, 'name': 'Comedy'})
+
+
+def source(*row, version=None) -> dict:
+    data = json.loads(dumps(Genre(*row).get_bulk_format()['_source']))
+    return {**data, 'modified': version} if version else data
+
+
+class FakePG:
+    def __init__(self, rows: dict):
+        self.rows = rows
+
+    def batch_execute(self, *, query: str, params: dict):
+        if query == QUERIES['genre']:
+            yield [self.rows[doc_id] for doc_id in params['ids'] if doc_id in self.rows]
+        else:
+            yield [(doc_id, source(*row)['modified']) for doc_id, row in self.rows.items()]
+
+
+class FakeES:
+    def __init__(self, docs: dict):
+        self.docs = docs
+
+    def mget(self, *, index: str, body: dict) -> dict:
+        return {'docs': [{'_id': doc_id, 'found': doc_id in self.docs, '_source': self.docs.get(doc_id)}
+                         for doc_id in body['ids']]}
+
+
+def test_check_compares_content_of_documents_with_other_versions():
+    old, new = datetime(2021, 1, 1, tzinfo=timezone.utc), datetime(2021, 1, 2, tzinfo=timezone.utc)
+    rows = {'a1': ('a1', 'Drama', None, new), 'a2': ('a2', 'Comedy', 'new', new), 'a3': ('a3', 'Horror', None, old),
+            'a5': ('a5', 'Noir', None, old)}
+    docs = {'a1': source('a1', 'Drama', None, new, version='old'), 'a2': source('a2', 'Comedy', 'old', old),
+            'a3': source(*rows['a3']), 'a4': source('a4', 'Western', None, old)}
+    checker = ConsistencyChecker(pg=FakePG(rows), es=FakeES(docs), table='genre', index='genres', document=Genre)
+    checker.pg_buckets = lambda: {'a': (4, 1)}
+    checker.es_buckets = lambda: {'a': (4, 2)}
+    checker.es_versions = lambda bucket: {doc_id: doc['modified'] for doc_id, doc in docs.items()}
+
+    assert list(checker.check()) == [('a', ['a2', 'a5'], {'a1': source(*rows['a1'])['modified']}, ['a4'])]
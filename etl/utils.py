@@ -1,14 +1,136 @@
+import asyncio
+import inspect
 import logging
-from datetime import datetime
+import random
+import threading
+from datetime import datetime, timezone
 from functools import wraps
-from time import sleep
+from time import monotonic, sleep
 from typing import Optional
 
+import psycopg2
+from elasticsearch import ConnectionError as ESConnectionError, TransportError, helpers
+
+from etc.config import RETRY
+from etc.queries import VERSION_FORMAT
+from metrics import BACKOFF_RETRIES
+
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+
+RETRIABLE_STATUSES = (429, 502, 503, 504)
+PG_RETRIABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError) + \
+    ((psycopg.OperationalError, psycopg.InterfaceError) if psycopg else ())
+
+
+class CircuitBreaker:
+    """
+    Класс автоматического выключателя обращений к сервису.
+    После failure_threshold повторяемых ошибок подряд выключатель размыкается на reset_timeout секунд:
+    все потоки ждут вместо повторных запросов к недоступному сервису, затем обращения снова разрешаются,
+    и первая же ошибка размыкает выключатель заново.
+    """
+
+    def __init__(self, *, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    def remaining(self) -> float:
+        """
+        Метод получения времени до разрешения обращений
+
+        :return: секунды, 0 - если выключатель замкнут или время ожидания истекло
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(self.opened_at + self.reset_timeout - monotonic(), 0.0)
+
+    def success(self) -> None:
+        with self.lock:
+            if self.opened_at is not None:
+                logging.info(f'Circuit breaker {self.name} closed')
+            self.failures, self.opened_at = 0, None
+
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logging.warning(f'Circuit breaker {self.name} opened for {self.reset_timeout} seconds')
+                self.opened_at = monotonic()
+
+
+breakers = {
+    backend: CircuitBreaker(name=backend, failure_threshold=RETRY['breaker_threshold'],
+                            reset_timeout=RETRY['breaker_reset'])
+    for backend in ('postgres', 'elasticsearch')
+}
+
+
+def classify_error(error: BaseException) -> Optional[str]:
+    """
+    Функция определения, можно ли повторить действие после ошибки
+
+    :param error: исключение
+    :return: название сервиса, временная недоступность которого вызвала ошибку, None - если ошибка не повторяемая
+    """
+    if isinstance(error, PG_RETRIABLE_ERRORS):
+        return 'postgres'
+    if isinstance(error, ESConnectionError):
+        return 'elasticsearch'
+    if isinstance(error, TransportError) and error.status_code in RETRIABLE_STATUSES:
+        return 'elasticsearch'
+    if isinstance(error, helpers.BulkIndexError) and all(
+            next(iter(item.values())).get('status') in RETRIABLE_STATUSES for item in error.errors):
+        return 'elasticsearch'
+    return None
+
+
+def jitter(seconds: float) -> float:
+    """
+    Функция случайного сокращения времени ожидания до половины, чтобы повторы разных потоков не совпадали
+
+    :param seconds: время ожидания
+    :return: время ожидания со случайной составляющей
+    """
+    return random.uniform(seconds / 2, seconds) if RETRY['jitter'] else seconds
+
+
+def _retry_delay(*, error: Exception, name: str, attempt: int, start_sleep_time: float, factor: float,
+                 border_sleep_time: float) -> Optional[float]:
+    if (backend := classify_error(error)) is None:
+        logging.error(f'{name} failed with non-retriable error: {error!r}')
+        return None
+    breakers[backend].failure()
+    seconds = jitter(min(start_sleep_time * factor ** attempt, border_sleep_time))
+    BACKOFF_RETRIES.inc(function=name)
+    logging.error(f'{error}\nRetry {name} after {seconds:.2f} seconds')
+    return seconds
+
+
+def _breakers_wait() -> float:
+    return max(breaker.remaining() for breaker in breakers.values())
+
+
+def _breakers_success() -> None:
+    for breaker in breakers.values():
+        breaker.success()
+
 
 def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10):
     """
-    Функция для повторного выполнения функции через некоторое время, если возникла ошибка.
-    Использует наивный экспоненциальный рост времени повтора (factor) до граничного времени ожидания (border_sleep_time)
+    Функция для повторного выполнения функции через некоторое время, если возникла повторяемая ошибка.
+    Использует экспоненциальный рост времени повтора (factor) до граничного времени ожидания (border_sleep_time)
+    со случайной составляющей и ждет, пока разомкнут выключатель сервиса.
+    Неповторяемые ошибки, KeyboardInterrupt и SystemExit пробрасываются сразу.
+    Генераторы не оборачиваются: повтор должен выполнять код, который их потребляет и знает позицию продолжения
 
     :param start_sleep_time: начальное время повтора
     :param factor: во сколько раз нужно увеличить время ожидания
@@ -17,34 +139,72 @@ def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10):
     """
 
     def func_wrapper(func):
+        if inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func):
+            raise TypeError(f'{func.__name__} is a generator function, retry its consumer instead')
+
         @wraps(func)
         def inner(*args, **kwargs):
-            n = 0
+            attempt = 0
             while True:
+                if seconds := _breakers_wait():
+                    sleep(seconds)
                 try:
-                    return func(*args, **kwargs)
-                except BaseException as e:
-                    seconds = start_sleep_time * factor ** n
-                    if seconds < border_sleep_time:
-                        n += 1
-                    else:
-                        seconds = border_sleep_time
-                    logging.error(f'{e}\nRetry after {seconds} seconds')
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    seconds = _retry_delay(error=e, name=func.__name__, attempt=attempt,
+                                           start_sleep_time=start_sleep_time, factor=factor,
+                                           border_sleep_time=border_sleep_time)
+                    if seconds is None:
+                        raise
+                    attempt = min(attempt + 1, 64)
                     sleep(seconds)
+                else:
+                    _breakers_success()
+                    return result
 
         return inner
 
     return func_wrapper
 
 
-def get_format_time(*, time: str) -> str:
+def async_backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10):
     """
-    Функция форматирования времени для sql запроса
+    Вариант backoff для корутин: ожидание перед повтором не блокирует цикл событий,
+    отмена задачи (CancelledError) не повторяется
 
-    :param time: начальное время повтора
-    :return: результат форматирования, в случае. если поле отсутствует - возвращается None
+    :param start_sleep_time: начальное время повтора
+    :param factor: во сколько раз нужно увеличить время ожидания
+    :param border_sleep_time: граничное время ожидания
+    :return: результат выполнения корутины
     """
-    return f'\'{time}\'' if time else None
+
+    def func_wrapper(func):
+        if inspect.isasyncgenfunction(func):
+            raise TypeError(f'{func.__name__} is a generator function, retry its consumer instead')
+
+        @wraps(func)
+        async def inner(*args, **kwargs):
+            attempt = 0
+            while True:
+                if seconds := _breakers_wait():
+                    await asyncio.sleep(seconds)
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception as e:
+                    seconds = _retry_delay(error=e, name=func.__name__, attempt=attempt,
+                                           start_sleep_time=start_sleep_time, factor=factor,
+                                           border_sleep_time=border_sleep_time)
+                    if seconds is None:
+                        raise
+                    attempt = min(attempt + 1, 64)
+                    await asyncio.sleep(seconds)
+                else:
+                    _breakers_success()
+                    return result
+
+        return inner
+
+    return func_wrapper
 
 
 def latest_datetime_from_list(*, current: Optional[datetime] = None, obj_time: list) -> datetime:
@@ -55,15 +215,9 @@ def latest_datetime_from_list(*, current: Optional[datetime] = None, obj_time: l
     :param obj_time: время объекта
     :return: максимальное время
     """
-    if not all(obj_time):
+    if not obj_time or not all(obj_time):
         return current
-
-    if current:
-        if current < max(obj_time):
-            current = max(obj_time)
-    else:
-        current = max(obj_time)
-    return current
+    return latest_datetime(current=current, obj_time=max(obj_time))
 
 
 def latest_datetime(*, current: Optional[datetime] = None, obj_time: datetime) -> datetime:
@@ -83,3 +237,15 @@ def latest_datetime(*, current: Optional[datetime] = None, obj_time: datetime) -
     else:
         current = obj_time
     return current
+
+
+def doc_version(times: dict) -> Optional[str]:
+    """
+    Функция получения версии документа: время последнего изменения записей, из которых он собран,
+    в UTC с микросекундами в формате VERSION_FORMAT, в postgresql версии формируются в формате VERSION_SQL_FORMAT
+
+    :param times: время последнего изменения документа по ключам состояния таблицы
+    :return: версия документа
+    """
+    latest = latest_datetime_from_list(obj_time=[time for time in times.values() if time])
+    return latest.astimezone(timezone.utc).strftime(VERSION_FORMAT) if latest else None
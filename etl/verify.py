@@ -0,0 +1,152 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from typing import Generator, Optional
+from uuid import UUID
+
+from elasticsearch import Elasticsearch, helpers
+
+from data_workers import PostgresLoader
+from digests import VERSION_FIELD, DigestStore
+from etc.queries import QUERIES
+from serializers import dumps
+
+
+def version_digest(*, doc_id: str, version: Optional[str]) -> int:
+    """
+    Функция хеша пары идентификатор, версия документа, совпадает с вычислением в QUERIES['version_buckets']
+
+    :param doc_id: идентификатор документа
+    :param version: версия документа
+    :return: первые 60 бит md5
+    """
+    return int(md5(f'{doc_id}|{version or ""}'.encode()).hexdigest()[:15], 16)
+
+
+class ConsistencyChecker:
+    """
+    Класс проверки соответствия индекса elasticsearch таблице postgresql.
+    Документы делятся на корзины по первым символам идентификатора, для каждой корзины с обеих сторон считаются
+    количество документов и сумма хешей пар идентификатор, версия (время последнего изменения записей документа).
+    Суммы не зависят от порядка документов, поэтому корзины postgresql считаются одним запросом с группировкой,
+    а корзины elasticsearch - параллельным чтением индекса частями (sliced scroll) только с полем modified.
+    Документы сравниваются поштучно только в несовпавших корзинах. Версия документа в индексе может отставать,
+    если документ пропущен загрузкой как неизменившийся, поэтому у документов с разными версиями
+    дополнительно сравнивается тело без версии
+    """
+
+    def __init__(self, *, pg: PostgresLoader, es: Elasticsearch, table: str, index: str, document: type,
+                 prefix_length: int = 2, slices: int = 4, scroll_size: int = 1000):
+        if not 1 <= prefix_length <= 8:
+            raise ValueError(f'Bucket prefix length must be between 1 and 8, got {prefix_length}')
+        self.pg = pg
+        self.es = es
+        self.table = table
+        self.index = index
+        self.document = document
+        self.prefix_length = prefix_length
+        self.slices = slices
+        self.scroll_size = scroll_size
+
+    def check(self) -> Generator:
+        """
+        Метод поиска расхождений
+
+        :yield: bucket, reindex, outdated, delete: корзина, идентификаторы документов, которые отсутствуют
+            в индексе или тело которых устарело, словарь идентификатор: версия документов, у которых устарела
+            только версия, и идентификаторы документов, которых нет в таблице
+        """
+        pg_buckets, es_buckets = self.pg_buckets(), self.es_buckets()
+        mismatched = sorted(bucket for bucket in pg_buckets.keys() | es_buckets.keys()
+                            if pg_buckets.get(bucket) != es_buckets.get(bucket))
+        logging.info(f'Verification of {self.index}: {len(mismatched)} of {len(pg_buckets | es_buckets)} '
+                     f'bucket(s) differ')
+        for bucket in mismatched:
+            expected, actual = self.pg_versions(bucket=bucket), self.es_versions(bucket=bucket)
+            stale = [doc_id for doc_id, version in expected.items() if doc_id in actual and actual[doc_id] != version]
+            changed = self.changed_ids(ids=stale)
+            reindex = sorted(expected.keys() - actual.keys() | changed)
+            outdated = {doc_id: expected[doc_id] for doc_id in stale if doc_id not in changed}
+            delete = sorted(actual.keys() - expected.keys())
+            if reindex or outdated or delete:
+                yield bucket, reindex, outdated, delete
+
+    def pg_buckets(self) -> dict:
+        """
+        Метод подсчета корзин таблицы
+
+        :return: словарь корзина: (количество документов, сумма хешей)
+        """
+        query = QUERIES['version_buckets'].format(versions=QUERIES[f'{self.table}_versions'])
+        self.pg.cursor.execute(query, {'prefix_length': self.prefix_length, 'lower': None, 'upper': None})
+        return {bucket: (count, int(digest)) for bucket, count, digest in self.pg.cursor.fetchall()}
+
+    def es_buckets(self) -> dict:
+        """
+        Метод подсчета корзин индекса
+
+        :return: словарь корзина: (количество документов, сумма хешей)
+        """
+        with ThreadPoolExecutor(max_workers=self.slices, thread_name_prefix='verify') as executor:
+            parts = list(executor.map(self._es_slice_buckets, range(self.slices)))
+        buckets = {}
+        for part in parts:
+            for bucket, (count, digest) in part.items():
+                total_count, total_digest = buckets.get(bucket, (0, 0))
+                buckets[bucket] = (total_count + count, total_digest + digest)
+        return buckets
+
+    def pg_versions(self, *, bucket: str) -> dict:
+        """
+        Метод получения версий документов корзины из таблицы
+
+        :param bucket: корзина
+        :return: словарь идентификатор: версия
+        """
+        params = {'lower': str(UUID(bucket.ljust(32, '0'))), 'upper': str(UUID(bucket.ljust(32, 'f')))}
+        data = self.pg.batch_execute(query=QUERIES[f'{self.table}_versions'], params=params)
+        return {doc_id: version for rows in data for doc_id, version in rows}
+
+    def es_versions(self, *, bucket: str) -> dict:
+        """
+        Метод получения версий документов корзины из индекса
+
+        :param bucket: корзина
+        :return: словарь идентификатор: версия
+        """
+        query = {'query': {'prefix': {'id': bucket}}, '_source': [VERSION_FIELD]}
+        return {hit['_id']: hit['_source'].get(VERSION_FIELD)
+                for hit in helpers.scan(self.es, index=self.index, query=query, size=self.scroll_size)}
+
+    def changed_ids(self, *, ids: list[str]) -> set:
+        """
+        Метод поиска документов, тело которых в индексе отличается от собранного из таблицы.
+        Документ из таблицы сериализуется так же, как при загрузке, и сравнивается по хешу без версии
+
+        :param ids: идентификаторы документов
+        :return: идентификаторы документов, которые нужно загрузить повторно
+        """
+        changed = set()
+        for start in range(0, len(ids), self.scroll_size):
+            batch = ids[start:start + self.scroll_size]
+            response = self.es.mget(index=self.index, body={'ids': batch})
+            indexed = {doc['_id']: DigestStore.digest(doc['_source']) for doc in response['docs'] if doc.get('found')}
+            for rows in self.pg.batch_execute(query=QUERIES[self.table], params={'ids': batch}):
+                for row in rows:
+                    action = self.document(*row).get_bulk_format()
+                    if indexed.get(action['_id']) != DigestStore.digest(json.loads(dumps(action['_source']))):
+                        changed.add(action['_id'])
+        return changed
+
+    def _es_slice_buckets(self, number: int) -> dict:
+        query = {'_source': [VERSION_FIELD]}
+        if self.slices > 1:
+            query['slice'] = {'id': number, 'max': self.slices}
+        buckets = {}
+        for hit in helpers.scan(self.es, index=self.index, query=query, size=self.scroll_size):
+            bucket = hit['_id'][:self.prefix_length]
+            count, digest = buckets.get(bucket, (0, 0))
+            buckets[bucket] = (count + 1, digest + version_digest(doc_id=hit['_id'],
+                                                                  version=hit['_source'].get(VERSION_FIELD)))
+        return buckets